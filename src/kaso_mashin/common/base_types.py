@@ -290,6 +290,14 @@ class AsyncRepository(typing.Generic[T_AggregateRoot, T_EntityModel]):
             await session.commit()
         return entity
 
+    async def create_many(
+        self, entities: typing.List[T_AggregateRoot]
+    ) -> typing.List[T_AggregateRoot]:
+        async with self._session_maker() as session:
+            session.add_all([await entity.to_model() for entity in entities])
+            await session.commit()
+        return entities
+
     async def modify(self, entity: T_AggregateRoot) -> T_AggregateRoot:
         async with self._session_maker() as session:
             model = await session.get(self._model_class, str(entity.uid))
@@ -28,6 +28,9 @@ class PredefinedImageSchema(EntitySchema):
 
     name: str = pydantic.Field(description="Name of the predefined image")
     url: str = pydantic.Field(description="URL of the predefined image")
+    prefetch: bool = pydantic.Field(
+        description="Download the image in the background and keep it refreshed", default=False
+    )
 
 
 class ConfigSchema(EntitySchema):
@@ -54,7 +57,12 @@ class ConfigSchema(EntitySchema):
     )
     default_os_disk_size: str = pydantic.Field(description="Default OS disk size", examples=["5G"])
     default_phone_home_port: int = pydantic.Field(
-        description="Default phone home port", examples=[10200]
+        description="Port on which instances phone home once they booted, 0 to not listen",
+        examples=[10200],
+    )
+    default_phone_home_host: str = pydantic.Field(
+        description="Address on which instances phone home, which must be reachable by them",
+        examples=["127.0.0.1", "172.16.5.1"],
     )
     default_host_network_dhcp4_start: str = pydantic.Field(
         description="Default host network dhcp4 start", examples=["172.16.4.10"]
@@ -84,9 +92,149 @@ class ConfigSchema(EntitySchema):
     qemu_aarch64_path: pathlib.Path = pydantic.Field(
         description="Path to the local qemu-aarch64 installation"
     )
+    qemu_img_path: pathlib.Path = pydantic.Field(
+        description="Path to the local qemu-img installation"
+    )
     predefined_images: typing.List[PredefinedImageSchema] = pydantic.Field(
         description="List of predefined images", default=[]
     )
+    convert_raw_images: bool = pydantic.Field(
+        description="Convert raw images to QCoW2 while they are downloaded", default=True
+    )
+    prefetch_interval: int = pydantic.Field(
+        description="Seconds between refreshes of prefetched images", examples=[86400]
+    )
+    prefetch_rate_limit: int = pydantic.Field(
+        description="Bytes per second prefetching may use, 0 for no limit", examples=[0, 10485760]
+    )
+    download_rate_limit: int = pydantic.Field(
+        description="Bytes per second all downloads may use together, 0 for no limit",
+        examples=[0, 52428800],
+    )
+    download_rate_limit_per_transfer: int = pydantic.Field(
+        description="Bytes per second a single download may use, 0 for no limit",
+        examples=[0, 10485760],
+    )
+    download_chunk_size: int = pydantic.Field(
+        description="Bytes to read from the network at a time while downloading",
+        examples=[1048576],
+    )
+    download_buffer_size: int = pydantic.Field(
+        description="Bytes to collect before writing a download to disk", examples=[8388608]
+    )
+    process_concurrency: int = pydantic.Field(
+        description="Number of external commands that may run at the same time", examples=[4]
+    )
+    process_timeout: int = pydantic.Field(
+        description="Seconds after which an external command is killed", examples=[600]
+    )
+    disk_pool_size: int = pydantic.Field(
+        description="Ready-made overlay disks to keep per image and size, 0 to disable the pool",
+        examples=[0, 2],
+    )
+    image_peers: typing.List[str] = pydantic.Field(
+        description="Base URLs of peer servers to download images from before their origin",
+        examples=[["http://kaso-2.local:8000"]],
+        default=[],
+    )
+    disk_overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the filesystem size behind the instances path that disks may "
+        "provision in total, 0 for no limit",
+        examples=[2.0],
+    )
+    disk_min_free_ratio: float = pydantic.Field(
+        description="Share of the filesystem behind the instances path that must remain free to "
+        "create disks",
+        examples=[0.05],
+    )
+    capacity_queue_timeout: int = pydantic.Field(
+        description="Seconds a disk creation waits for space before it is rejected, 0 to reject "
+        "it immediately",
+        examples=[0, 300],
+    )
+    vcpu_overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the host CPUs that running instances may have as vCPUs in "
+        "total, 0 for no limit",
+        examples=[4.0],
+    )
+    ram_overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the host RAM that running instances may have in total, 0 for "
+        "no limit",
+        examples=[1.0],
+    )
+    instance_admission_timeout: int = pydantic.Field(
+        description="Seconds an instance start waits for vCPUs and RAM before it is rejected, 0 "
+        "to reject it immediately",
+        examples=[0, 300],
+    )
+    vnc_displays: int = pydantic.Field(
+        description="Number of VNC displays given to running instances, starting at display 0 on "
+        "port 5900",
+        examples=[1024],
+    )
+    gc_mode: str = pydantic.Field(
+        description="Whether garbage collection only reports orphaned files, quarantines or "
+        "deletes them",
+        examples=["report", "quarantine", "delete"],
+    )
+    gc_interval: int = pydantic.Field(
+        description="Seconds between garbage collections, 0 to collect only on request",
+        examples=[3600],
+    )
+    gc_grace_period: int = pydantic.Field(
+        description="Seconds an orphaned file must remain unmodified before it is collected",
+        examples=[3600],
+    )
+    gc_quarantine_retention: int = pydantic.Field(
+        description="Seconds quarantined orphans are kept before they are deleted",
+        examples=[604800],
+    )
+    disk_stats_interval: int = pydantic.Field(
+        description="Seconds between samples of disk activity, 0 to disable sampling",
+        examples=[10],
+    )
+    disk_stats_samples: int = pydantic.Field(
+        description="Number of samples of disk activity to keep per disk", examples=[360]
+    )
+    fleet_concurrency: int = pydantic.Field(
+        description="Number of instances of a fleet to provision concurrently", examples=[8]
+    )
+    instance_shutdown_timeout: int = pydantic.Field(
+        description="Seconds a guest is given to power off before its instance is terminated",
+        examples=[60],
+    )
+    instance_restart_policy: str = pydantic.Field(
+        description="When instances that exit are restarted, one of never, on-failure or always",
+        examples=["on-failure"],
+    )
+    instance_restart_backoff: int = pydantic.Field(
+        description="Seconds before an instance is restarted, doubling with every consecutive "
+        "failure",
+        examples=[1],
+    )
+    instance_restart_backoff_max: int = pydantic.Field(
+        description="Maximum seconds before an instance is restarted", examples=[300]
+    )
+    instance_restart_limit: int = pydantic.Field(
+        description="Number of consecutive failures after which an instance is no longer "
+        "restarted, 0 for no limit",
+        examples=[5],
+    )
+    instance_output_lines: int = pydantic.Field(
+        description="Number of lines of output to keep per instance", examples=[200]
+    )
+    instance_action_concurrency: int = pydantic.Field(
+        description="Number of instances started or stopped at the same time by a bulk action",
+        examples=[4],
+    )
+    instance_action_stagger: float = pydantic.Field(
+        description="Minimum seconds between starting or stopping consecutive instances of a "
+        "bulk action",
+        examples=[2.0],
+    )
+    instance_ready_timeout: int = pydantic.Field(
+        description="Seconds a started instance is given to become ready", examples=[300]
+    )
 
 
 Predefined_Images = [
@@ -148,6 +296,7 @@ class Config:
     )
     default_os_disk_size: str = dataclasses.field(default="5G")
     default_phone_home_port: int = dataclasses.field(default=10200)
+    default_phone_home_host: str = dataclasses.field(default="127.0.0.1")
     default_host_network_dhcp4_start: str = dataclasses.field(default="172.16.4.10")
     default_host_network_dhcp4_end: str = dataclasses.field(default="172.16.4.254")
     default_shared_network_dhcp4_start: str = dataclasses.field(default="172.16.5.10")
@@ -166,11 +315,49 @@ class Config:
     qemu_aarch64_path: pathlib.Path = dataclasses.field(
         default=pathlib.Path("/opt/homebrew/bin/qemu-system-aarch64")
     )
+    qemu_img_path: pathlib.Path = dataclasses.field(
+        default=pathlib.Path("/opt/homebrew/bin/qemu-img")
+    )
     predefined_images: typing.List[PredefinedImageSchema] = dataclasses.field(default_factory=list)
+    convert_raw_images: bool = dataclasses.field(default=True)
+    prefetch_interval: int = dataclasses.field(default=86400)
+    prefetch_rate_limit: int = dataclasses.field(default=0)
+    download_rate_limit: int = dataclasses.field(default=0)
+    download_rate_limit_per_transfer: int = dataclasses.field(default=0)
+    download_chunk_size: int = dataclasses.field(default=1048576)
+    download_buffer_size: int = dataclasses.field(default=8388608)
+    process_concurrency: int = dataclasses.field(default=4)
+    process_timeout: int = dataclasses.field(default=600)
+    disk_pool_size: int = dataclasses.field(default=0)
+    image_peers: typing.List[str] = dataclasses.field(default_factory=list)
+    disk_overcommit_ratio: float = dataclasses.field(default=2.0)
+    disk_min_free_ratio: float = dataclasses.field(default=0.05)
+    capacity_queue_timeout: int = dataclasses.field(default=0)
+    vcpu_overcommit_ratio: float = dataclasses.field(default=4.0)
+    ram_overcommit_ratio: float = dataclasses.field(default=1.0)
+    instance_admission_timeout: int = dataclasses.field(default=0)
+    vnc_displays: int = dataclasses.field(default=1024)
+    gc_mode: str = dataclasses.field(default="report")
+    gc_interval: int = dataclasses.field(default=3600)
+    gc_grace_period: int = dataclasses.field(default=3600)
+    gc_quarantine_retention: int = dataclasses.field(default=604800)
+    disk_stats_interval: int = dataclasses.field(default=10)
+    disk_stats_samples: int = dataclasses.field(default=360)
+    fleet_concurrency: int = dataclasses.field(default=8)
+    instance_shutdown_timeout: int = dataclasses.field(default=60)
+    instance_restart_policy: str = dataclasses.field(default="on-failure")
+    instance_restart_backoff: int = dataclasses.field(default=1)
+    instance_restart_backoff_max: int = dataclasses.field(default=300)
+    instance_restart_limit: int = dataclasses.field(default=5)
+    instance_output_lines: int = dataclasses.field(default=200)
+    instance_action_concurrency: int = dataclasses.field(default=4)
+    instance_action_stagger: float = dataclasses.field(default=2.0)
+    instance_ready_timeout: int = dataclasses.field(default=300)
 
     def __init__(self, config_file: typing.Optional[pathlib.Path] = None):
         self._logger = logging.getLogger(f"{self.__class__.__module__}.{self.__class__.__name__}")
         self.predefined_images = Predefined_Images
+        self.image_peers = []
         if config_file:
             self.load(config_file)
 
@@ -26,8 +26,13 @@ from .disks import (
     DiskListSchema,
     DiskGetSchema,
     DiskCreateSchema,
+    DiskBatchCreateSchema,
     DiskModifySchema,
+    DiskSnapshotSchema,
+    DiskCloneSchema,
+    DiskRebaseSchema,
     DiskFormat,
+    SnapshotKind,
 )
 from .images import (
     ImageException,
@@ -74,6 +79,9 @@ from .instances import (
     InstanceListSchema,
     InstanceGetSchema,
     InstanceCreateSchema,
+    InstanceFleetCreateSchema,
     InstanceModifySchema,
+    InstanceActionSchema,
+    InstanceAction,
     InstanceState,
 )
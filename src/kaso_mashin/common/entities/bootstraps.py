@@ -1,7 +1,6 @@
 import typing
 import enum
 import pathlib
-import subprocess
 
 from pydantic import Field
 import rich.table
@@ -160,13 +159,13 @@ class BootstrapEntity(Entity, AggregateRoot):
                     bootstrap_file,
                     bootstrap_file_source,
                 ]
-                subprocess.run(args, check=True)
+                await self.runtime.process_service.run(args)
             else:
                 bootstrap_file.write_text(rendered, encoding="utf-8")
         except jinja2.TemplateError as te:
             raise BootstrapException(status=400, msg="Templating error") from te
-        except subprocess.CalledProcessError as e:
-            raise BootstrapException(status=500, msg="Failed to render bootstrap") from e
+        except KasoMashinException as e:
+            raise BootstrapException(status=500, msg=f"Failed to render bootstrap: {e.msg}") from e
         except Exception as e:
             raise BootstrapException(status=500, msg="Unknown error") from e
 
@@ -1,13 +1,17 @@
+import asyncio
 import typing
+import contextlib
 import enum
+import os
 import pathlib
-import subprocess
+import re
+import struct
 
 from pydantic import Field
 import rich.table
 import rich.box
 
-from sqlalchemy import String, Integer, Enum, UUID
+from sqlalchemy import String, Integer, Enum, UUID, select
 from sqlalchemy.orm import Mapped, mapped_column
 
 from kaso_mashin import KasoMashinException
@@ -22,8 +26,10 @@ from kaso_mashin.common import (
     BinarySizedValue,
     BinaryScale,
 )
+from kaso_mashin.common import qcow2
 
 from .images import ImageEntity
+from .tasks import TaskEntity
 
 
 class DiskFormat(enum.StrEnum):
@@ -32,6 +38,11 @@ class DiskFormat(enum.StrEnum):
     VDI = "vdi"
 
 
+class SnapshotKind(enum.StrEnum):
+    EXTERNAL = "external"
+    INTERNAL = "internal"
+
+
 class DiskException(KasoMashinException):
     """
     Exception for disk-related issues
@@ -59,8 +70,7 @@ class DiskCreateSchema(EntitySchema):
         description="Disk image file format",
         examples=[DiskFormat.QCoW2, DiskFormat.Raw],
     )
-    # TODO: This should be optional
-    image_uid: UniqueIdentifier = Field(
+    image_uid: UniqueIdentifier | None = Field(
         description="The image uid on which this disk is based on", default=None
     )
 
@@ -92,6 +102,25 @@ class DiskGetSchema(EntitySchema):
         optional=True,
         default=None,
     )
+    virtual_size: int | None = Field(
+        description="Size of the disk as seen by the guest in bytes, if the disk file exists",
+        examples=[2147483648],
+        default=None,
+    )
+    allocated_size: int | None = Field(
+        description="Bytes the disk file actually occupies on the local filesystem",
+        examples=[196608],
+        default=None,
+    )
+    chain_depth: int | None = Field(
+        description="Number of backing files the disk is layered on",
+        examples=[0, 1],
+        default=None,
+    )
+    parent_uid: UniqueIdentifier | None = Field(
+        description="The uid of the disk this snapshot overlay or clone is layered on",
+        default=None,
+    )
 
 
 class DiskListSchema(EntitySchema):
@@ -125,6 +154,59 @@ class DiskModifySchema(EntitySchema):
     )
 
 
+class DiskSnapshotSchema(EntitySchema):
+    """
+    Schema to snapshot a disk
+    """
+
+    name: str = Field(description="Snapshot name", examples=["golden", "before-upgrade"])
+    path: pathlib.Path | None = Field(
+        description="Path to move the frozen disk file to, required for external snapshots",
+        examples=["/var/kaso/instances/golden.qcow2"],
+        default=None,
+    )
+    kind: SnapshotKind = Field(
+        description="External snapshots freeze the disk file as a disk of its own, internal "
+        "snapshots are kept within the QCoW2 file",
+        examples=[SnapshotKind.EXTERNAL, SnapshotKind.INTERNAL],
+        default=SnapshotKind.EXTERNAL,
+    )
+
+
+class DiskCloneSchema(EntitySchema):
+    """
+    Schema to clone a disk
+    """
+
+    name: str = Field(description="Name of the clone", examples=["worker-1"])
+    path: pathlib.Path = Field(
+        description="Path of the clone on the local filesystem",
+        examples=["/var/kaso/instances/worker-1.qcow2"],
+    )
+
+
+class DiskRebaseSchema(EntitySchema):
+    """
+    Schema to rebase a disk onto another disk
+    """
+
+    backing_uid: UniqueIdentifier | None = Field(
+        description="The uid of the disk to layer this disk on, or none to flatten it",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093", None],
+        default=None,
+    )
+
+
+class DiskBatchCreateSchema(EntitySchema):
+    """
+    Schema to create many disks at once
+    """
+
+    entries: typing.List[DiskCreateSchema] = Field(
+        description="The disks to create", min_length=1, max_length=1000
+    )
+
+
 class DiskModel(EntityModel):
     """
     Representation of a disk entity in the database
@@ -139,6 +221,9 @@ class DiskModel(EntityModel):
     image_uid: Mapped[str] = mapped_column(
         UUID(as_uuid=True).with_variant(String(32), "sqlite"), nullable=True
     )
+    parent_uid: Mapped[str | None] = mapped_column(
+        UUID(as_uuid=True).with_variant(String(32), "sqlite"), nullable=True
+    )
 
 
 class DiskEntity(Entity, AggregateRoot):
@@ -153,6 +238,7 @@ class DiskEntity(Entity, AggregateRoot):
         size: BinarySizedValue = BinarySizedValue(2, BinaryScale.G),
         disk_format: DiskFormat = DiskFormat.Raw,
         image: ImageEntity | None = None,
+        parent_uid: UniqueIdentifier | None = None,
     ) -> None:
         super().__init__()
         self._name = name
@@ -160,6 +246,8 @@ class DiskEntity(Entity, AggregateRoot):
         self._size = size
         self._disk_format = disk_format
         self._image = image
+        self._parent_uid = parent_uid
+        self._chain: typing.List[qcow2.ImageInfo] | None = None
 
     @property
     def name(self) -> str:
@@ -181,6 +269,34 @@ class DiskEntity(Entity, AggregateRoot):
     def image(self) -> ImageEntity:
         return self._image
 
+    @property
+    def parent_uid(self) -> UniqueIdentifier | None:
+        return self._parent_uid
+
+    @property
+    def chain(self) -> typing.List[qcow2.ImageInfo]:
+        """
+        Metadata of the disk file followed by its backing files, read once per entity
+        """
+        if self._chain is None:
+            try:
+                self._chain = qcow2.backing_chain(self.path)
+            except (OSError, ValueError, struct.error):
+                self._chain = []
+        return self._chain
+
+    @property
+    def virtual_size(self) -> int | None:
+        return self.chain[0].virtual_size if self.chain else None
+
+    @property
+    def allocated_size(self) -> int | None:
+        return self.chain[0].allocated_size if self.chain else None
+
+    @property
+    def chain_depth(self) -> int | None:
+        return len(self.chain) - 1 if self.chain else None
+
     @staticmethod
     async def from_model(model: DiskModel) -> "DiskEntity":
         entity = DiskEntity(
@@ -188,6 +304,7 @@ class DiskEntity(Entity, AggregateRoot):
             path=pathlib.Path(model.path),
             size=BinarySizedValue(model.size, model.size_scale),
             disk_format=model.disk_format,
+            parent_uid=UniqueIdentifier(model.parent_uid) if model.parent_uid else None,
         )
         entity._uid = UniqueIdentifier(model.uid)
         if model.image_uid is not None:
@@ -204,6 +321,7 @@ class DiskEntity(Entity, AggregateRoot):
                 size_scale=self.size.scale,
                 disk_format=self.disk_format,
                 image_uid=str(self.image.uid) if self.image is not None else None,
+                parent_uid=str(self.parent_uid) if self.parent_uid is not None else None,
             )
         else:
             model.uid = str(self.uid)
@@ -212,8 +330,8 @@ class DiskEntity(Entity, AggregateRoot):
             model.size = self.size.value
             model.size_scale = self.size.scale
             model.disk_format = self.disk_format
-            if self.image is not None:
-                model.image_uid = str(self.image.uid)
+            model.image_uid = str(self.image.uid) if self.image is not None else None
+            model.parent_uid = str(self.parent_uid) if self.parent_uid is not None else None
             return model
 
     def __eq__(self, other: "DiskEntity") -> bool:  # type: ignore[override]
@@ -238,6 +356,68 @@ class DiskEntity(Entity, AggregateRoot):
             f"image={self.image})"
         )
 
+    @staticmethod
+    def qemu_img() -> str:
+        return str(DiskEntity.runtime.config.qemu_img_path)
+
+    @staticmethod
+    def create_args(
+        path: pathlib.Path,
+        size: BinarySizedValue,
+        disk_format: DiskFormat,
+        image: ImageEntity | None = None,
+    ) -> typing.List[str]:
+        """
+        Assemble the qemu-img invocation creating a disk file, backed by an image if provided
+        """
+        args = [DiskEntity.qemu_img(), "create", "-f", str(disk_format)]
+        if image is not None:
+            args.extend(["-F", str(disk_format), "-b", str(image.path)])
+        args.extend([str(path), str(size)])
+        return args
+
+    @staticmethod
+    async def create_file(
+        path: pathlib.Path,
+        size: BinarySizedValue,
+        disk_format: DiskFormat,
+        image: ImageEntity | None = None,
+    ):
+        """
+        Create an empty disk file, layered on an image if provided. Raw and QCoW2 files are
+        written directly as sparse files, only other formats are left to qemu-img.
+        Args:
+            path: The path of the disk file, which must not exist
+            size: The size of the disk
+            disk_format: The format of the disk file
+            image: Optional image the disk file is layered on
+        """
+        virtual_size = size.at_scale(BinaryScale.b).value
+        if disk_format == DiskFormat.QCoW2:
+            backing_file, backing_format = None, None
+            if image is not None:
+                backing_file, backing_format = str(image.path), qcow2.inspect(image.path).format
+            qcow2.create(path, virtual_size, backing_file, backing_format)
+        elif disk_format == DiskFormat.Raw and image is None:
+            with open(path, "xb") as f:
+                f.truncate(virtual_size)
+        else:
+            await DiskEntity.runtime.process_service.run(
+                DiskEntity.create_args(path, size, disk_format, image)
+            )
+
+    @staticmethod
+    async def _create_file(
+        path: pathlib.Path,
+        size: BinarySizedValue,
+        disk_format: DiskFormat,
+        image: ImageEntity | None = None,
+    ):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pool = DiskEntity.runtime.disk_pool_service
+        if image is None or not await pool.claim(image, size, disk_format, path):
+            await DiskEntity.create_file(path, size, disk_format, image)
+
     @staticmethod
     async def create(
         name: str,
@@ -250,55 +430,390 @@ class DiskEntity(Entity, AggregateRoot):
             raise DiskException(status=400, msg=f"Disk at {path} already exists")
         if image is not None and size < image.min_disk:
             raise DiskException(status=400, msg=f"Disk size is less than image minimum size")
+        capacity = DiskEntity.runtime.capacity_service
+        async with capacity.reserve(capacity.size_in_bytes(size)):
+            try:
+                await DiskEntity._create_file(path, size, disk_format, image)
+                disk = DiskEntity(
+                    name=name, path=path, size=size, disk_format=disk_format, image=image
+                )
+                return await DiskEntity.repository.create(disk)
+            except EntityNotFoundException as e:
+                path.unlink(missing_ok=True)
+                raise DiskException(status=400, msg=f"The provided image does not exist") from e
+            except KasoMashinException as e:
+                path.unlink(missing_ok=True)
+                raise DiskException(status=500, msg=f"Failed to create disk: {e.msg}") from e
+            except PermissionError as e:
+                path.unlink(missing_ok=True)
+                raise DiskException(
+                    status=400,
+                    msg=f"You have no permission to create a disk at path {path}",
+                ) from e
+            except Exception as e:
+                path.unlink(missing_ok=True)
+                raise DiskException(
+                    status=500,
+                    msg=f"An unknown error occurred: {e}",
+                ) from e
+
+    @staticmethod
+    async def create_many(
+        task: TaskEntity, disks: typing.List[DiskCreateSchema]
+    ) -> typing.List["DiskEntity"]:
+        """
+        Create many disks at once. The disk files are created concurrently, bounded by the
+        concurrency of the process service, and all disks are recorded in a single transaction.
+        Either all disks are created or none.
+        Args:
+            task: The task to report aggregate progress to
+            disks: The disks to create
+
+        Returns:
+            The created disks
+        """
+        entities: typing.List[DiskEntity] = []
+        completed = 0
+
+        async def create_file(entity: DiskEntity):
+            nonlocal completed
+            await DiskEntity._create_file(
+                entity.path, entity.size, entity.disk_format, entity.image
+            )
+            completed += 1
+            percent = completed * 99 // len(entities)
+            if percent != task.percent_complete:
+                await task.progress(
+                    percent_complete=percent, msg=f"Created {completed} of {len(entities)} disks"
+                )
+
         try:
-            path.parent.mkdir(parents=True, exist_ok=True)
-            args = ["/opt/homebrew/bin/qemu-img", "create", "-f", str(disk_format)]
-            if image is not None:
-                args.extend(["-F", str(disk_format), "-b", str(image.path)])
-            args.extend([str(path), str(size)])
-            subprocess.run(args, check=True)
-            disk = DiskEntity(name=name, path=path, size=size, disk_format=disk_format, image=image)
-            return await DiskEntity.repository.create(disk)
-        except subprocess.CalledProcessError as e:
-            path.unlink(missing_ok=True)
-            raise DiskException(status=500, msg=f"Failed to create disk: {e.output}") from e
-        except EntityNotFoundException as e:
-            path.unlink(missing_ok=True)
-            raise DiskException(status=400, msg=f"The provided image does not exist") from e
-        except PermissionError as e:
-            path.unlink(missing_ok=True)
-            raise DiskException(
-                status=400,
-                msg=f"You have no permission to create a disk at path {path}",
-            ) from e
+            paths = [pathlib.Path(disk.path) for disk in disks]
+            if len(set(paths)) != len(paths):
+                raise DiskException(status=400, msg="The paths of the disks must be unique")
+            images: typing.Dict[UniqueIdentifier | None, ImageEntity] = {}
+            for disk, path in zip(disks, paths):
+                if path.exists():
+                    raise DiskException(status=400, msg=f"Disk at {path} already exists")
+                if disk.image_uid is not None and disk.image_uid not in images:
+                    try:
+                        images[disk.image_uid] = await ImageEntity.repository.get_by_uid(
+                            disk.image_uid
+                        )
+                    except EntityNotFoundException as e:
+                        raise DiskException(
+                            status=400, msg=f"The image {disk.image_uid} does not exist"
+                        ) from e
+                image = images.get(disk.image_uid)
+                if image is not None and disk.size < image.min_disk:
+                    raise DiskException(
+                        status=400, msg=f"Disk size of {disk.name} is less than image minimum size"
+                    )
+            candidates = [
+                DiskEntity(
+                    name=disk.name,
+                    path=path,
+                    size=disk.size,
+                    disk_format=disk.disk_format,
+                    image=images.get(disk.image_uid),
+                )
+                for disk, path in zip(disks, paths)
+            ]
+        except DiskException as e:
+            await task.fail(msg=f"Failed to create disks: {e.msg}")
+            raise
+        capacity = DiskEntity.runtime.capacity_service
+        try:
+            reservation = sum(capacity.size_in_bytes(entity.size) for entity in candidates)
+            async with capacity.reserve(reservation):
+                entities = candidates
+                results = await asyncio.gather(
+                    *[create_file(entity) for entity in entities], return_exceptions=True
+                )
+                failures = [result for result in results if isinstance(result, BaseException)]
+                if failures:
+                    raise failures[0]
+                await DiskEntity.repository.create_many(entities)
+            await task.done(msg=f"Created {len(entities)} disks")
+            return entities
         except Exception as e:
+            for entity in entities:
+                entity.path.unlink(missing_ok=True)
+            status, msg = (e.status, e.msg) if isinstance(e, KasoMashinException) else (500, str(e))
+            await task.fail(msg=f"Failed to create disks: {msg}")
+            raise DiskException(status=status, msg=f"Failed to create disks: {msg}") from e
+
+    async def resize(self, value: BinarySizedValue) -> "DiskEntity":
+        capacity = DiskEntity.runtime.capacity_service
+        growth = capacity.size_in_bytes(value) - capacity.size_in_bytes(self.size)
+        async with capacity.reserve(growth) if growth > 0 else contextlib.nullcontext():
+            try:
+                args = [DiskEntity.qemu_img(), "resize"]
+                if self.size > value:
+                    args.append("--shrink")
+                args += ["-f", str(self.disk_format), str(self._path), str(value)]
+                await DiskEntity.runtime.process_service.run(args)
+                self._size = value
+                self._chain = None
+                capacity.forget(self.path)
+                await DiskEntity.repository.modify(self)
+            except KasoMashinException as e:
+                raise DiskException(status=500, msg=f"Failed to resize disk: {e.msg}") from e
+        if growth < 0:
+            await capacity.release()
+        return self
+
+    async def _run_with_progress(self, task: TaskEntity, args: typing.List[str], verb: str):
+        reported = -1
+
+        async def on_output(line: str):
+            nonlocal reported
+            match = re.search(r"\((\d+(?:\.\d+)?)/100%\)", line)
+            if match is None or int(float(match.group(1))) == reported:
+                return
+            reported = int(float(match.group(1)))
+            await task.progress(percent_complete=min(reported, 99), msg=f"{verb} {reported}%")
+
+        # Copying the data of a backing chain may take longer than any sensible default timeout
+        await DiskEntity.runtime.process_service.run(args, timeout=0, on_output=on_output)
+
+    async def check_unused(self):
+        """
+        Make sure no instance runs off the disk, whose QEMU process would otherwise keep writing
+        to the disk file while it is moved or changed underneath it
+        Raises:
+            DiskException if an instance that is not stopped uses the disk
+        """
+        instances = await DiskEntity.runtime.instance_repository.list_using_disk(self.uid)
+        if instances:
+            raise DiskException(
+                status=409,
+                msg=f"Disk {self.name} is in use by instances "
+                f"{', '.join(instance.name for instance in instances)}",
+            )
+
+    async def snapshot(
+        self,
+        task: TaskEntity,
+        name: str,
+        path: pathlib.Path | None = None,
+        kind: SnapshotKind = SnapshotKind.EXTERNAL,
+    ) -> "DiskEntity":
+        """
+        Snapshot the disk. An external snapshot moves the current disk file to the provided path,
+        where it becomes a read-only disk of its own, and continues this disk as a QCoW2 overlay
+        on top of it at the original path. An internal snapshot is kept within the QCoW2 file.
+        The disk must not be in use by an instance that is not stopped.
+        Args:
+            task: The task to report to
+            name: The name of the snapshot
+            path: The path to move the frozen disk file to, required for external snapshots
+            kind: The kind of snapshot
+
+        Returns:
+            The snapshot disk for external snapshots, this disk for internal snapshots
+        """
+        try:
+            await self.check_unused()
+            if kind == SnapshotKind.INTERNAL:
+                if self.disk_format != DiskFormat.QCoW2:
+                    raise DiskException(
+                        status=400, msg="Internal snapshots require a disk in QCoW2 format"
+                    )
+                await DiskEntity.runtime.process_service.run(
+                    [DiskEntity.qemu_img(), "snapshot", "-c", name, str(self.path)]
+                )
+                await task.done(msg=f"Created internal snapshot {name}", outcome=self.uid)
+                return self
+            if path is None or path.exists():
+                raise DiskException(status=400, msg="A new path is required for the snapshot")
+            capacity = DiskEntity.runtime.capacity_service
+            async with capacity.reserve(capacity.size_in_bytes(self.size)):
+                os.rename(self.path, path)
+                try:
+                    qcow2.create(
+                        self.path,
+                        capacity.size_in_bytes(self.size),
+                        backing_file=str(path),
+                        backing_format=str(self.disk_format),
+                    )
+                except OSError:
+                    os.rename(path, self.path)
+                    raise
+                capacity.forget(self.path)
+                snapshot = await DiskEntity.repository.create(
+                    DiskEntity(
+                        name=name,
+                        path=path,
+                        size=self.size,
+                        disk_format=self.disk_format,
+                        image=self.image,
+                        parent_uid=self.parent_uid,
+                    )
+                )
+            self._disk_format = DiskFormat.QCoW2
+            self._parent_uid = snapshot.uid
+            self._chain = None
+            await DiskEntity.repository.modify(self)
+            await task.done(msg=f"Created snapshot {name}", outcome=snapshot.uid)
+            return snapshot
+        except (KasoMashinException, OSError) as e:
+            status, msg = (e.status, e.msg) if isinstance(e, KasoMashinException) else (500, str(e))
+            await task.fail(msg=f"Failed to snapshot disk: {msg}")
+            raise DiskException(status=status, msg=f"Failed to snapshot disk: {msg}") from e
+
+    async def clone(self, task: TaskEntity, name: str, path: pathlib.Path) -> "DiskEntity":
+        """
+        Clone the disk as a thin QCoW2 overlay on top of it. The disk being cloned must no longer
+        change, which is why clones are typically made from a snapshot.
+        Args:
+            task: The task to report to
+            name: The name of the clone
+            path: The path of the clone
+
+        Returns:
+            The clone
+        """
+        if path.exists():
+            await task.fail(msg=f"Disk at {path} already exists")
+            raise DiskException(status=400, msg=f"Disk at {path} already exists")
+        capacity = DiskEntity.runtime.capacity_service
+        try:
+            async with capacity.reserve(capacity.size_in_bytes(self.size)):
+                path.parent.mkdir(parents=True, exist_ok=True)
+                qcow2.create(
+                    path,
+                    capacity.size_in_bytes(self.size),
+                    backing_file=str(self.path),
+                    backing_format=str(self.disk_format),
+                )
+                clone = await DiskEntity.repository.create(
+                    DiskEntity(
+                        name=name,
+                        path=path,
+                        size=self.size,
+                        disk_format=DiskFormat.QCoW2,
+                        image=self.image,
+                        parent_uid=self.uid,
+                    )
+                )
+            await task.done(msg=f"Created clone {name}", outcome=clone.uid)
+            return clone
+        except (KasoMashinException, OSError) as e:
             path.unlink(missing_ok=True)
+            status, msg = (e.status, e.msg) if isinstance(e, KasoMashinException) else (500, str(e))
+            await task.fail(msg=f"Failed to clone disk: {msg}")
+            raise DiskException(status=status, msg=f"Failed to clone disk: {msg}") from e
+
+    async def descends_from(self, uid: UniqueIdentifier) -> bool:
+        """
+        Whether the disk is layered on the disk with the given uid, directly or further down
+        its backing chain
+        """
+        seen = set()
+        parent_uid = self.parent_uid
+        while parent_uid is not None and parent_uid not in seen:
+            if parent_uid == uid:
+                return True
+            seen.add(parent_uid)
+            try:
+                parent: DiskEntity = await DiskEntity.repository.get_by_uid(parent_uid)
+            except EntityNotFoundException:
+                return False
+            parent_uid = parent.parent_uid
+        return False
+
+    async def check_backing(self, backing: "DiskEntity"):
+        """
+        Make sure this disk may be layered on a backing disk without creating a cycle
+        Args:
+            backing: The disk to layer this disk on
+
+        Raises:
+            DiskException if the backing disk is this disk or layered on it
+        """
+        if backing.uid == self.uid or await backing.descends_from(self.uid):
             raise DiskException(
-                status=500,
-                msg=f"An unknown error occurred: {e}",
-            ) from e
+                status=400,
+                msg=f"Disk {self.name} cannot be layered on disk {backing.name}, which is the "
+                "disk itself or layered on it",
+            )
 
-    async def resize(self, value: BinarySizedValue) -> "DiskEntity":
+    async def rebase(self, task: TaskEntity, backing: "DiskEntity | None" = None) -> "DiskEntity":
+        """
+        Layer the disk on top of another disk, or flatten it into a standalone disk if no backing
+        disk is provided. The data that differs between the old and new backing chain is copied
+        into the disk, so the guest sees the same content afterwards.
+        Args:
+            task: The task to report to
+            backing: The disk to layer this disk on, or None to flatten it
+
+        Returns:
+            This disk
+        """
         try:
-            args = ["/opt/homebrew/bin/qemu-img", "resize"]
-            if self.size > value:
-                args.append("--shrink")
-            args += ["-f", str(self.disk_format), str(self._path), str(value)]
-            subprocess.run(args, check=True)
-            self._size = value
+            if self.disk_format != DiskFormat.QCoW2:
+                raise DiskException(status=400, msg="Only disks in QCoW2 format can be rebased")
+            if backing is not None:
+                await self.check_backing(backing)
+            args = [DiskEntity.qemu_img(), "rebase", "-p", "-f", str(self.disk_format)]
+            if backing is None:
+                args.extend(["-b", ""])
+            else:
+                args.extend(["-F", str(backing.disk_format), "-b", str(backing.path)])
+            await self._run_with_progress(
+                task, args + [str(self.path)], "Flattened" if backing is None else "Rebased"
+            )
+            self._image = backing.image if backing is not None else None
+            self._parent_uid = backing.uid if backing is not None else None
+            self._chain = None
             await DiskEntity.repository.modify(self)
+            await task.done(
+                msg="Flattened disk" if backing is None else f"Rebased disk onto {backing.name}",
+                outcome=self.uid,
+            )
             return self
-        except subprocess.CalledProcessError as e:
-            raise DiskException(status=500, msg=f"Failed to resize disk: {e.output}") from e
+        except KasoMashinException as e:
+            await task.fail(msg=f"Failed to rebase disk: {e.msg}")
+            raise DiskException(status=e.status, msg=f"Failed to rebase disk: {e.msg}") from e
+
+    async def flatten(self, task: TaskEntity) -> "DiskEntity":
+        """
+        Copy all data of the backing chain into the disk so it no longer depends on it
+        Args:
+            task: The task to report to
+
+        Returns:
+            This disk
+        """
+        return await self.rebase(task=task, backing=None)
 
     async def modify(self, schema: DiskModifySchema) -> "DiskEntity":
         if schema.size is not None:
             return await self.resize(schema.size)
 
     async def remove(self):
+        children = await DiskEntity.repository.list_by_parent(self.uid)
+        if children:
+            raise DiskException(
+                status=409,
+                msg=f"Disk {self.name} is the backing file of disks "
+                f"{', '.join(child.name for child in children)}",
+            )
         self.path.unlink(missing_ok=True)
         await DiskEntity.repository.remove(self.uid)
+        DiskEntity.runtime.capacity_service.forget(self.path)
+        await DiskEntity.runtime.capacity_service.release()
 
 
 class DiskRepository(AsyncRepository[DiskEntity, DiskModel]):
-    pass
+
+    async def list_by_parent(self, parent_uid: UniqueIdentifier) -> typing.List[DiskEntity]:
+        """
+        The snapshot overlays and clones layered directly on a disk
+        """
+        async with self._session_maker() as session:
+            models = await session.scalars(
+                select(self._model_class).where(self._model_class.parent_uid == str(parent_uid))
+            )
+            return [await self._aggregate_root_class.from_model(m) for m in models]
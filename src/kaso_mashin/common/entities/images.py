@@ -1,14 +1,13 @@
 import typing
 import pathlib
 import shutil
+import datetime
 
-import aiofiles
-import httpx
 from pydantic import Field
 import rich.table
 import rich.box
 
-from sqlalchemy import String, Integer, Enum
+from sqlalchemy import String, Integer, Enum, select
 from sqlalchemy.orm import Mapped, mapped_column
 
 from kaso_mashin import KasoMashinException
@@ -77,6 +76,12 @@ class ImageGetSchema(ImageCreateSchema):
         examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
     )
     path: pathlib.Path = Field(description="Path to the image on the local disk")
+    etag: typing.Optional[str] = Field(
+        description="The entity tag the image was downloaded with", default=None
+    )
+    last_modified: typing.Optional[str] = Field(
+        description="The Last-Modified header the image was downloaded with", default=None
+    )
 
     def __rich__(self):
         table = rich.table.Table(box=rich.box.ROUNDED)
@@ -146,6 +151,8 @@ class ImageModel(EntityModel):
     min_ram_scale: Mapped[str] = mapped_column(Enum(BinaryScale), default=BinaryScale.G)
     min_disk: Mapped[int] = mapped_column(Integer, default=0)
     min_disk_scale: Mapped[str] = mapped_column(Enum(BinaryScale), default=BinaryScale.G)
+    etag: Mapped[str | None] = mapped_column(String(), nullable=True)
+    last_modified: Mapped[str | None] = mapped_column(String(), nullable=True)
 
 
 class ImageEntity(Entity, AggregateRoot):
@@ -161,6 +168,8 @@ class ImageEntity(Entity, AggregateRoot):
         min_vcpu: int = 0,
         min_ram: BinarySizedValue = BinarySizedValue(0, BinaryScale.G),
         min_disk: BinarySizedValue = BinarySizedValue(0, BinaryScale.G),
+        etag: str | None = None,
+        last_modified: str | None = None,
     ):
         super().__init__()
         self._name = name
@@ -169,6 +178,8 @@ class ImageEntity(Entity, AggregateRoot):
         self._min_vcpu = min_vcpu
         self._min_ram = min_ram
         self._min_disk = min_disk
+        self._etag = etag
+        self._last_modified = last_modified
 
     @property
     def name(self) -> str:
@@ -194,6 +205,14 @@ class ImageEntity(Entity, AggregateRoot):
     def min_disk(self) -> BinarySizedValue:
         return self._min_disk
 
+    @property
+    def etag(self) -> str | None:
+        return self._etag
+
+    @property
+    def last_modified(self) -> str | None:
+        return self._last_modified
+
     def __eq__(self, other: object) -> bool:
         return all(
             [
@@ -229,6 +248,8 @@ class ImageEntity(Entity, AggregateRoot):
             min_disk=BinarySizedValue(
                 value=model.min_disk, scale=BinaryScale(model.min_disk_scale)
             ),
+            etag=model.etag,
+            last_modified=model.last_modified,
         )
         entity._uid = UniqueIdentifier(model.uid)
         return entity
@@ -245,6 +266,8 @@ class ImageEntity(Entity, AggregateRoot):
                 min_ram_scale=self.min_ram.scale,
                 min_disk=self.min_disk.value,
                 min_disk_scale=self.min_disk.scale,
+                etag=self.etag,
+                last_modified=self.last_modified,
             )
         else:
             model.uid = str(self.uid)
@@ -256,8 +279,24 @@ class ImageEntity(Entity, AggregateRoot):
             model.min_ram_scale = self.min_ram.scale
             model.min_disk = self.min_disk.value
             model.min_disk_scale = self.min_disk.scale
+            model.etag = self.etag
+            model.last_modified = self.last_modified
             return model
 
+    @staticmethod
+    def path_for(images_path: pathlib.Path, name: str) -> pathlib.Path:
+        """
+        Calculate a unique path for a new download of an image
+        Args:
+            images_path: The directory in which images are stored
+            name: The image name
+
+        Returns:
+            The path to store the image at
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+        return images_path / f"{name}-{now}.qcow2"
+
     @staticmethod
     async def create(
         task: TaskEntity,
@@ -268,25 +307,53 @@ class ImageEntity(Entity, AggregateRoot):
         min_vcpu: int = DEFAULT_MIN_VCPU,
         min_ram: BinarySizedValue = DEFAULT_MIN_RAM,
         min_disk: BinarySizedValue = DEFAULT_MIN_DISK,
+        rate_limit: int = 0,
+        low_priority: bool = False,
+        mirrors: typing.List[str] | None = None,
     ) -> "ImageEntity":
+        """
+        Download an image, preferring peer servers that already have it over its origin URL
+        Args:
+            task: The task to report progress to
+            user: The user owning the downloaded image
+            name: The name of the image
+            url: The origin URL of the image
+            path: The path to store the image at
+            min_vcpu: Minimum number of vCPUs to run the image
+            min_ram: Minimum RAM to run the image
+            min_disk: Minimum disk size to run the image
+            rate_limit: An optional limit of bytes per second for the download, 0 for no limit
+            low_priority: Whether the download yields its bandwidth to all other downloads
+            mirrors: Base URLs of peer servers to try first, defaults to the configured image peers
+
+        Returns:
+            The created image
+        """
         if path.exists():
             raise ImageException(status=400, msg=f"Disk at {path} already exists")
         path.parent.mkdir(parents=True, exist_ok=True)
+        if mirrors is None:
+            mirrors = ImageEntity.runtime.config.image_peers
+        download_service = ImageEntity.runtime.download_service
         try:
-            resp = httpx.head(url, follow_redirects=True, timeout=60)
-            size = int(resp.headers.get("content-length"))
-            current = 0
-            client = httpx.AsyncClient(follow_redirects=True, timeout=60)
-            chunk_size = 32784  # 8196
-            async with (
-                client.stream("GET", url=url) as resp,
-                aiofiles.open(path, mode="wb") as file,
-            ):
-                async for chunk in resp.aiter_bytes(chunk_size=chunk_size):
-                    await file.write(chunk)
-                    current += chunk_size
-                    completed = int(current / size * 100)
-                    await task.progress(percent_complete=completed, msg=f"Downloaded {completed}%")
+            result = await download_service.download_from_peers(
+                url=url,
+                peers=mirrors,
+                path=path,
+                task=task,
+                convert_to_qcow2=ImageEntity.runtime.config.convert_raw_images,
+                rate_limit=rate_limit,
+                low_priority=low_priority,
+            )
+            if result is None:
+                result = await download_service.download(
+                    url=url,
+                    path=path,
+                    task=task,
+                    convert_to_qcow2=ImageEntity.runtime.config.convert_raw_images,
+                    rate_limit=rate_limit,
+                    low_priority=low_priority,
+                )
             shutil.chown(path, user)
             image = ImageEntity(
                 name=name,
@@ -295,6 +362,8 @@ class ImageEntity(Entity, AggregateRoot):
                 min_vcpu=min_vcpu,
                 min_ram=min_ram,
                 min_disk=min_disk,
+                etag=result.etag,
+                last_modified=result.last_modified,
             )
             outcome = await ImageEntity.repository.create(image)
             await task.done(msg="Successfully downloaded", outcome=outcome.uid)
@@ -309,6 +378,54 @@ class ImageEntity(Entity, AggregateRoot):
             await task.fail(msg=f"Exception occurred while downloading {e}")
             raise ImageException(status=500, msg=f"Exception occurred while downloading {e}")
 
+    async def refresh(
+        self,
+        task: TaskEntity,
+        user: str,
+        path: pathlib.Path,
+        rate_limit: int = 0,
+        low_priority: bool = False,
+    ) -> bool:
+        """
+        Conditionally download the image again if it was modified at its source. A modified image is
+        stored at a new path because existing disks may still use the current path as their backing file.
+        Args:
+            task: The task to report progress to
+            user: The user owning the downloaded image
+            path: The path to store a modified image at
+            rate_limit: An optional limit of bytes per second, 0 for no limit
+            low_priority: Whether the download yields its bandwidth to all other downloads
+
+        Returns:
+            True if the image was modified
+        """
+        try:
+            result = await self.runtime.download_service.download(
+                url=self.url,
+                path=path,
+                task=task,
+                convert_to_qcow2=self.runtime.config.convert_raw_images,
+                etag=self.etag,
+                last_modified=self.last_modified,
+                rate_limit=rate_limit,
+                low_priority=low_priority,
+            )
+            if result.not_modified:
+                await task.done(msg="Image is up to date", outcome=self.uid)
+                return False
+            shutil.chown(path, user)
+            self._path = path
+            self._etag = result.etag
+            self._last_modified = result.last_modified
+            await self.repository.modify(self)
+            await task.done(msg="Successfully refreshed", outcome=self.uid)
+            return True
+        except Exception as e:
+            await task.fail(msg=f"Exception occurred while refreshing {e}")
+            raise ImageException(
+                status=500, msg=f"Exception occurred while refreshing {e}"
+            ) from e
+
     async def modify(self, schema: ImageModifySchema):
         if schema.name is not None:
             self._name = schema.name
@@ -329,4 +446,12 @@ class ImageEntity(Entity, AggregateRoot):
 
 
 class ImageRepository(AsyncRepository[ImageEntity, ImageModel]):
-    pass
\ No newline at end of file
+
+    async def get_by_url(self, url: str) -> ImageEntity | None:
+        async with self._session_maker() as session:
+            model = await session.scalar(
+                select(self._model_class).where(self._model_class.url == url)
+            )
+            if model is None:
+                return None
+            return await self._aggregate_root_class.from_model(model)
\ No newline at end of file
@@ -1,12 +1,18 @@
+import asyncio
+import contextlib
+import datetime
+import logging
 import typing
 import enum
 import re
 import pathlib
 import shutil
 
-from pydantic import Field
+from pydantic import Field, field_validator
 
-from sqlalchemy import String, Integer, Enum, UUID
+from sqlalchemy import String, Integer, Enum, UUID, DateTime, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from sqlalchemy.orm import Mapped, mapped_column
 
 import rich.table
@@ -15,6 +21,7 @@ import rich.box
 from kaso_mashin import KasoMashinException
 from kaso_mashin.common import (
     UniqueIdentifier,
+    EntityNotFoundException,
     EntitySchema,
     EntityModel,
     Entity,
@@ -23,6 +30,7 @@ from kaso_mashin.common import (
     BinarySizedValue,
     BinaryScale,
 )
+from kaso_mashin.common.files import clone_file
 
 from kaso_mashin.common.entities import (
     TaskEntity,
@@ -42,6 +50,12 @@ class InstanceState(str, enum.Enum):
     STOPPED = "STOPPED"
     STARTING = "STARTING"
     STARTED = "STARTED"
+    PAUSED = "PAUSED"
+
+
+class InstanceAction(str, enum.Enum):
+    START = "start"
+    STOP = "stop"
 
 
 MAC_VENDOR_PREFIX = "00:50:56"
@@ -81,6 +95,56 @@ class InstanceCreateSchema(EntitySchema):
     )
 
 
+class InstanceFleetCreateSchema(EntitySchema):
+    """
+    Schema to create many instances from the same template
+    """
+
+    count: int = Field(description="Number of instances to create", examples=[3], ge=1, le=1000)
+    name_pattern: str = Field(
+        description="Pattern of the instance names, {index} is replaced by the index of the node",
+        examples=["k8s-node-{index}"],
+    )
+    vcpu: int = Field(description="Number of virtual CPU cores", examples=[2])
+    ram: BinarySizedValue = Field(
+        description="Amount of RAM",
+        examples=[BinarySizedValue(value=2, scale=BinaryScale.G)],
+    )
+    os_disk_size: BinarySizedValue = Field(description="Size of the OS disk")
+    image_uid: str = Field(
+        description="The image UID from which to create the OS disks from",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    network_uid: str = Field(
+        description="The network on which to run the instances",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    bootstrap_uid: str = Field(
+        description="The bootstrap uid",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    variables: typing.List[typing.Dict[str, typing.Any]] = Field(
+        description="Additional bootstrap variables of each node, by index",
+        examples=[[{"role": "master"}, {"role": "worker"}, {"role": "worker"}]],
+        default_factory=list,
+    )
+
+    @field_validator("name_pattern")
+    @classmethod
+    def check_name_pattern(cls, name_pattern: str) -> str:
+        # Names become directories below the instances path, so they must not escape it
+        try:
+            name = name_pattern.format(index=0)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"The name pattern may only refer to {{index}}: {e}") from e
+        if not name or "/" in name_pattern or ".." in name_pattern or name in (".", ".."):
+            raise ValueError("The name pattern must produce a name without path separators")
+        return name_pattern
+
+    def names(self) -> typing.List[str]:
+        return [self.name_pattern.format(index=index) for index in range(self.count)]
+
+
 class InstanceGetSchema(EntitySchema):
     """
     Schema to get information about a specific instance
@@ -112,6 +176,36 @@ class InstanceGetSchema(EntitySchema):
         description="The instance state",
         examples=[InstanceState.STOPPED, InstanceState.STARTED],
     )
+    pid: int | None = Field(
+        description="The process id of the instance, none while it is not running",
+        examples=[4711],
+        default=None,
+    )
+    started: datetime.datetime | None = Field(
+        description="When the instance was last started", default=None
+    )
+    state_changed: datetime.datetime | None = Field(
+        description="When the state of the instance last changed", default=None
+    )
+    ready: datetime.datetime | None = Field(
+        description="When the guest phoned home after it was last started, none if it has not",
+        default=None,
+    )
+    boot_seconds: float | None = Field(
+        description="Seconds from starting the instance until the guest phoned home",
+        examples=[21.5],
+        default=None,
+    )
+    vnc_display: int | None = Field(
+        description="The VNC display of the instance, none while it is not running",
+        examples=[0, 1],
+        default=None,
+    )
+    vnc_port: int | None = Field(
+        description="The port of the VNC display on localhost, none while it is not running",
+        examples=[5900, 5901],
+        default=None,
+    )
 
     def __rich__(self):
         table = rich.table.Table(box=rich.box.ROUNDED)
@@ -129,6 +223,12 @@ class InstanceGetSchema(EntitySchema):
         table.add_row("[blue]Bootstrap UID", str(self.bootstrap_uid))
         table.add_row("[blue]Bootstrap File", str(self.bootstrap_file))
         table.add_row("[blue]State", str(self.state))
+        table.add_row("[blue]PID", str(self.pid or ""))
+        table.add_row("[blue]Started", str(self.started or ""))
+        table.add_row("[blue]State Changed", str(self.state_changed or ""))
+        table.add_row("[blue]Ready", str(self.ready or ""))
+        table.add_row("[blue]Boot Seconds", str(self.boot_seconds or ""))
+        table.add_row("[blue]VNC Port", str(self.vnc_port or ""))
         return table
 
 
@@ -159,6 +259,42 @@ class InstanceModifySchema(EntitySchema):
     state: typing.Optional[InstanceState] = Field(description="The state of the instance")
 
 
+class InstanceActionSchema(EntitySchema):
+    """
+    Schema to start or stop many instances at once
+    """
+
+    uids: typing.List[UniqueIdentifier] = Field(
+        description="The instances to act on",
+        examples=[["b430727e-2491-4184-bb4f-c7d6d213e093"]],
+        default_factory=list,
+    )
+    state: typing.List[InstanceState] = Field(
+        description="Additionally act on all instances in any of these states",
+        examples=[[InstanceState.STOPPED]],
+        default_factory=list,
+    )
+    concurrency: int | None = Field(
+        description="Maximum number of instances to act on at the same time, defaults to the "
+        "configured concurrency",
+        examples=[4],
+        ge=1,
+        default=None,
+    )
+    stagger: float | None = Field(
+        description="Minimum seconds between acting on consecutive instances, defaults to the "
+        "configured stagger",
+        examples=[2.0],
+        ge=0,
+        default=None,
+    )
+    wait_ready: bool = Field(
+        description="Whether a started instance keeps its place in the concurrency window "
+        "until it is ready",
+        default=False,
+    )
+
+
 class InstanceModel(EntityModel):
     """
     Representation of an instance entity in the database
@@ -180,6 +316,13 @@ class InstanceModel(EntityModel):
         UUID(as_uuid=True).with_variant(String(32), "sqlite")
     )
     bootstrap_file: Mapped[str] = mapped_column(String)
+    state: Mapped[str] = mapped_column(
+        Enum(InstanceState), default=InstanceState.STOPPED, index=True
+    )
+    pid: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    started: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True)
+    state_changed: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True)
+    vnc_display: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
 
 class InstanceEntity(Entity, AggregateRoot):
@@ -214,8 +357,11 @@ class InstanceEntity(Entity, AggregateRoot):
         self._network = network
         self._bootstrap = bootstrap
         self._bootstrap_file = bootstrap_file
-        self._popen = None
         self._state = InstanceState.STOPPED
+        self._pid: int | None = None
+        self._started: datetime.datetime | None = None
+        self._state_changed: datetime.datetime | None = None
+        self._vnc_display: int | None = None
 
     @property
     def name(self) -> str:
@@ -263,7 +409,41 @@ class InstanceEntity(Entity, AggregateRoot):
 
     @property
     def state(self) -> InstanceState:
-        return self._state
+        # QEMU reports state changes of running instances, including those made in the guest
+        reported = self.runtime.qemu_service.state(self)
+        return reported if reported is not None else self._state
+
+    @property
+    def pid(self) -> int | None:
+        return self._pid
+
+    @property
+    def started(self) -> datetime.datetime | None:
+        return self._started
+
+    @property
+    def state_changed(self) -> datetime.datetime | None:
+        return self._state_changed
+
+    @property
+    def ready(self) -> datetime.datetime | None:
+        check_in = self.runtime.phone_home_service.ready(self)
+        return check_in.ready if check_in is not None else None
+
+    @property
+    def boot_seconds(self) -> float | None:
+        check_in = self.runtime.phone_home_service.ready(self)
+        return check_in.boot_seconds if check_in is not None else None
+
+    @property
+    def vnc_display(self) -> int | None:
+        allocated = self.runtime.display_service.display(self.uid)
+        return allocated if allocated is not None else self._vnc_display
+
+    @property
+    def vnc_port(self) -> int | None:
+        display = self.vnc_display
+        return self.runtime.display_service.port(display) if display is not None else None
 
     # TODO: Consider replacing this in favour of image_uid
     @property
@@ -361,6 +541,11 @@ class InstanceEntity(Entity, AggregateRoot):
         )
         entity._uid = UniqueIdentifier(model.uid)
         entity._mac = model.mac
+        entity._state = InstanceState(model.state or InstanceState.STOPPED)
+        entity._pid = model.pid
+        entity._started = model.started
+        entity._state_changed = model.state_changed
+        entity._vnc_display = model.vnc_display
         return entity
 
     async def to_model(self, model: InstanceModel | None = None) -> InstanceModel:
@@ -380,6 +565,11 @@ class InstanceEntity(Entity, AggregateRoot):
                 network_uid=str(self.network_uid),
                 bootstrap_uid=str(self.bootstrap_uid),
                 bootstrap_file=str(self.bootstrap_file),
+                state=self._state,
+                pid=self._pid,
+                started=self._started,
+                state_changed=self._state_changed,
+                vnc_display=self._vnc_display,
             )
         else:
             model.uid = str(self.uid)
@@ -395,6 +585,8 @@ class InstanceEntity(Entity, AggregateRoot):
             model.network_uid = str(self.network_uid)
             model.bootstrap_uid = str(self.bootstrap_uid)
             model.bootstrap_file = str(self.bootstrap_file)
+            # The state, pid, display and timestamps are recorded by the repository as the state
+            # changes
             return model
 
     def _generate_mac(self) -> str:
@@ -420,70 +612,387 @@ class InstanceEntity(Entity, AggregateRoot):
             raise InstanceException(
                 status=400, msg=f"Instance path at {path} already exists", task=task
             )
-        os_disk = None
         try:
-            path.mkdir(parents=True, exist_ok=True)
-            shutil.chown(path=path, user=user)
-
-            instance_uefi_code = path / "uefi_code.fd"
-            instance_uefi_code.symlink_to(uefi_code)
-            instance_uefi_vars = path / "uefi_vars.fd"
-            shutil.copyfile(uefi_vars, instance_uefi_vars)
-
-            os_disk = await DiskEntity.create(
-                name="OS Disk 0",
-                path=path / "os.qcow2",
-                size=os_disk_size,
-                disk_format=DiskFormat.QCoW2,
-                image=image,
-            )
-
-            bootstrap_file = path / "bootstrap.json"
-            await bootstrap.render(bootstrap_file=bootstrap_file, kv={"name": name})
-
-            entity = InstanceEntity(
+            InstanceEntity.check_requirements(image, vcpu, ram)
+        except InstanceException as e:
+            await task.fail(msg=e.msg)
+            raise
+        try:
+            entity = await InstanceEntity._provision(
+                user=user,
                 name=name,
                 path=path,
-                uefi_code=instance_uefi_code,
-                uefi_vars=instance_uefi_vars,
+                uefi_code=uefi_code,
+                uefi_vars=uefi_vars,
                 vcpu=vcpu,
                 ram=ram,
                 image=image,
-                os_disk=os_disk,
+                os_disk_size=os_disk_size,
                 network=network,
                 bootstrap=bootstrap,
-                bootstrap_file=bootstrap_file,
+                stage=task.stage,
             )
-
-            outcome = await InstanceEntity.repository.create(entity)
+        except Exception as e:
+            await task.fail(msg=f"Some exception {e} occurred")
+            raise InstanceException(status=400, msg=f"Some exception {e}")
+        await task.progress(percent_complete=80, msg="Created instance files")
+        try:
+            with task.stage("persist"):
+                outcome = await InstanceEntity.repository.create(entity)
             await task.done(msg="Successfully created", outcome=outcome.uid)
             return outcome
         except Exception as e:
-            if os_disk_size is not None:
-                await os_disk.remove()
+            await InstanceEntity._unprovision(entity)
             await task.fail(msg=f"Some exception {e} occurred")
-            shutil.rmtree(path)
             raise InstanceException(status=400, msg=f"Some exception {e}")
 
+    @staticmethod
+    def check_requirements(image: ImageEntity, vcpu: int, ram: BinarySizedValue):
+        """
+        Check that an instance has at least the vCPUs and RAM its image requires
+
+        Raises:
+            InstanceException if the instance has less than the image requires
+        """
+        if vcpu < image.min_vcpu:
+            raise InstanceException(
+                status=400,
+                msg=f"Image {image.name} requires at least {image.min_vcpu} vCPUs, not {vcpu}",
+            )
+        if ram.at_scale(BinaryScale.b).value < image.min_ram.at_scale(BinaryScale.b).value:
+            raise InstanceException(
+                status=400,
+                msg=f"Image {image.name} requires at least {image.min_ram} of RAM, not {ram}",
+            )
+
+    @staticmethod
+    async def _provision(
+        user: str,
+        name: str,
+        path: pathlib.Path,
+        uefi_code: pathlib.Path,
+        uefi_vars: pathlib.Path,
+        vcpu: int,
+        ram: BinarySizedValue,
+        image: ImageEntity,
+        os_disk_size: BinarySizedValue,
+        network: NetworkEntity,
+        bootstrap: BootstrapEntity,
+        kv: typing.Dict[str, typing.Any] | None = None,
+        stage: typing.Callable[[str], typing.ContextManager] = lambda _: contextlib.nullcontext(),
+    ) -> "InstanceEntity":
+        """
+        Create the files of an instance, without recording the instance. The directory, the
+        files within it and the OS disk are removed again if any of them fails to be created.
+        Args:
+            kv: Additional variables to render the bootstrap with
+            stage: Records the time spent in each stage
+
+        Returns:
+            The instance, which is yet to be recorded in the repository
+        """
+        instance_uefi_code = path / "uefi_code.fd"
+        instance_uefi_vars = path / "uefi_vars.fd"
+        bootstrap_file = path / "bootstrap.json"
+
+        async def prepare_uefi():
+            with stage("uefi"):
+                instance_uefi_code.symlink_to(uefi_code)
+                await asyncio.to_thread(clone_file, uefi_vars, instance_uefi_vars)
+
+        async def create_os_disk() -> DiskEntity:
+            with stage("os_disk"):
+                return await DiskEntity.create(
+                    name="OS Disk 0",
+                    path=path / "os.qcow2",
+                    size=os_disk_size,
+                    disk_format=DiskFormat.QCoW2,
+                    image=image,
+                )
+
+        async def render_bootstrap():
+            phone_home_url = InstanceEntity.runtime.phone_home_service.url(network.gateway)
+            with stage("bootstrap"):
+                await bootstrap.render(
+                    bootstrap_file=bootstrap_file,
+                    kv={**(kv or {}), "name": name, "phone_home_url": phone_home_url},
+                )
+
+        os_disk: DiskEntity | None = None
+        try:
+            with stage("path"):
+                path.mkdir(parents=True, exist_ok=True)
+                shutil.chown(path=path, user=user)
+
+            # The stages are independent of each other, so creation takes as long as the slowest
+            # one. All of them run to completion so a failure does not leave a half-created disk.
+            results = await asyncio.gather(
+                prepare_uefi(), create_os_disk(), render_bootstrap(), return_exceptions=True
+            )
+            if isinstance(results[1], DiskEntity):
+                os_disk = results[1]
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        except Exception:
+            if os_disk is not None:
+                await os_disk.remove()
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        # A stage that failed was raised above, so the OS disk exists
+        assert os_disk is not None
+        return InstanceEntity(
+            name=name,
+            path=path,
+            uefi_code=instance_uefi_code,
+            uefi_vars=instance_uefi_vars,
+            vcpu=vcpu,
+            ram=ram,
+            image=image,
+            os_disk=os_disk,
+            network=network,
+            bootstrap=bootstrap,
+            bootstrap_file=bootstrap_file,
+        )
+
+    @staticmethod
+    async def _unprovision(entity: "InstanceEntity"):
+        """
+        Remove the files of an instance that was never recorded
+        """
+        await entity.os_disk.remove()
+        shutil.rmtree(entity.path, ignore_errors=True)
+
+    @staticmethod
+    async def create_many(
+        task: TaskEntity,
+        user: str,
+        instances_path: pathlib.Path,
+        uefi_code: pathlib.Path,
+        uefi_vars: pathlib.Path,
+        schema: InstanceFleetCreateSchema,
+    ) -> typing.List["InstanceEntity"]:
+        """
+        Create a fleet of instances from the same template. The image, network and bootstrap are
+        resolved once, the instances are provisioned concurrently bounded by the fleet
+        concurrency and all instances are recorded in a single transaction. Either all instances
+        are created or none.
+        Args:
+            task: The task to report aggregate progress to
+            user: The user owning the instance directories
+            instances_path: The directory below which the instances are created
+            uefi_code: The UEFI code to link into each instance
+            uefi_vars: The UEFI vars to copy into each instance
+            schema: The template of the fleet
+
+        Returns:
+            The created instances
+        """
+        try:
+            names = schema.names()
+            if len(set(names)) != len(names):
+                raise InstanceException(
+                    status=400, msg="The name pattern must produce unique names, add {index}"
+                )
+            if len(schema.variables) > schema.count:
+                raise InstanceException(
+                    status=400, msg="There are more bootstrap variables than instances"
+                )
+            for name in names:
+                if (instances_path / name).exists():
+                    raise InstanceException(
+                        status=400, msg=f"Instance path at {instances_path / name} already exists"
+                    )
+            try:
+                image: ImageEntity = await ImageEntity.repository.get_by_uid(
+                    UniqueIdentifier(schema.image_uid)
+                )
+                network: NetworkEntity = await NetworkEntity.repository.get_by_uid(
+                    UniqueIdentifier(schema.network_uid)
+                )
+                bootstrap: BootstrapEntity = await BootstrapEntity.repository.get_by_uid(
+                    UniqueIdentifier(schema.bootstrap_uid)
+                )
+            except EntityNotFoundException as e:
+                raise InstanceException(status=400, msg=f"Failed to resolve the template: {e.msg}")
+            InstanceEntity.check_requirements(image, schema.vcpu, schema.ram)
+        except InstanceException as e:
+            await task.fail(msg=f"Failed to create instances: {e.msg}")
+            raise
+
+        semaphore = asyncio.Semaphore(max(InstanceEntity.runtime.config.fleet_concurrency, 1))
+        completed = 0
+
+        async def provision(index: int, name: str) -> InstanceEntity:
+            nonlocal completed
+            async with semaphore:
+                entity = await InstanceEntity._provision(
+                    user=user,
+                    name=name,
+                    path=instances_path / name,
+                    uefi_code=uefi_code,
+                    uefi_vars=uefi_vars,
+                    vcpu=schema.vcpu,
+                    ram=schema.ram,
+                    image=image,
+                    os_disk_size=schema.os_disk_size,
+                    network=network,
+                    bootstrap=bootstrap,
+                    kv={
+                        "index": index,
+                        **(schema.variables[index] if index < len(schema.variables) else {}),
+                    },
+                )
+            completed += 1
+            percent = completed * 99 // len(names)
+            if percent != task.percent_complete:
+                await task.progress(
+                    percent_complete=percent, msg=f"Created {completed} of {len(names)} instances"
+                )
+            return entity
+
+        entities: typing.List[InstanceEntity] = []
+        try:
+            with task.stage("provision"):
+                results = await asyncio.gather(
+                    *[provision(index, name) for index, name in enumerate(names)],
+                    return_exceptions=True,
+                )
+            entities = [result for result in results if isinstance(result, InstanceEntity)]
+            failures = [result for result in results if isinstance(result, BaseException)]
+            if failures:
+                raise failures[0]
+            with task.stage("persist"):
+                await InstanceEntity.repository.create_many(entities)
+        except Exception as e:
+            for entity in entities:
+                await InstanceEntity._unprovision(entity)
+            await task.fail(msg=f"Failed to create instances: {e}")
+            raise InstanceException(status=400, msg=f"Failed to create instances: {e}") from e
+        await task.done(msg=f"Successfully created {len(entities)} instances")
+        return entities
+
+    @staticmethod
+    async def act_many(
+        task: TaskEntity,
+        action: InstanceAction,
+        instances: typing.List["InstanceEntity"],
+        schema: InstanceActionSchema,
+    ) -> typing.List["InstanceEntity"]:
+        """
+        Start or stop many instances. Only so many instances are acted on at the same time and
+        consecutive instances are acted on some time apart, so that guests do not all boot at
+        once and compete for the CPUs and disks of the host.
+        Args:
+            task: The task to report aggregate progress to
+            action: Whether to start or stop the instances
+            instances: The instances to act on
+            schema: The concurrency, stagger and readiness of the action
+
+        Returns:
+            The instances the action failed for
+        """
+        config = InstanceEntity.runtime.config
+        concurrency = schema.concurrency or config.instance_action_concurrency
+        stagger = config.instance_action_stagger if schema.stagger is None else schema.stagger
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        pacing = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        completed = 0
+        failed: typing.List[InstanceEntity] = []
+
+        async def act(instance: InstanceEntity) -> bool:
+            nonlocal next_at
+            async with pacing:
+                await asyncio.sleep(max(next_at - loop.time(), 0))
+                next_at = loop.time() + stagger
+            if action == InstanceAction.STOP:
+                await instance.stop()
+                return instance.state in (InstanceState.STOPPED, InstanceState.STOPPING)
+            if instance.state == InstanceState.PAUSED:
+                await instance.resume()
+            else:
+                await instance.start()
+            if instance.state != InstanceState.STARTED:
+                return False
+            return not schema.wait_ready or await instance.wait_ready(config.instance_ready_timeout)
+
+        async def act_bounded(instance: InstanceEntity):
+            nonlocal completed
+            async with semaphore:
+                try:
+                    succeeded = await act(instance)
+                except KasoMashinException as e:
+                    instance._logger.warning(
+                        "Failed to %s instance %s: %s", action.value, instance.name, e.msg
+                    )
+                    succeeded = False
+            if not succeeded:
+                failed.append(instance)
+            completed += 1
+            percent = completed * 99 // len(instances)
+            if percent != task.percent_complete:
+                await task.progress(
+                    percent_complete=percent,
+                    msg=f"Completed {action.value} of {completed} of {len(instances)} instances",
+                )
+
+        await asyncio.gather(*[act_bounded(instance) for instance in instances])
+        if failed:
+            await task.fail(
+                msg=f"Failed to {action.value} instances {', '.join(i.name for i in failed)}"
+            )
+        else:
+            await task.done(msg=f"Completed {action.value} of {len(instances)} instances")
+        return failed
+
     async def modify(self, schema: InstanceModifySchema, task: TaskEntity):
-        if schema.state == InstanceState.STARTED:
-            await self.start()
-        if schema.state == InstanceState.STOPPED:
-            await self.stop()
+        try:
+            if schema.state == InstanceState.STARTED and self.state == InstanceState.PAUSED:
+                await self.resume()
+            elif schema.state == InstanceState.STARTED:
+                await self.start()
+            if schema.state == InstanceState.PAUSED:
+                await self.pause()
+            if schema.state == InstanceState.STOPPED:
+                await self.stop()
+        except KasoMashinException as e:
+            await task.fail(msg=f"Failed to modify instance {self.name}: {e.msg}")
+            return
         await task.done(msg="Successfully modified")
 
     async def start(self):
+        # An instance that is refused or fails to start is reported to the caller, only
+        # controlling it via QMP is optional
+        await self.runtime.qemu_service.start_instance(self)
+        self._state = InstanceState.STARTED
         try:
-            self._popen = self.runtime.qemu_service.start_instance(self)
-            self._state = InstanceState.STARTED
-        except Exception as e:
-            pass
+            await self.runtime.qemu_service.connect(self)
+        except KasoMashinException as e:
+            self._logger.warning("Instance %s cannot be controlled via QMP: %s", self.name, e.msg)
 
     async def stop(self):
-        if self._popen is None:
-            return
-        self._popen.terminate()
-        self._state = InstanceState.STOPPED
+        self._state = await self.runtime.qemu_service.stop_instance(self)
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """
+        Wait until the guest of a started instance phones home
+        Args:
+            timeout: Seconds to wait at most
+
+        Returns:
+            Whether the instance became ready in time
+        """
+        return await self.runtime.phone_home_service.wait_ready(self, timeout)
+
+    async def pause(self):
+        await self.runtime.qemu_service.pause(self)
+        self._state = InstanceState.PAUSED
+
+    async def resume(self):
+        await self.runtime.qemu_service.resume(self)
+        self._state = InstanceState.STARTED
 
     async def remove(self):
         await self.stop()
@@ -492,4 +1001,82 @@ class InstanceEntity(Entity, AggregateRoot):
 
 
 class InstanceRepository(AsyncRepository[InstanceEntity, InstanceModel]):
-    pass
+    """
+    Repository of instances, which records the state of every instance as it changes so that
+    instances can be listed by their state without asking each of them
+    """
+
+    def __init__(
+        self,
+        runtime: "Runtime",
+        session_maker: async_sessionmaker[AsyncSession],
+        aggregate_root_class: typing.Type[InstanceEntity],
+        model_class: typing.Type[InstanceModel],
+    ):
+        super().__init__(
+            runtime=runtime,
+            session_maker=session_maker,
+            aggregate_root_class=aggregate_root_class,
+            model_class=model_class,
+        )
+        self._logger = logging.getLogger(f"{self.__class__.__module__}.{self.__class__.__name__}")
+        runtime.event_service.on_instance_state += self.record_state
+
+    async def get_by_mac(self, mac: str) -> InstanceEntity:
+        async with self._session_maker() as session:
+            model = await session.scalar(
+                select(self._model_class).where(self._model_class.mac == mac.lower())
+            )
+            if model is None:
+                raise EntityNotFoundException(status=400, msg="No such entity")
+            return await self._aggregate_root_class.from_model(model)
+
+    async def list_by_state(
+        self, states: typing.Iterable[InstanceState]
+    ) -> typing.List[InstanceEntity]:
+        async with self._session_maker() as session:
+            models = await session.scalars(
+                select(self._model_class).where(self._model_class.state.in_(list(states)))
+            )
+            return [await self._aggregate_root_class.from_model(m) for m in models]
+
+    async def list_using_disk(self, disk_uid: UniqueIdentifier) -> typing.List[InstanceEntity]:
+        """
+        The instances that run off a disk as their OS disk and are not stopped
+        """
+        async with self._session_maker() as session:
+            models = await session.scalars(
+                select(self._model_class).where(
+                    self._model_class.os_disk_uid == str(disk_uid),
+                    self._model_class.state != InstanceState.STOPPED,
+                )
+            )
+            return [await self._aggregate_root_class.from_model(m) for m in models]
+
+    async def record_state(self, uid: UniqueIdentifier, state: InstanceState):
+        """
+        Record a state change of an instance along with the pid of its process and its VNC
+        display, in one transaction. The start time changes whenever the instance runs in a new
+        process.
+        Args:
+            uid: The uid of the instance
+            state: The new state of the instance
+        """
+        now = datetime.datetime.now()
+        pid = self._runtime.supervisor_service.pid(uid)
+        vnc_display = self._runtime.display_service.display(uid)
+        try:
+            async with self._session_maker() as session:
+                model = await session.get(self._model_class, str(uid))
+                if model is None:
+                    return
+                if pid is not None and pid != model.pid:
+                    model.started = now
+                model.pid = pid
+                model.vnc_display = vnc_display
+                if model.state != state:
+                    model.state = state
+                    model.state_changed = now
+                await session.commit()
+        except SQLAlchemyError as e:
+            self._logger.warning("Failed to record state %s of instance %s: %s", state, uid, e)
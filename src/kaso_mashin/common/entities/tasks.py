@@ -1,5 +1,7 @@
 import typing
 import enum
+import contextlib
+import time
 
 from pydantic import Field
 import rich.table
@@ -66,6 +68,9 @@ class TaskGetSchema(EntitySchema):
     outcome: UniqueIdentifier | None = Field(
         description="The resulting uid of the task if applicable"
     )
+    timings: typing.Dict[str, float] = Field(description="Seconds spent in each stage of the task",
+                                             examples=[{"os_disk": 0.42, "bootstrap": 1.3}],
+                                             default_factory=dict)
 
     def __rich__(self):
         table = rich.table.Table(box=rich.box.ROUNDED)
@@ -77,6 +82,8 @@ class TaskGetSchema(EntitySchema):
         table.add_row("[blue]State", str(self.state))
         table.add_row("[blue]Message", str(self.msg))
         table.add_row("[blue]Percent Complete", f"{self.percent_complete} %")
+        for stage, seconds in self.timings.items():
+            table.add_row(f"[blue]Stage {stage}", f"{seconds:.3f} s")
         return table
 
 
@@ -127,6 +134,7 @@ class TaskEntity(Entity, AggregateRoot):
         self._msg = msg
         self._percent_complete = 0
         self._outcome: UniqueIdentifier | None = None
+        self._timings: typing.Dict[str, float] = {}
 
     @property
     def name(self) -> str:
@@ -156,6 +164,23 @@ class TaskEntity(Entity, AggregateRoot):
     def outcome(self) -> UniqueIdentifier | None:
         return self._outcome
 
+    @property
+    def timings(self) -> typing.Dict[str, float]:
+        return self._timings
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Record the seconds spent in a stage of the task, whether the stage succeeds or not
+        Args:
+            name: The name of the stage
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._timings[name] = time.monotonic() - started
+
     @staticmethod
     async def from_model(model: TaskModel) -> "TaskEntity":
         raise NotImplementedError
@@ -0,0 +1,106 @@
+"""
+Local file helpers
+"""
+
+import ctypes
+import fcntl
+import os
+import pathlib
+import shutil
+import sys
+
+# _IOW(0x94, 9, int), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Bytes handed to the kernel per in-kernel copy call
+COPY_CHUNK_SIZE = 1 << 30
+
+
+def _reflink(source_fd: int, destination_fd: int) -> bool:
+    """
+    Share the extents of the source with the destination on filesystems supporting reflinks,
+    such as btrfs and xfs on Linux
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _clonefile(source: pathlib.Path, destination: pathlib.Path) -> bool:
+    """
+    Clone the source on APFS via clonefile(2), which requires that the destination does not exist
+    """
+    if sys.platform != "darwin" or destination.exists():
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def _copy_in_kernel(source_fd: int, destination_fd: int, size: int) -> str | None:
+    """
+    Copy without moving the data through userspace, via copy_file_range(2) or sendfile(2)
+
+    Returns:
+        The name of the system call that copied the data, None if neither is supported
+    """
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if method == "copy_file_range":
+                    count = os.copy_file_range(
+                        source_fd, destination_fd, min(size - copied, COPY_CHUNK_SIZE)
+                    )
+                else:
+                    count = os.sendfile(
+                        destination_fd, source_fd, copied, min(size - copied, COPY_CHUNK_SIZE)
+                    )
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            if copied > 0:
+                raise
+            continue
+        if copied == size:
+            return method
+        if copied > 0:
+            raise OSError(f"Source file changed size while it was copied with {method}")
+    return None
+
+
+def clone_file(source: pathlib.Path, destination: pathlib.Path) -> str:
+    """
+    Copy a file as cheaply as the platform allows. Reflinks and clones share the data with the
+    source until either is modified, which makes the copy independent of the file size. Copying
+    in the kernel avoids moving the data through userspace. Only if neither is supported the
+    file is copied in userspace.
+    Args:
+        source: The file to copy
+        destination: The file to create or overwrite
+
+    Returns:
+        The method used, one of reflink, clonefile, copy_file_range, sendfile or copy
+    """
+    if _clonefile(source, destination):
+        return "clonefile"
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        if _reflink(src.fileno(), dst.fileno()):
+            return "reflink"
+        method = _copy_in_kernel(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+        if method is not None:
+            return method
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+        shutil.copyfileobj(src, dst)
+    return "copy"
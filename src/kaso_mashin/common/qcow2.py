@@ -0,0 +1,326 @@
+"""
+QCoW2 on-disk format helpers
+"""
+
+import dataclasses
+import math
+import mmap
+import pathlib
+import struct
+import typing
+
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_VERSION = 3
+QCOW2_DEFAULT_CLUSTER_BITS = 16
+QCOW2_REFCOUNT_ORDER = 4
+QCOW2_OFLAG_COPIED = 1 << 63
+QCOW2_OFFSET_MASK = 0x00FFFFFFFFFFFE00
+QCOW2_EXT_END = 0x00000000
+QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+
+# Version 3 header up to and including header_length, see docs/interop/qcow2.txt in the QEMU sources
+QCOW2_HEADER = struct.Struct(">4sIQIIQIIQQIIQQQQII")
+
+# Version 2 header, which version 3 extends
+QCOW2_HEADER_V2 = struct.Struct(">4sIQIIQIIQQIIQ")
+
+# Upper bound of images followed when resolving a backing chain
+QCOW2_MAX_CHAIN_DEPTH = 64
+
+
+def is_qcow2(head: bytes) -> bool:
+    """
+    Determine whether the provided leading bytes of an image belong to a QCoW2 image
+    Args:
+        head: The first bytes of the image
+
+    Returns:
+        True if the bytes carry the QCoW2 magic
+    """
+    return head[: len(QCOW2_MAGIC)] == QCOW2_MAGIC
+
+
+def pack_header(
+    virtual_size: int,
+    l1_size: int,
+    l1_table_offset: int,
+    refcount_table_offset: int,
+    refcount_table_clusters: int,
+    cluster_bits: int = QCOW2_DEFAULT_CLUSTER_BITS,
+    backing_file: str | None = None,
+    backing_format: str | None = None,
+) -> bytes:
+    """
+    Pack a version 3 QCoW2 header including its extensions and the backing file name
+    Args:
+        virtual_size: The virtual size of the image in bytes
+        l1_size: Number of entries in the L1 table
+        l1_table_offset: Offset of the L1 table in the image file
+        refcount_table_offset: Offset of the refcount table in the image file
+        refcount_table_clusters: Number of clusters occupied by the refcount table
+        cluster_bits: Cluster size as a power of two
+        backing_file: Optional backing file name
+        backing_format: Optional format of the backing file
+
+    Returns:
+        The header bytes, which must fit into the first cluster of the image
+    """
+    extensions = b""
+    if backing_format is not None:
+        fmt = backing_format.encode("utf-8")
+        extensions += struct.pack(">II", QCOW2_EXT_BACKING_FORMAT, len(fmt))
+        extensions += fmt + b"\x00" * (-len(fmt) % 8)
+    extensions += struct.pack(">II", QCOW2_EXT_END, 0)
+    backing = backing_file.encode("utf-8") if backing_file is not None else b""
+    backing_file_offset = QCOW2_HEADER.size + len(extensions) if backing else 0
+    header = QCOW2_HEADER.pack(
+        QCOW2_MAGIC,
+        QCOW2_VERSION,
+        backing_file_offset,
+        len(backing),
+        cluster_bits,
+        virtual_size,
+        0,  # crypt_method
+        l1_size,
+        l1_table_offset,
+        refcount_table_offset,
+        refcount_table_clusters,
+        0,  # nb_snapshots
+        0,  # snapshots_offset
+        0,  # incompatible_features
+        0,  # compatible_features
+        0,  # autoclear_features
+        QCOW2_REFCOUNT_ORDER,
+        QCOW2_HEADER.size,
+    )
+    packed = header + extensions + backing
+    if len(packed) > 1 << cluster_bits:
+        raise ValueError("QCoW2 header does not fit into the first cluster")
+    return packed
+
+
+def l1_entries(virtual_size: int, cluster_bits: int = QCOW2_DEFAULT_CLUSTER_BITS) -> int:
+    """
+    Calculate the number of L1 table entries required to map the provided virtual size
+    """
+    cluster_size = 1 << cluster_bits
+    return max(1, math.ceil(virtual_size / (cluster_size * (cluster_size // 8))))
+
+
+def refcount_layout(
+    clusters: int, cluster_bits: int = QCOW2_DEFAULT_CLUSTER_BITS
+) -> typing.Tuple[int, int]:
+    """
+    Calculate how many refcount blocks and refcount table clusters are required to account for
+    the provided number of clusters as well as for the refcount structures themselves
+    Args:
+        clusters: Number of clusters in use, excluding the refcount structures
+        cluster_bits: Cluster size as a power of two
+
+    Returns:
+        A tuple of refcount block count and refcount table cluster count
+    """
+    cluster_size = 1 << cluster_bits
+    refcounts_per_block = cluster_size * 8 // (1 << QCOW2_REFCOUNT_ORDER)
+    blocks, table_clusters = 0, 0
+    while True:
+        total = clusters + blocks + table_clusters
+        needed_blocks = math.ceil(total / refcounts_per_block)
+        needed_table_clusters = math.ceil(needed_blocks * 8 / cluster_size)
+        if (needed_blocks, needed_table_clusters) == (blocks, table_clusters):
+            return blocks, table_clusters
+        blocks, table_clusters = needed_blocks, needed_table_clusters
+
+
+def pack_refcounts(
+    refcount_block_offset: int,
+    blocks: int,
+    table_clusters: int,
+    clusters: int,
+    cluster_bits: int = QCOW2_DEFAULT_CLUSTER_BITS,
+) -> typing.Tuple[bytes, bytes]:
+    """
+    Pack a refcount table and contiguous refcount blocks marking the first clusters as in use
+    Args:
+        refcount_block_offset: Offset of the first refcount block in the image file
+        blocks: Number of refcount blocks
+        table_clusters: Number of clusters of the refcount table
+        clusters: Number of clusters (from offset 0) to mark as referenced exactly once
+        cluster_bits: Cluster size as a power of two
+
+    Returns:
+        A tuple of the packed refcount table and the packed refcount blocks
+    """
+    cluster_size = 1 << cluster_bits
+    table = bytearray(table_clusters * cluster_size)
+    for index in range(blocks):
+        struct.pack_into(">Q", table, index * 8, refcount_block_offset + index * cluster_size)
+    refcounts = bytearray(blocks * cluster_size)
+    refcounts[: clusters * 2] = b"\x00\x01" * clusters
+    return bytes(table), bytes(refcounts)
+
+
+@dataclasses.dataclass
+class ImageInfo:
+    """
+    Metadata of a QCoW2 or raw image file
+    """
+
+    path: pathlib.Path
+    format: str
+    virtual_size: int
+    allocated_size: int
+    cluster_bits: int = dataclasses.field(default=0)
+    l1_size: int = dataclasses.field(default=0)
+    l2_tables: int = dataclasses.field(default=0)
+    backing_file: str | None = dataclasses.field(default=None)
+    backing_format: str | None = dataclasses.field(default=None)
+
+    @property
+    def backing_path(self) -> pathlib.Path | None:
+        """
+        The path of the backing file, which QEMU resolves relative to the image itself
+        """
+        if self.backing_file is None:
+            return None
+        return self.path.parent / self.backing_file
+
+
+def inspect(path: pathlib.Path) -> ImageInfo:
+    """
+    Read the metadata of an image without spawning qemu-img. Only the header, its extensions
+    and the L1 table of QCoW2 images are read via mmap, files in any other format are treated
+    as raw images.
+    Args:
+        path: The path of the image file
+
+    Returns:
+        The image metadata
+    """
+    stat = path.stat()
+    allocated_size = stat.st_blocks * 512
+    if stat.st_size < QCOW2_HEADER_V2.size:
+        return ImageInfo(
+            path=path, format="raw", virtual_size=stat.st_size, allocated_size=allocated_size
+        )
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if not is_qcow2(m[: len(QCOW2_MAGIC)]):
+            return ImageInfo(
+                path=path, format="raw", virtual_size=stat.st_size, allocated_size=allocated_size
+            )
+        (
+            _,
+            version,
+            backing_file_offset,
+            backing_file_size,
+            cluster_bits,
+            virtual_size,
+            _,
+            l1_size,
+            l1_table_offset,
+            *_,
+        ) = QCOW2_HEADER_V2.unpack_from(m)
+        header_length = QCOW2_HEADER_V2.size
+        if version >= 3 and len(m) >= QCOW2_HEADER.size:
+            header_length = QCOW2_HEADER.unpack_from(m)[-1]
+        backing_format = None
+        offset = header_length
+        while offset + 8 <= len(m):
+            ext_type, ext_length = struct.unpack_from(">II", m, offset)
+            if ext_type == QCOW2_EXT_END:
+                break
+            if ext_type == QCOW2_EXT_BACKING_FORMAT:
+                backing_format = m[offset + 8 : offset + 8 + ext_length].decode("utf-8")
+            offset += 8 + ext_length + (-ext_length % 8)
+        backing_file = None
+        if backing_file_offset:
+            backing_file = m[backing_file_offset : backing_file_offset + backing_file_size].decode(
+                "utf-8"
+            )
+        l1_end = min(l1_table_offset + l1_size * 8, len(m))
+        l2_tables = sum(
+            1
+            for (entry,) in struct.iter_unpack(">Q", m[l1_table_offset:l1_end])
+            if entry & QCOW2_OFFSET_MASK
+        )
+    return ImageInfo(
+        path=path,
+        format="qcow2",
+        virtual_size=virtual_size,
+        allocated_size=allocated_size,
+        cluster_bits=cluster_bits,
+        l1_size=l1_size,
+        l2_tables=l2_tables,
+        backing_file=backing_file,
+        backing_format=backing_format,
+    )
+
+
+def backing_chain(
+    path: pathlib.Path, max_depth: int = QCOW2_MAX_CHAIN_DEPTH
+) -> typing.List[ImageInfo]:
+    """
+    Inspect an image and the backing files it is layered on
+    Args:
+        path: The path of the topmost image
+        max_depth: The maximum number of backing files to follow
+
+    Returns:
+        The metadata of the image followed by its backing files, as far as they exist
+    """
+    chain = [inspect(path)]
+    seen = {path.resolve()}
+    while len(chain) <= max_depth:
+        backing = chain[-1].backing_path
+        if backing is None or not backing.exists() or backing.resolve() in seen:
+            break
+        seen.add(backing.resolve())
+        chain.append(inspect(backing))
+    return chain
+
+
+def create(
+    path: pathlib.Path,
+    virtual_size: int,
+    backing_file: str | None = None,
+    backing_format: str | None = None,
+    cluster_bits: int = QCOW2_DEFAULT_CLUSTER_BITS,
+):
+    """
+    Create an empty QCoW2 image without spawning qemu-img. Only the header and the refcount
+    structures are written, the L1 table is left as a sparse range of zeroes so that every
+    cluster reads from the backing file or as zeroes.
+    Args:
+        path: The path of the image file, which must not exist
+        virtual_size: The virtual size of the image in bytes
+        backing_file: Optional backing file name, resolved relative to the image by QEMU
+        backing_format: Optional format of the backing file
+        cluster_bits: Cluster size as a power of two
+    """
+    cluster_size = 1 << cluster_bits
+    l1_size = l1_entries(virtual_size, cluster_bits)
+    l1_clusters = math.ceil(l1_size * 8 / cluster_size)
+    blocks, table_clusters = refcount_layout(1 + l1_clusters, cluster_bits)
+    refcount_table_offset = cluster_size
+    refcount_block_offset = refcount_table_offset + table_clusters * cluster_size
+    l1_table_offset = refcount_block_offset + blocks * cluster_size
+    clusters = 1 + table_clusters + blocks + l1_clusters
+    header = pack_header(
+        virtual_size=virtual_size,
+        l1_size=l1_size,
+        l1_table_offset=l1_table_offset,
+        refcount_table_offset=refcount_table_offset,
+        refcount_table_clusters=table_clusters,
+        cluster_bits=cluster_bits,
+        backing_file=backing_file,
+        backing_format=backing_format,
+    )
+    table, refcounts = pack_refcounts(
+        refcount_block_offset, blocks, table_clusters, clusters, cluster_bits
+    )
+    with open(path, "xb") as f:
+        f.write(header)
+        f.seek(refcount_table_offset)
+        f.write(table)
+        f.write(refcounts)
+        f.truncate(clusters * cluster_size)
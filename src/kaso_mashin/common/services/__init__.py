@@ -1,2 +1,27 @@
 from .event import EventService
-from .qemu import QEMUService
\ No newline at end of file
+from .process import ProcessService, ProcessException, ProcessResult, ProcessMetricsSchema
+from .supervisor import SupervisorService, RestartPolicy, SupervisedProcessSchema
+from .qemu import QEMUService, QMPException
+from .phone_home import PhoneHomeService
+from .download import DownloadService, DownloadException, DownloadResult
+from .prefetch import PrefetchService
+from .disk_pool import DiskPoolService
+from .capacity import CapacityService, CapacityException, CapacityGetSchema
+from .resources import ResourceService, ResourceException, ResourcesGetSchema
+from .displays import DisplayService, DisplayException
+from .bandwidth import BandwidthService, BandwidthGetSchema, BandwidthModifySchema
+from .gc import (
+    GCService,
+    GCMode,
+    GCAction,
+    GCReportSchema,
+    GCOrphanSchema,
+    GCDanglingSchema,
+)
+from .disk_stats import (
+    DiskStatsService,
+    DiskStatsRing,
+    DiskStatsSource,
+    DiskStatsSchema,
+    DiskStatsPointSchema,
+)
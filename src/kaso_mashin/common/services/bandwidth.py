@@ -0,0 +1,218 @@
+import asyncio
+import contextlib
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin.common.base_types import Service, EntitySchema
+
+# Transfers are throttled in quanta of this size, so that waiting transfers take turns
+BANDWIDTH_QUANTUM = 65536
+
+
+class BandwidthGetSchema(EntitySchema):
+    """
+    Schema to get the current bandwidth limits
+    """
+
+    rate_limit: int = pydantic.Field(
+        description="Bytes per second all downloads may use together, 0 for no limit",
+        examples=[0, 52428800],
+    )
+    rate_limit_per_transfer: int = pydantic.Field(
+        description="Bytes per second a single download may use, 0 for no limit",
+        examples=[0, 10485760],
+    )
+    active_transfers: int = pydantic.Field(
+        description="Number of downloads currently in progress", examples=[0, 2]
+    )
+
+
+class BandwidthModifySchema(EntitySchema):
+    """
+    Schema to modify the bandwidth limits
+    """
+
+    rate_limit: typing.Optional[int] = pydantic.Field(
+        description="Bytes per second all downloads may use together, 0 for no limit",
+        examples=[0, 52428800],
+        default=None,
+        ge=0,
+    )
+    rate_limit_per_transfer: typing.Optional[int] = pydantic.Field(
+        description="Bytes per second a single download may use, 0 for no limit",
+        examples=[0, 10485760],
+        default=None,
+        ge=0,
+    )
+
+
+class TokenBucket:
+    """
+    A token bucket refilling at a rate of bytes per second with a burst of one second
+    """
+
+    def __init__(self, rate: int = 0):
+        self._rate = rate
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    @rate.setter
+    def rate(self, value: int):
+        self._rate = value
+        self._tokens = min(self._tokens, float(value))
+
+    async def consume(self, amount: int):
+        """
+        Take tokens from the bucket, waiting until they are available. Waiting consumers are
+        served in the order they arrived.
+        Args:
+            amount: The number of tokens to take
+        """
+        if self._rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self._rate), self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens < 0:
+                await asyncio.sleep(-self._tokens / self._rate)
+
+
+class Transfer:
+    """
+    A single throttled transfer
+    """
+
+    def __init__(self, service: "BandwidthService", name: str, rate: int, low_priority: bool):
+        self._service = service
+        self._name = name
+        self._low_priority = low_priority
+        self._limit = rate
+        self._bucket = TokenBucket(self._effective_rate(service.rate_limit_per_transfer))
+        self._transferred = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def low_priority(self) -> bool:
+        return self._low_priority
+
+    @property
+    def transferred(self) -> int:
+        return self._transferred
+
+    def _effective_rate(self, rate_limit_per_transfer: int) -> int:
+        rates = [rate for rate in (self._limit, rate_limit_per_transfer) if rate > 0]
+        return min(rates) if rates else 0
+
+    def reconfigure(self, rate_limit_per_transfer: int):
+        self._bucket.rate = self._effective_rate(rate_limit_per_transfer)
+
+    async def throttle(self, amount: int):
+        """
+        Wait until the transfer may move the provided amount of bytes
+        Args:
+            amount: The number of bytes to move
+        """
+        self._transferred += amount
+        while amount > 0:
+            quantum = min(amount, BANDWIDTH_QUANTUM)
+            if self._low_priority:
+                await self._service.wait_idle()
+            await self._bucket.consume(quantum)
+            await self._service.bucket.consume(quantum)
+            amount -= quantum
+
+
+class BandwidthService(Service):
+    """
+    Governs the bandwidth of downloads using a global token bucket and a bucket per transfer.
+    Transfers take turns on the global bucket in small quanta so they share it fairly, and
+    low priority transfers only proceed while no other transfer is active.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._bucket = TokenBucket(runtime.config.download_rate_limit)
+        self._transfers: typing.Set[Transfer] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._logger.info("Started bandwidth service")
+
+    @property
+    def bucket(self) -> TokenBucket:
+        return self._bucket
+
+    @property
+    def rate_limit(self) -> int:
+        return self._runtime.config.download_rate_limit
+
+    @property
+    def rate_limit_per_transfer(self) -> int:
+        return self._runtime.config.download_rate_limit_per_transfer
+
+    @property
+    def active_transfers(self) -> int:
+        return len(self._transfers)
+
+    def configure(self, rate_limit: int | None = None, rate_limit_per_transfer: int | None = None):
+        """
+        Adjust the bandwidth limits at runtime. Active transfers adopt the new limits immediately.
+        Args:
+            rate_limit: Bytes per second all transfers may use together, 0 for no limit
+            rate_limit_per_transfer: Bytes per second a single transfer may use, 0 for no limit
+        """
+        if rate_limit is not None:
+            self._runtime.config.download_rate_limit = rate_limit
+            self._bucket.rate = rate_limit
+        if rate_limit_per_transfer is not None:
+            self._runtime.config.download_rate_limit_per_transfer = rate_limit_per_transfer
+            for transfer in self._transfers:
+                transfer.reconfigure(rate_limit_per_transfer)
+        self._logger.info(
+            "Bandwidth limited to %s bytes/s in total and %s bytes/s per transfer",
+            self.rate_limit,
+            self.rate_limit_per_transfer,
+        )
+
+    async def wait_idle(self):
+        await self._idle.wait()
+
+    def _update_idle(self):
+        if any(not transfer.low_priority for transfer in self._transfers):
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    @contextlib.asynccontextmanager
+    async def transfer(
+        self, name: str, rate: int = 0, low_priority: bool = False
+    ) -> typing.AsyncIterator[Transfer]:
+        """
+        Register a transfer for the duration of the context
+        Args:
+            name: A name for the transfer, typically its URL
+            rate: An optional limit of bytes per second for this transfer, 0 for no limit
+            low_priority: Whether the transfer yields to all other transfers
+
+        Returns:
+            The transfer to throttle
+        """
+        transfer = Transfer(service=self, name=name, rate=rate, low_priority=low_priority)
+        self._transfers.add(transfer)
+        self._update_idle()
+        try:
+            yield transfer
+        finally:
+            self._transfers.discard(transfer)
+            self._update_idle()
@@ -0,0 +1,198 @@
+import asyncio
+import contextlib
+import os
+import pathlib
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service, EntitySchema, BinarySizedValue, BinaryScale
+
+# Seconds the allocated size of a disk file is trusted before it is read again
+ALLOCATION_CACHE_SECONDS = 30
+
+
+class CapacityException(KasoMashinException):
+    """
+    Exception for disk space that is not available
+    """
+
+    pass
+
+
+class CapacityGetSchema(EntitySchema):
+    """
+    Schema for the disk space behind the instances path
+    """
+
+    path: pathlib.Path = pydantic.Field(
+        description="The path whose filesystem is accounted", examples=["/var/kaso/instances"]
+    )
+    total: int = pydantic.Field(description="Size of the filesystem in bytes")
+    free: int = pydantic.Field(description="Bytes still available on the filesystem")
+    provisioned: int = pydantic.Field(
+        description="Sum of the sizes of all disks as seen by their guests in bytes"
+    )
+    allocated: int = pydantic.Field(description="Bytes the disk files actually occupy")
+    reserved: int = pydantic.Field(description="Bytes reserved by disks currently being created")
+    overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the filesystem size that may be provisioned, 0 for no limit",
+        examples=[2.0],
+    )
+    min_free_ratio: float = pydantic.Field(
+        description="Share of the filesystem that must remain free to create disks",
+        examples=[0.05],
+    )
+    available: int | None = pydantic.Field(
+        description="Bytes that can still be provisioned within the overcommit ratio, "
+        "none if there is no limit",
+        default=None,
+    )
+    waiting: int = pydantic.Field(description="Number of disk creations queued for space")
+
+
+class CapacityService(Service):
+    """
+    Accounts for the disk space behind the instances path and admits disk creations only while
+    the sum of provisioned disk sizes stays within the configured overcommit ratio and enough of
+    the filesystem remains free. Thin-provisioned disks only grow later, so overcommitting without
+    limit eventually fills the host and stops every instance on it. Creations that do not fit are
+    rejected or, if configured, queued until space is released.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._condition = asyncio.Condition()
+        self._reserved = 0
+        self._waiting = 0
+        self._allocations: typing.Dict[pathlib.Path, typing.Tuple[float, int]] = {}
+        self._logger.info("Started capacity service")
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._runtime.config.instances_path
+
+    @staticmethod
+    def size_in_bytes(size: BinarySizedValue) -> int:
+        return size.at_scale(BinaryScale.b).value
+
+    def allocated_size(self, path: pathlib.Path) -> int:
+        """
+        Bytes a disk file occupies on the filesystem, cached for a short while so that admitting
+        a disk does not stat every disk file again
+        Args:
+            path: Path of the disk file
+
+        Returns:
+            The allocated bytes, 0 if the file does not exist
+        """
+        now = time.monotonic()
+        cached = self._allocations.get(path)
+        if cached is not None and now - cached[0] < ALLOCATION_CACHE_SECONDS:
+            return cached[1]
+        try:
+            allocated = os.stat(path).st_blocks * 512
+        except OSError:
+            allocated = 0
+        self._allocations[path] = (now, allocated)
+        return allocated
+
+    def forget(self, path: pathlib.Path):
+        """
+        Drop the cached allocation of a disk file that was created, resized or removed
+        """
+        self._allocations.pop(path, None)
+
+    async def usage(self) -> CapacityGetSchema:
+        """
+        Account for the disk space behind the instances path
+        """
+        disks = await self._runtime.disk_repository.list()
+        self._allocations = {
+            path: cached
+            for path, cached in self._allocations.items()
+            if path in {disk.path for disk in disks}
+        }
+        stat = os.statvfs(self.path)
+        total = stat.f_blocks * stat.f_frsize
+        provisioned = sum(self.size_in_bytes(disk.size) for disk in disks)
+        ratio = self._runtime.config.disk_overcommit_ratio
+        return CapacityGetSchema(
+            path=self.path,
+            total=total,
+            free=stat.f_bavail * stat.f_frsize,
+            provisioned=provisioned,
+            allocated=sum(self.allocated_size(disk.path) for disk in disks),
+            reserved=self._reserved,
+            overcommit_ratio=ratio,
+            min_free_ratio=self._runtime.config.disk_min_free_ratio,
+            available=(
+                max(int(ratio * total) - provisioned - self._reserved, 0) if ratio > 0 else None
+            ),
+            waiting=self._waiting,
+        )
+
+    @staticmethod
+    def refusal(usage: CapacityGetSchema, amount: int) -> str | None:
+        """
+        Decide whether provisioning more space is admissible
+        Args:
+            usage: The current disk space accounting
+            amount: The bytes to provision
+
+        Returns:
+            The reason why the space cannot be provisioned, None if it can
+        """
+        if usage.available is not None and amount > usage.available:
+            return (
+                f"Provisioning {amount} bytes exceeds the overcommit ratio of "
+                f"{usage.overcommit_ratio}, only {usage.available} bytes are available"
+            )
+        if usage.free < usage.min_free_ratio * usage.total:
+            return (
+                f"Only {usage.free} of {usage.total} bytes are free on the filesystem of "
+                f"{usage.path}, which is below the minimum of {usage.min_free_ratio:.0%}"
+            )
+        return None
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, amount: int) -> typing.AsyncIterator[None]:
+        """
+        Reserve space for a disk while it is created. Waits for space to be released for up to
+        the configured queue timeout before giving up.
+        Args:
+            amount: The bytes to provision
+
+        Raises:
+            CapacityException if the space cannot be provisioned
+        """
+        deadline = time.monotonic() + self._runtime.config.capacity_queue_timeout
+        async with self._condition:
+            while (refusal := self.refusal(await self.usage(), amount)) is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise CapacityException(status=507, msg=refusal)
+                self._logger.info("Waiting for space to provision %s bytes: %s", amount, refusal)
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiting -= 1
+            self._reserved += amount
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._reserved -= amount
+                self._condition.notify_all()
+
+    async def release(self):
+        """
+        Wake up disk creations waiting for space after disks were removed or shrunk
+        """
+        async with self._condition:
+            self._condition.notify_all()
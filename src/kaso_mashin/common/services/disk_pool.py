@@ -0,0 +1,163 @@
+import asyncio
+import os
+import pathlib
+import typing
+import uuid
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import (
+    Service,
+    BinarySizedValue,
+    BinaryScale,
+    EntityNotFoundException,
+)
+from kaso_mashin.common import qcow2
+from kaso_mashin.common.entities import DiskEntity, DiskFormat, ImageEntity
+
+# Name of the directory below the instances path holding the pool
+DISK_POOL_DIRECTORY = ".pool"
+
+PoolKey = typing.Tuple[str, str, str]
+
+
+class DiskPoolService(Service):
+    """
+    Keeps a warm pool of ready-made overlay disks for the images and sizes disks are created with,
+    so creating a disk only needs to claim a file by renaming it instead of waiting on qemu-img.
+    The pool lives below the instances path, so claiming is atomic on the same filesystem. It
+    learns which images and sizes to keep from the disks being created and refills itself in the
+    background.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._pool: typing.Dict[PoolKey, typing.List[pathlib.Path]] = {}
+        self._refills: typing.Dict[PoolKey, asyncio.Task] = {}
+        self._logger.info("Started disk pool service")
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._runtime.config.instances_path / DISK_POOL_DIRECTORY
+
+    @property
+    def size(self) -> int:
+        return self._runtime.config.disk_pool_size
+
+    @property
+    def entries(self) -> typing.Dict[PoolKey, typing.List[pathlib.Path]]:
+        return {key: list(paths) for key, paths in self._pool.items() if paths}
+
+    @staticmethod
+    def key(image: ImageEntity, size: BinarySizedValue, disk_format: DiskFormat) -> PoolKey:
+        return str(image.uid), str(size), str(disk_format)
+
+    async def start(self):
+        """
+        Pick up overlays pooled before a restart and top up the pool for the images they belong to
+        """
+        if not self.path.exists():
+            return
+        self._pool.clear()
+        for candidate in self.path.iterdir():
+            try:
+                image_uid, size, _ = candidate.stem.split("_")
+                key = (image_uid, size, candidate.suffix.lstrip("."))
+                self._pool.setdefault(key, []).append(candidate)
+            except ValueError:
+                candidate.unlink(missing_ok=True)
+        for key in list(self._pool):
+            image_uid, size, disk_format = key
+            try:
+                image = await self._runtime.image_repository.get_by_uid(image_uid)
+            except EntityNotFoundException:
+                for candidate in self._pool.pop(key):
+                    candidate.unlink(missing_ok=True)
+                continue
+            self.refill(
+                image,
+                BinarySizedValue(int(size[:-1]), BinaryScale[size[-1]]),
+                DiskFormat(disk_format),
+            )
+
+    async def stop(self):
+        for task in self._refills.values():
+            task.cancel()
+        for task in self._refills.values():
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._refills.clear()
+
+    async def claim(
+        self,
+        image: ImageEntity,
+        size: BinarySizedValue,
+        disk_format: DiskFormat,
+        path: pathlib.Path,
+    ) -> bool:
+        """
+        Move a pooled overlay into place and refill the pool in the background
+        Args:
+            image: The image the disk is backed by
+            size: The size of the disk
+            disk_format: The format of the disk
+            path: Where the disk is expected
+
+        Returns:
+            True if a pooled overlay was moved to the path, False if the caller must create it
+        """
+        if self.size <= 0:
+            return False
+        key = self.key(image, size, disk_format)
+        entries = self._pool.get(key, [])
+        claimed = False
+        while entries and not claimed:
+            candidate = entries.pop()
+            try:
+                if qcow2.inspect(candidate).backing_path != image.path:
+                    # The image was refreshed since the overlay was created
+                    candidate.unlink(missing_ok=True)
+                    continue
+                os.rename(candidate, path)
+                claimed = True
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self._logger.warning("Failed to claim pooled disk %s: %s", candidate, e)
+                entries.append(candidate)
+                break
+        self.refill(image, size, disk_format)
+        if claimed:
+            self._logger.info("Claimed pooled disk for %s at %s", image.name, path)
+        return claimed
+
+    def refill(self, image: ImageEntity, size: BinarySizedValue, disk_format: DiskFormat):
+        """
+        Top up the pool for an image and size in the background unless that is already underway
+        """
+        key = self.key(image, size, disk_format)
+        if self.size <= 0 or (key in self._refills and not self._refills[key].done()):
+            return
+        self._refills[key] = asyncio.create_task(
+            self._refill(key, image, size, disk_format), name=f"refill {key}"
+        )
+
+    async def _refill(
+        self,
+        key: PoolKey,
+        image: ImageEntity,
+        size: BinarySizedValue,
+        disk_format: DiskFormat,
+    ):
+        self.path.mkdir(parents=True, exist_ok=True)
+        entries = self._pool.setdefault(key, [])
+        while len(entries) < self.size:
+            candidate = self.path / f"{key[0]}_{key[1]}_{uuid.uuid4().hex}.{disk_format}"
+            try:
+                await DiskEntity.create_file(candidate, size, disk_format, image)
+            except (KasoMashinException, OSError) as e:
+                candidate.unlink(missing_ok=True)
+                self._logger.warning("Failed to refill the disk pool for %s: %s", image.name, e)
+                return
+            entries.append(candidate)
@@ -0,0 +1,246 @@
+import array
+import asyncio
+import datetime
+import enum
+import os
+import typing
+
+import pydantic
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service, EntitySchema, UniqueIdentifier
+from kaso_mashin.common.entities import InstanceEntity
+
+Counters = typing.Tuple[int, int, int, int]
+
+
+class DiskStatsSource(enum.StrEnum):
+    QMP = "qmp"
+    ALLOCATION = "allocation"
+
+
+class DiskStatsPointSchema(EntitySchema):
+    """
+    Schema for the disk activity within one interval
+    """
+
+    timestamp: datetime.datetime = pydantic.Field(description="End of the interval")
+    read_bytes_per_second: float = pydantic.Field(description="Bytes read by the guest")
+    write_bytes_per_second: float = pydantic.Field(description="Bytes written by the guest")
+    read_ops_per_second: float = pydantic.Field(description="Read operations of the guest")
+    write_ops_per_second: float = pydantic.Field(description="Write operations of the guest")
+    allocated: int = pydantic.Field(description="Bytes the disk file occupied at the end")
+    allocation_growth_per_second: float = pydantic.Field(
+        description="Bytes the disk file grew by, which is all that is known of stopped disks"
+    )
+
+
+class DiskStatsSchema(EntitySchema):
+    """
+    Schema for the recent activity of a disk
+    """
+
+    uid: UniqueIdentifier = pydantic.Field(
+        description="The unique identifier of the disk",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    source: DiskStatsSource | None = pydantic.Field(
+        description="Where the most recent sample came from, none if there is no sample yet",
+        examples=[DiskStatsSource.QMP],
+        default=None,
+    )
+    entries: typing.List[DiskStatsPointSchema] = pydantic.Field(
+        description="Activity per interval, oldest first", default_factory=list
+    )
+
+
+class DiskStatsRing:
+    """
+    Fixed-size ring buffer of cumulative disk counters, kept in a single flat array of doubles
+    so that hundreds of disks with hours of samples remain compact
+    """
+
+    FIELDS = ("timestamp", "allocated", "rd_bytes", "wr_bytes", "rd_ops", "wr_ops", "source")
+
+    def __init__(self, capacity: int):
+        self._capacity = max(capacity, 2)
+        self._data = array.array("d", [0.0]) * (self._capacity * len(self.FIELDS))
+        self._head = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, *values: float):
+        offset = self._head * len(self.FIELDS)
+        self._data[offset : offset + len(self.FIELDS)] = array.array("d", values)
+        self._head = (self._head + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def samples(self, since: float = 0.0) -> typing.List[typing.Tuple[float, ...]]:
+        """
+        The samples taken at or after the provided timestamp, oldest first
+        """
+        width = len(self.FIELDS)
+        first = (self._head - self._count) % self._capacity
+        samples = []
+        for index in range(self._count):
+            offset = ((first + index) % self._capacity) * width
+            if self._data[offset] >= since:
+                samples.append(tuple(self._data[offset : offset + width]))
+        return samples
+
+
+class DiskStatsService(Service):
+    """
+    Periodically samples the activity of every disk into a ring buffer per disk. Disks of
+    running instances report the counters of the guest via QMP, for all other disks only the
+    growth of their file allocation is known. Samples are cumulative counters, so they can be
+    downsampled to any resolution without losing activity between samples.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._task: asyncio.Task | None = None
+        self._rings: typing.Dict[UniqueIdentifier, DiskStatsRing] = {}
+        self._logger.info("Started disk stats service")
+
+    async def start(self):
+        if self._task is not None or self._runtime.config.disk_stats_interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run(), name="disk stats")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sample()
+            except (KasoMashinException, OSError) as e:
+                self._logger.warning("Failed to sample disk stats: %s", e)
+            await asyncio.sleep(self._runtime.config.disk_stats_interval)
+
+    async def _instance_counters(self, instance: InstanceEntity) -> typing.Dict[str, Counters]:
+        counters = {}
+        async with self._runtime.qemu_service.qmp_session(instance) as qmp:
+            files = {
+                entry["device"]: entry["inserted"]["file"]
+                for entry in await qmp.execute("query-block")
+                if "inserted" in entry
+            }
+            for entry in await qmp.execute("query-blockstats"):
+                if entry.get("device") not in files:
+                    continue
+                stats = entry["stats"]
+                counters[os.path.abspath(files[entry["device"]])] = (
+                    stats["rd_bytes"],
+                    stats["wr_bytes"],
+                    stats["rd_operations"],
+                    stats["wr_operations"],
+                )
+        return counters
+
+    async def _counters(self) -> typing.Dict[str, Counters]:
+        """
+        Query the block device counters of all instances with a QMP socket concurrently
+        """
+        instances = [
+            instance
+            for instance in await self._runtime.instance_repository.list()
+            if self._runtime.qemu_service.qmp_path(instance).exists()
+        ]
+        counters = {}
+        results = await asyncio.gather(
+            *[self._instance_counters(instance) for instance in instances], return_exceptions=True
+        )
+        for instance, result in zip(instances, results):
+            if isinstance(result, KasoMashinException):
+                self._logger.debug("No disk stats for instance %s: %s", instance.name, result.msg)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                counters.update(result)
+        return counters
+
+    async def sample(self):
+        """
+        Take one sample of every disk
+        """
+        disks = await self._runtime.disk_repository.list()
+        counters = await self._counters()
+        now = datetime.datetime.now().timestamp()
+        for disk in disks:
+            try:
+                allocated = os.stat(disk.path).st_blocks * 512
+            except OSError:
+                allocated = 0
+            ring = self._rings.setdefault(
+                disk.uid, DiskStatsRing(self._runtime.config.disk_stats_samples)
+            )
+            counter = counters.get(os.path.abspath(disk.path))
+            source = DiskStatsSource.QMP if counter is not None else DiskStatsSource.ALLOCATION
+            ring.append(
+                now,
+                allocated,
+                *(counter or (0, 0, 0, 0)),
+                list(DiskStatsSource).index(source),
+            )
+        for uid in set(self._rings) - {disk.uid for disk in disks}:
+            del self._rings[uid]
+
+    def stats(self, uid: UniqueIdentifier, points: int = 60, window: int = 3600) -> DiskStatsSchema:
+        """
+        Downsample the recent activity of a disk
+        Args:
+            uid: The uid of the disk
+            points: Maximum number of intervals to return
+            window: Seconds of history to cover
+
+        Returns:
+            The activity of the disk per interval
+        """
+        ring = self._rings.get(uid)
+        if ring is None or len(ring) == 0:
+            return DiskStatsSchema(uid=uid)
+        now = datetime.datetime.now().timestamp()
+        samples = ring.samples(since=now - window)
+        if not samples:
+            return DiskStatsSchema(uid=uid)
+        source = DiskStatsSource(list(DiskStatsSource)[int(samples[-1][-1])])
+        bucket = max(window / max(points, 1), 1e-6)
+        # The last sample of each interval
+        ends: typing.Dict[int, typing.Tuple[float, ...]] = {}
+        for sample in samples:
+            ends[int((sample[0] - (now - window)) // bucket)] = sample
+        entries = []
+        previous = samples[0]
+        for _, end in sorted(ends.items()):
+            elapsed = end[0] - previous[0]
+            if elapsed <= 0:
+                continue
+            # Counters start over when an instance restarts
+            rates = [
+                (end[i] - previous[i] if end[i] >= previous[i] else end[i]) / elapsed
+                for i in range(2, 6)
+            ]
+            entries.append(
+                DiskStatsPointSchema(
+                    timestamp=datetime.datetime.fromtimestamp(end[0]),
+                    read_bytes_per_second=rates[0],
+                    write_bytes_per_second=rates[1],
+                    read_ops_per_second=rates[2],
+                    write_ops_per_second=rates[3],
+                    allocated=int(end[1]),
+                    allocation_growth_per_second=(end[1] - previous[1]) / elapsed,
+                )
+            )
+            previous = end
+        return DiskStatsSchema(uid=uid, source=source, entries=entries)
@@ -0,0 +1,101 @@
+import typing
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service, UniqueIdentifier
+from kaso_mashin.common.entities import InstanceEntity, InstanceState
+
+# VNC display 0 listens on this port, every further display on the next one
+VNC_BASE_PORT = 5900
+
+
+class DisplayException(KasoMashinException):
+    """
+    Exception for instances that cannot be given a display
+    """
+
+    pass
+
+
+class DisplayService(Service):
+    """
+    Allocates a distinct VNC display to every running instance. The displays in use are the set
+    bits of a single integer, so finding the lowest free display takes a few operations on it no
+    matter how many instances run. Displays are released once the process of their instance stops
+    for good rather than being restarted.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._used = 0
+        self._displays: typing.Dict[UniqueIdentifier, int] = {}
+        runtime.event_service.on_instance_state += self._on_instance_state
+        self._logger.info("Started display service")
+
+    @staticmethod
+    def port(display: int) -> int:
+        return VNC_BASE_PORT + display
+
+    def display(self, uid: UniqueIdentifier) -> int | None:
+        """
+        The display allocated to an instance given its uid, None if it has none
+        """
+        return self._displays.get(uid)
+
+    def allocate(self, instance: InstanceEntity) -> int:
+        """
+        Allocate the lowest free display to an instance, unless it has one already
+        Args:
+            instance: The instance to allocate a display to
+
+        Returns:
+            The display of the instance
+
+        Raises:
+            DisplayException if all displays are in use
+        """
+        if instance.uid in self._displays:
+            return self._displays[instance.uid]
+        # Isolates the lowest bit that is not set
+        display = (~self._used & (self._used + 1)).bit_length() - 1
+        if display >= self._runtime.config.vnc_displays:
+            raise DisplayException(
+                status=503,
+                msg=f"All {self._runtime.config.vnc_displays} displays are in use, instance "
+                f"{instance.name} cannot be given one",
+            )
+        self._used |= 1 << display
+        self._displays[instance.uid] = display
+        return display
+
+    def claim(self, instance: InstanceEntity, display: int) -> bool:
+        """
+        Allocate a specific display to an instance, which is how an instance that is still running
+        since before the server started keeps its display
+        Args:
+            instance: The instance to allocate the display to
+            display: The display the instance uses
+
+        Returns:
+            Whether the display was free or allocated to the instance already
+        """
+        if self._displays.get(instance.uid) == display:
+            return True
+        if self._used & (1 << display):
+            self._logger.warning(
+                "Display %s of instance %s is in use by another instance", display, instance.name
+            )
+            return False
+        self.release(instance.uid)
+        self._used |= 1 << display
+        self._displays[instance.uid] = display
+        return True
+
+    def release(self, uid: UniqueIdentifier):
+        display = self._displays.pop(uid, None)
+        if display is not None:
+            self._used &= ~(1 << display)
+
+    async def _on_instance_state(self, uid: UniqueIdentifier, state: InstanceState):
+        # A restarted process keeps the display it is started with
+        if state == InstanceState.STOPPED and not self._runtime.supervisor_service.active(uid):
+            self.release(uid)
@@ -0,0 +1,561 @@
+import abc
+import asyncio
+import bz2
+import dataclasses
+import lzma
+import math
+import os
+import pathlib
+import struct
+import typing
+import urllib.parse
+import zlib
+
+import aiofiles
+import aiofiles.threadpool.binary
+import httpx
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service
+from kaso_mashin.common import qcow2
+from kaso_mashin.common.entities import TaskEntity
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Payloads are written in buffers of this size by default
+DEFAULT_BUFFER_SIZE = 8388608
+
+# Sparse writes skip all-zero blocks of this size
+SPARSE_BLOCK_SIZE = 65536
+
+# Decompressed output is produced in pieces of at most this size, however well the input compresses
+DECOMPRESS_PIECE_SIZE = 1048576
+
+
+class DownloadException(KasoMashinException):
+    """
+    Exception for download-related issues
+    """
+
+    pass
+
+
+@dataclasses.dataclass
+class DownloadResult:
+    """
+    Outcome of a download
+    """
+
+    size: int = dataclasses.field(default=0)
+    etag: str | None = dataclasses.field(default=None)
+    last_modified: str | None = dataclasses.field(default=None)
+    not_modified: bool = dataclasses.field(default=False)
+
+
+class DownloadStage(abc.ABC):
+    """
+    A streaming transformation applied to the bytes received from a download
+    """
+
+    @abc.abstractmethod
+    def feed(self, data: bytes) -> typing.Iterator[bytes]:
+        pass
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class DecompressStage(DownloadStage):
+    """
+    Incremental decompression of a stream that may consist of multiple concatenated members
+    """
+
+    def __init__(
+        self, factory: typing.Callable[[], typing.Any], piece_size: int = DECOMPRESS_PIECE_SIZE
+    ):
+        self._factory = factory
+        self._piece_size = piece_size
+        self._decompressor = factory()
+        self._fed = False
+
+    def feed(self, data: bytes) -> typing.Iterator[bytes]:
+        while data:
+            self._fed = True
+            yield from self._decompress(data)
+            if not getattr(self._decompressor, "eof", False):
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._factory()
+            self._fed = False
+
+    def _decompress(self, data: bytes) -> typing.Iterator[bytes]:
+        """
+        Decompress the input of the current member in pieces of bounded size. A chunk of highly
+        compressed input, such as the long zero runs of a raw disk image, would otherwise expand
+        into a single bytes object of gigabytes.
+        """
+        decompressor = self._decompressor
+        if not hasattr(decompressor, "needs_input") and not hasattr(
+            decompressor, "unconsumed_tail"
+        ):
+            # zstandard does not bound the output of its decompression objects
+            yield decompressor.decompress(data)
+            return
+        while True:
+            piece = decompressor.decompress(data, self._piece_size)
+            if piece:
+                yield piece
+            if decompressor.eof:
+                return
+            if hasattr(decompressor, "needs_input"):
+                # lzma and bz2 buffer the input they did not decompress yet
+                if decompressor.needs_input:
+                    return
+                data = b""
+            else:
+                # zlib hands back the input it did not decompress yet
+                data = decompressor.unconsumed_tail
+                if not data and len(piece) < self._piece_size:
+                    return
+
+    def flush(self) -> bytes:
+        if not self._fed:
+            return b""
+        tail = self._decompressor.flush() if hasattr(self._decompressor, "flush") else b""
+        if not getattr(self._decompressor, "eof", True):
+            raise DownloadException(status=502, msg="The compressed stream is truncated")
+        return tail
+
+
+DECOMPRESSORS: typing.Dict[str, typing.Callable[[], typing.Any]] = {
+    ".xz": lzma.LZMADecompressor,
+    ".gz": lambda: zlib.decompressobj(wbits=zlib.MAX_WBITS | 32),
+    ".bz2": bz2.BZ2Decompressor,
+}
+if zstandard is not None:
+    DECOMPRESSORS[".zst"] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+
+class ImageSink(abc.ABC):
+    """
+    The final stage of a download, persisting the payload at a path
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._path = path
+        self._file: aiofiles.threadpool.binary.AsyncBufferedIOBase | None = None
+        self._size = 0
+
+    @property
+    def file(self) -> aiofiles.threadpool.binary.AsyncBufferedIOBase:
+        if self._file is None:
+            raise DownloadException(status=500, msg=f"The image at {self._path} is not open")
+        return self._file
+
+    async def open(self):
+        self._file = await aiofiles.open(self._path, mode="wb")
+
+    @abc.abstractmethod
+    async def write(self, data: bytes):
+        pass
+
+    async def close(self) -> int:
+        """
+        Finish writing the payload
+        Returns:
+            The number of payload bytes received
+        """
+        await self.file.close()
+        return self._size
+
+    async def abort(self):
+        if self._file is not None:
+            await self._file.close()
+        self._path.unlink(missing_ok=True)
+
+
+class FileSink(ImageSink):
+    """
+    Writes the payload verbatim. Writes are collected into large buffers which are handed to a
+    worker thread as a whole. The file is preallocated when the size of the payload is known,
+    otherwise sparse writes skip all-zero blocks so raw images only occupy the space they use.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        size: int | None = None,
+        sparse: bool = False,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ):
+        super().__init__(path)
+        self._expected = size
+        self._sparse = sparse
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._fd: int | None = None
+        self._zero = bytes(SPARSE_BLOCK_SIZE)
+
+    @property
+    def fd(self) -> int:
+        if self._fd is None:
+            raise DownloadException(status=500, msg=f"The image at {self._path} is not open")
+        return self._fd
+
+    async def open(self):
+        self._fd = await asyncio.to_thread(
+            os.open, self._path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+        )
+        if self._expected and hasattr(os, "posix_fallocate"):
+            try:
+                await asyncio.to_thread(os.posix_fallocate, self._fd, 0, self._expected)
+            except OSError:
+                # Not all filesystems support preallocation, the file simply grows as it is written
+                pass
+
+    async def write(self, data: bytes):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        buffer, offset = bytes(self._buffer), self._size
+        self._buffer = bytearray()
+        self._size += len(buffer)
+        await asyncio.to_thread(self._write_at, buffer, offset)
+
+    def _write_at(self, buffer: bytes, offset: int):
+        fd = self.fd
+        if not self._sparse:
+            os.pwrite(fd, buffer, offset)
+            return
+        view = memoryview(buffer)
+        start = 0
+        for block in range(0, len(buffer), SPARSE_BLOCK_SIZE):
+            if buffer[block : block + SPARSE_BLOCK_SIZE] != self._zero[: len(buffer) - block]:
+                continue
+            if block > start:
+                os.pwrite(fd, view[start:block], offset + start)
+            start = block + SPARSE_BLOCK_SIZE
+        if start < len(buffer):
+            os.pwrite(fd, view[start:], offset + start)
+        view.release()
+
+    async def close(self) -> int:
+        await self._flush()
+        # Trailing zero blocks were skipped, so the file is sized explicitly
+        await asyncio.to_thread(os.ftruncate, self.fd, self._size)
+        await asyncio.to_thread(os.close, self.fd)
+        self._fd = None
+        return self._size
+
+    async def abort(self):
+        if self._fd is not None:
+            await asyncio.to_thread(os.close, self._fd)
+            self._fd = None
+        self._path.unlink(missing_ok=True)
+
+
+class QCoW2Sink(ImageSink):
+    """
+    Converts a raw payload into a QCoW2 image while it is streamed.
+    Data clusters are appended as they arrive, all-zero clusters are left unallocated and the
+    metadata is written behind the data once the payload is complete.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        cluster_bits: int = qcow2.QCOW2_DEFAULT_CLUSTER_BITS,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ):
+        super().__init__(path)
+        self._buffer_size = buffer_size
+        self._cluster_bits = cluster_bits
+        self._cluster_size = 1 << cluster_bits
+        self._zero = bytes(self._cluster_size)
+        self._pending = bytearray()
+        self._guest_clusters = 0
+        self._next_offset = self._cluster_size
+        self._mapping: typing.Dict[int, int] = {}
+
+    async def open(self):
+        await super().open()
+        await self.file.write(self._zero)
+
+    async def write(self, data: bytes):
+        self._size += len(data)
+        self._pending += data
+        if len(self._pending) >= self._buffer_size:
+            await self._write_clusters(
+                len(self._pending) // self._cluster_size * self._cluster_size
+            )
+
+    async def _write_clusters(self, length: int):
+        if length == 0:
+            return
+        out = bytearray()
+        for offset in range(0, length, self._cluster_size):
+            # Comparing slices rather than memoryviews keeps the zero test a plain memcmp
+            cluster = self._pending[offset : offset + self._cluster_size]
+            if cluster != self._zero:
+                self._mapping[self._guest_clusters] = self._next_offset + len(out)
+                out += cluster
+            self._guest_clusters += 1
+        del self._pending[:length]
+        if out:
+            await self.file.write(out)
+            self._next_offset += len(out)
+
+    async def close(self) -> int:
+        if self._pending:
+            self._pending += bytes(-len(self._pending) % self._cluster_size)
+            await self._write_clusters(len(self._pending))
+        virtual_size = math.ceil(self._size / 512) * 512
+        l2_size = self._cluster_size // 8
+        l1_size = qcow2.l1_entries(virtual_size, self._cluster_bits)
+        l2_tables: typing.Dict[int, bytearray] = {}
+        for guest, host in self._mapping.items():
+            table = l2_tables.setdefault(guest // l2_size, bytearray(self._cluster_size))
+            struct.pack_into(">Q", table, (guest % l2_size) * 8, host | qcow2.QCOW2_OFLAG_COPIED)
+        l1 = bytearray(math.ceil(l1_size * 8 / self._cluster_size) * self._cluster_size)
+        metadata = bytearray()
+        for index in sorted(l2_tables):
+            struct.pack_into(
+                ">Q", l1, index * 8, (self._next_offset + len(metadata)) | qcow2.QCOW2_OFLAG_COPIED
+            )
+            metadata += l2_tables[index]
+        l1_offset = self._next_offset + len(metadata)
+        metadata += l1
+        clusters = (self._next_offset + len(metadata)) // self._cluster_size
+        blocks, table_clusters = qcow2.refcount_layout(clusters, self._cluster_bits)
+        refcount_table_offset = clusters * self._cluster_size
+        refcount_table, refcount_blocks = qcow2.pack_refcounts(
+            refcount_block_offset=refcount_table_offset + table_clusters * self._cluster_size,
+            blocks=blocks,
+            table_clusters=table_clusters,
+            clusters=clusters + blocks + table_clusters,
+            cluster_bits=self._cluster_bits,
+        )
+        await self.file.write(metadata + refcount_table + refcount_blocks)
+        await self.file.seek(0)
+        await self.file.write(
+            qcow2.pack_header(
+                virtual_size=virtual_size,
+                l1_size=l1_size,
+                l1_table_offset=l1_offset,
+                refcount_table_offset=refcount_table_offset,
+                refcount_table_clusters=table_clusters,
+                cluster_bits=self._cluster_bits,
+            )
+        )
+        return await super().close()
+
+
+class DownloadService(Service):
+    """
+    Streams downloads through a pipeline of decompression and conversion stages straight to disk
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._stages: typing.Dict[str, typing.Callable[[], typing.Any]] = dict(DECOMPRESSORS)
+        self._logger.info("Started download service")
+
+    def register_decompressor(self, suffix: str, factory: typing.Callable[[], typing.Any]):
+        """
+        Register an additional incremental decompressor
+        Args:
+            suffix: The URL suffix the decompressor handles, e.g. '.lz4'
+            factory: A callable producing an object with decompress(), eof and unused_data
+        """
+        self._stages[suffix] = factory
+
+    def stage_for(self, url: str) -> DownloadStage | None:
+        """
+        Determine the decompression stage for a URL based on its suffix
+        Args:
+            url: The URL to download
+
+        Returns:
+            A decompression stage or None if the URL does not point to a compressed file
+        """
+        suffix = pathlib.PurePosixPath(urllib.parse.urlparse(url).path).suffix
+        if suffix == ".zst" and suffix not in self._stages:
+            raise DownloadException(
+                status=400, msg="The zstandard package is required to download .zst images"
+            )
+        if suffix not in self._stages:
+            return None
+        return DecompressStage(self._stages[suffix])
+
+    @staticmethod
+    def sink_for(
+        path: pathlib.Path,
+        head: bytes,
+        convert_to_qcow2: bool,
+        size: int | None = None,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+    ) -> ImageSink:
+        """
+        Pick the sink for a payload based on its leading bytes. QCoW2 payloads are dense and are
+        preallocated if their size is known, raw payloads are kept sparse.
+        Args:
+            path: The path to write the payload to
+            head: The leading bytes of the (decompressed) payload
+            convert_to_qcow2: Whether payloads that are not QCoW2 images are converted
+            size: The size of the payload if it is known in advance
+            buffer_size: The number of bytes to collect before writing them out
+
+        Returns:
+            The sink to write the payload into
+        """
+        if qcow2.is_qcow2(head):
+            return FileSink(path, size=size, buffer_size=buffer_size)
+        if convert_to_qcow2:
+            return QCoW2Sink(path, buffer_size=buffer_size)
+        return FileSink(path, sparse=True, buffer_size=buffer_size)
+
+    async def download(
+        self,
+        url: str,
+        path: pathlib.Path,
+        task: TaskEntity | None = None,
+        convert_to_qcow2: bool = False,
+        chunk_size: int | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        rate_limit: int = 0,
+        low_priority: bool = False,
+    ) -> DownloadResult:
+        """
+        Download a URL to a path, decompressing and converting the payload on the fly
+        Args:
+            url: The URL to download from
+            path: The path to store the payload at
+            task: An optional task to report progress to
+            convert_to_qcow2: Whether to convert payloads that are not QCoW2 images to QCoW2
+            chunk_size: The size of chunks to read from the network, defaults to the configured size
+            etag: The entity tag of a previous download to make the request conditional
+            last_modified: The Last-Modified header of a previous download to make the request conditional
+            rate_limit: An optional limit of bytes per second for this download, 0 for no limit
+            low_priority: Whether the download yields its bandwidth to all other downloads
+
+        Returns:
+            The download result, which may indicate that the payload was not modified
+        """
+        stage = self.stage_for(url)
+        chunk_size = chunk_size or self._runtime.config.download_chunk_size
+        buffer_size = self._runtime.config.download_buffer_size
+        sink: ImageSink | None = None
+        head = b""
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            async with (
+                self._runtime.bandwidth_service.transfer(
+                    name=url, rate=rate_limit, low_priority=low_priority
+                ) as transfer,
+                httpx.AsyncClient(follow_redirects=True, timeout=60) as client,
+                client.stream("GET", url=url, headers=headers) as resp,
+            ):
+                if resp.status_code == 304:
+                    return DownloadResult(etag=etag, last_modified=last_modified, not_modified=True)
+                if resp.status_code != 200:
+                    raise DownloadException(
+                        status=502, msg=f"Download from {url} failed with status {resp.status_code}"
+                    )
+                result = DownloadResult(
+                    etag=resp.headers.get("etag"), last_modified=resp.headers.get("last-modified")
+                )
+                total = int(resp.headers.get("content-length", 0))
+                # The payload size is only known up front when nothing transforms the stream
+                size = (
+                    total
+                    if stage is None and resp.headers.get("content-encoding") in (None, "identity")
+                    else None
+                )
+                received, reported = 0, -1
+                async for chunk in resp.aiter_bytes(chunk_size=chunk_size):
+                    received += len(chunk)
+                    await transfer.throttle(len(chunk))
+                    for data in stage.feed(chunk) if stage is not None else (chunk,):
+                        if sink is None:
+                            head += data
+                            if len(head) < len(qcow2.QCOW2_MAGIC):
+                                continue
+                            sink = self.sink_for(path, head, convert_to_qcow2, size, buffer_size)
+                            await sink.open()
+                            data, head = head, b""
+                        if data:
+                            await sink.write(data)
+                    if task is not None and total > 0:
+                        completed = min(int(received / total * 100), 99)
+                        if completed != reported:
+                            reported = completed
+                            await task.progress(
+                                percent_complete=completed, msg=f"Downloaded {completed}%"
+                            )
+                tail = stage.flush() if stage is not None else b""
+            if sink is None:
+                sink = self.sink_for(path, head, convert_to_qcow2, buffer_size=buffer_size)
+                await sink.open()
+                tail = head + tail
+            if tail:
+                await sink.write(tail)
+            result.size = await sink.close()
+            return result
+        except BaseException:
+            if sink is not None:
+                await sink.abort()
+            raise
+
+    async def download_from_peers(
+        self, url: str, peers: typing.List[str], path: pathlib.Path, **kwargs
+    ) -> DownloadResult | None:
+        """
+        Download an image from the first peer server that already holds a copy of it. Peers
+        serve the image as they stored it, so it needs no further decompression.
+        Args:
+            url: The origin URL of the image
+            peers: Base URLs of the peer servers to try in order
+            path: The path to store the payload at
+            **kwargs: Further arguments for the download
+
+        Returns:
+            The download result carrying the validators of the origin, or None if no peer
+            could provide the image
+        """
+        for peer in peers:
+            base = peer.rstrip("/")
+            try:
+                async with httpx.AsyncClient(follow_redirects=True, timeout=10) as client:
+                    resp = await client.get(f"{base}/api/images/")
+                    resp.raise_for_status()
+                    entries = resp.json().get("entries", [])
+            except (httpx.HTTPError, ValueError) as e:
+                self._logger.warning("Peer %s is not available: %s", peer, e)
+                continue
+            match = next((entry for entry in entries if entry.get("url") == url), None)
+            if match is None:
+                continue
+            try:
+                result = await self.download(
+                    url=f"{base}/api/images/{match['uid']}/content", path=path, **kwargs
+                )
+            except (DownloadException, httpx.HTTPError) as e:
+                self._logger.warning("Failed to download %s from peer %s: %s", url, peer, e)
+                continue
+            result.etag = match.get("etag")
+            result.last_modified = match.get("last_modified")
+            self._logger.info("Downloaded %s from peer %s", url, peer)
+            return result
+        return None
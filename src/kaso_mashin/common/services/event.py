@@ -10,7 +10,14 @@ from kaso_mashin.common.base_types import Service
 
 
 class EventService(Service, Events):
-    __events__ = ("on_task_create", "on_task_progress", "on_task_done", "on_task_fail")
+    __events__ = (
+        "on_task_create",
+        "on_task_progress",
+        "on_task_done",
+        "on_task_fail",
+        "on_instance_state",
+        "on_instance_ready",
+    )
 
     def __init__(self, runtime: "Runtime"):
         super().__init__(runtime=runtime)
@@ -0,0 +1,316 @@
+import asyncio
+import datetime
+import enum
+import os
+import pathlib
+import shutil
+import struct
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service, EntitySchema, UniqueIdentifier
+from kaso_mashin.common import qcow2
+from kaso_mashin.common.services.disk_pool import DISK_POOL_DIRECTORY
+
+# Name of the directory below the images and instances paths holding quarantined orphans
+QUARANTINE_DIRECTORY = ".quarantine"
+
+# Number of directory entries to scan before yielding to the event loop
+SCAN_BATCH_SIZE = 64
+
+FileKey = typing.Tuple[int, int, int]
+
+
+class GCMode(enum.StrEnum):
+    REPORT = "report"
+    QUARANTINE = "quarantine"
+    DELETE = "delete"
+
+
+class GCAction(enum.StrEnum):
+    REPORTED = "reported"
+    QUARANTINED = "quarantined"
+    DELETED = "deleted"
+    FAILED = "failed"
+
+
+class GCOrphanSchema(EntitySchema):
+    """
+    Schema for a file or directory no entity refers to
+    """
+
+    path: pathlib.Path = pydantic.Field(
+        description="Path of the orphan", examples=["/var/kaso/instances/failed-instance"]
+    )
+    size: int = pydantic.Field(description="Bytes the orphan occupies on the local filesystem")
+    action: GCAction = pydantic.Field(
+        description="What was done with the orphan", examples=[GCAction.QUARANTINED]
+    )
+
+
+class GCDanglingSchema(EntitySchema):
+    """
+    Schema for an entity whose file or directory no longer exists
+    """
+
+    uid: UniqueIdentifier = pydantic.Field(
+        description="The unique identifier of the entity",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    relation: str = pydantic.Field(description="The kind of entity", examples=["disks"])
+    path: pathlib.Path = pydantic.Field(
+        description="The path the entity refers to", examples=["/var/kaso/instances/root.qcow2"]
+    )
+
+
+class GCReportSchema(EntitySchema):
+    """
+    Schema for the outcome of a garbage collection
+    """
+
+    mode: GCMode = pydantic.Field(description="How orphans were handled", examples=[GCMode.REPORT])
+    started: datetime.datetime = pydantic.Field(description="When the collection started")
+    duration: float = pydantic.Field(description="Seconds the collection took")
+    scanned: int = pydantic.Field(description="Number of files and directories scanned")
+    cache_hits: int = pydantic.Field(
+        description="Number of files whose backing file was known from a previous scan"
+    )
+    orphans: typing.List[GCOrphanSchema] = pydantic.Field(
+        description="Files and directories no entity refers to", default_factory=list
+    )
+    dangling: typing.List[GCDanglingSchema] = pydantic.Field(
+        description="Entities whose file or directory no longer exists", default_factory=list
+    )
+    quarantined: int = pydantic.Field(description="Bytes moved into quarantine", default=0)
+    reclaimed: int = pydantic.Field(description="Bytes freed on the filesystem", default=0)
+
+
+class GCService(Service):
+    """
+    Reconciles the files below the images and instances paths with the entities referring to
+    them. Failed creations can leave files without an entity behind, which are reported,
+    quarantined or deleted once they are older than the grace period. Files that disks are
+    layered on are kept even if no entity refers to them directly. The backing file of each
+    disk file is cached by inode and modification time, so repeated scans only read the headers
+    of files that changed.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._backing: typing.Dict[pathlib.Path, typing.Tuple[FileKey, pathlib.Path | None]] = {}
+        self._report: GCReportSchema | None = None
+        self._logger.info("Started garbage collection service")
+
+    @property
+    def roots(self) -> typing.List[pathlib.Path]:
+        return [self._runtime.config.images_path, self._runtime.config.instances_path]
+
+    @property
+    def report(self) -> GCReportSchema | None:
+        return self._report
+
+    async def start(self):
+        if self._task is not None or self._runtime.config.gc_interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run(), name="gc")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._runtime.config.gc_interval)
+            try:
+                await self.collect()
+            except (KasoMashinException, OSError) as e:
+                self._logger.warning("Failed to collect garbage: %s", e)
+
+    @staticmethod
+    def _normalise(path: pathlib.Path) -> pathlib.Path:
+        return pathlib.Path(os.path.abspath(path))
+
+    def _backing_file(self, path: pathlib.Path) -> typing.Tuple[pathlib.Path | None, bool]:
+        """
+        The file a disk file is directly layered on, read from its header unless the file is
+        unchanged since the last scan
+
+        Returns:
+            The backing file if there is one and whether it was known from a previous scan
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._backing.pop(path, None)
+            return None, False
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._backing.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1], True
+        try:
+            backing = qcow2.inspect(path).backing_path
+        except (OSError, ValueError, struct.error):
+            backing = None
+        backing = self._normalise(backing) if backing is not None else None
+        self._backing[path] = (key, backing)
+        return backing, False
+
+    @staticmethod
+    def _size(path: pathlib.Path) -> int:
+        if path.is_symlink() or not path.is_dir():
+            return path.lstat().st_blocks * 512
+        size = 0
+        for directory, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(directory, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return size
+
+    @staticmethod
+    def _remove(path: pathlib.Path):
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+    async def collect(self, mode: GCMode | None = None) -> GCReportSchema:
+        """
+        Scan the images and instances paths for orphans and handle them
+        Args:
+            mode: How to handle orphans, defaults to the configured mode
+
+        Returns:
+            The report of the collection
+        """
+        mode = GCMode(mode or self._runtime.config.gc_mode)
+        async with self._lock:
+            report = GCReportSchema(
+                mode=mode,
+                started=datetime.datetime.now(),
+                duration=0.0,
+                scanned=0,
+                cache_hits=0,
+            )
+            started = time.monotonic()
+            referenced = await self._referenced(report)
+            grace = time.time() - self._runtime.config.gc_grace_period
+            for root in self.roots:
+                if not root.exists():
+                    continue
+                for count, entry in enumerate(os.scandir(root)):
+                    if count % SCAN_BATCH_SIZE == 0:
+                        await asyncio.sleep(0)
+                    report.scanned += 1
+                    path = self._normalise(pathlib.Path(entry.path))
+                    if entry.name in (QUARANTINE_DIRECTORY, DISK_POOL_DIRECTORY):
+                        continue
+                    if path in referenced or entry.stat(follow_symlinks=False).st_mtime > grace:
+                        continue
+                    report.orphans.append(self._handle(root, path, mode, report))
+                if mode != GCMode.REPORT:
+                    self._purge(root, report)
+            report.duration = time.monotonic() - started
+        self._logger.info(
+            "Collected %s orphans in %.3fs, %s bytes quarantined, %s bytes reclaimed",
+            len(report.orphans),
+            report.duration,
+            report.quarantined,
+            report.reclaimed,
+        )
+        self._report = report
+        return report
+
+    async def _referenced(self, report: GCReportSchema) -> typing.Set[pathlib.Path]:
+        """
+        Collect the paths entities refer to, the files disks are layered on and the directories
+        containing any of them. Entities whose path no longer exists are added to the report.
+        """
+        referenced: typing.Set[pathlib.Path] = set()
+        disk_files: typing.List[pathlib.Path] = []
+        for relation, repository in (
+            ("images", self._runtime.image_repository),
+            ("disks", self._runtime.disk_repository),
+            ("instances", self._runtime.instance_repository),
+        ):
+            for entity in await repository.list():
+                path = self._normalise(entity.path)
+                referenced.add(path)
+                if relation == "disks":
+                    disk_files.append(path)
+                if not path.exists():
+                    report.dangling.append(
+                        GCDanglingSchema(uid=entity.uid, relation=relation, path=path)
+                    )
+        pool = self._runtime.config.instances_path / DISK_POOL_DIRECTORY
+        if pool.exists():
+            disk_files.extend(self._normalise(candidate) for candidate in pool.iterdir())
+        visited: typing.Set[pathlib.Path] = set()
+        for path in disk_files:
+            for _ in range(qcow2.QCOW2_MAX_CHAIN_DEPTH):
+                backing, cached = self._backing_file(path)
+                visited.add(path)
+                report.cache_hits += 1 if cached else 0
+                if backing is None or backing in visited:
+                    break
+                referenced.add(backing)
+                path = backing
+        # Forget about files that went away since the last scan
+        self._backing = {path: cached for path, cached in self._backing.items() if path in visited}
+        for path in list(referenced):
+            referenced.update(path.parents)
+        return referenced
+
+    def _handle(
+        self, root: pathlib.Path, path: pathlib.Path, mode: GCMode, report: GCReportSchema
+    ) -> GCOrphanSchema:
+        size = self._size(path)
+        try:
+            if mode == GCMode.QUARANTINE:
+                quarantine = root / QUARANTINE_DIRECTORY
+                quarantine.mkdir(exist_ok=True)
+                os.rename(path, quarantine / f"{int(time.time())}-{path.name}")
+                report.quarantined += size
+                action = GCAction.QUARANTINED
+            elif mode == GCMode.DELETE:
+                self._remove(path)
+                report.reclaimed += size
+                action = GCAction.DELETED
+            else:
+                action = GCAction.REPORTED
+        except OSError as e:
+            self._logger.warning("Failed to collect orphan %s: %s", path, e)
+            action = GCAction.FAILED
+        self._logger.info("Orphan %s of %s bytes %s", path, size, action)
+        return GCOrphanSchema(path=path, size=size, action=action)
+
+    def _purge(self, root: pathlib.Path, report: GCReportSchema):
+        """
+        Delete quarantined orphans that were kept for longer than the retention period
+        """
+        quarantine = root / QUARANTINE_DIRECTORY
+        if not quarantine.exists():
+            return
+        retention = time.time() - self._runtime.config.gc_quarantine_retention
+        for path in quarantine.iterdir():
+            quarantined, _, _ = path.name.partition("-")
+            if quarantined.isdigit() and int(quarantined) > retention:
+                continue
+            try:
+                size = self._size(path)
+                self._remove(path)
+                report.reclaimed += size
+            except OSError as e:
+                self._logger.warning("Failed to purge quarantined orphan %s: %s", path, e)
@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+import typing
+
+from kaso_mashin.common.base_types import (
+    Service,
+    UniqueIdentifier,
+    EntityNotFoundException,
+)
+from kaso_mashin.common.entities import InstanceEntity, InstanceState
+
+# Seconds a guest is given to send its check-in
+PHONE_HOME_REQUEST_TIMEOUT = 10
+
+# The largest check-in request that is read, in bytes
+PHONE_HOME_REQUEST_LIMIT = 8192
+
+
+@dataclasses.dataclass
+class CheckIn:
+    """
+    The check-in of a guest that finished booting
+    """
+
+    ready: datetime.datetime
+    boot_seconds: float | None
+
+
+class PhoneHomeService(Service):
+    """
+    Listens for guests that phone home once they finished booting. The bootstrap of an instance
+    has the guest request the phone home URL followed by its MAC address or the uid of its
+    instance, which is all the guest needs to know about itself. The check-in marks the instance
+    ready until it is stopped or restarted and records how long it took to boot.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._server: asyncio.Server | None = None
+        self._check_ins: typing.Dict[UniqueIdentifier, CheckIn] = {}
+        self._waiters: typing.Dict[UniqueIdentifier, asyncio.Event] = collections.defaultdict(
+            asyncio.Event
+        )
+        runtime.event_service.on_instance_state += self._on_instance_state
+        self._logger.info("Started phone home service")
+
+    @property
+    def port(self) -> int | None:
+        """
+        The port the service listens on, None while it is not listening
+        """
+        if self._server is None or not self._server.sockets:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    def url(self, host: str) -> str:
+        """
+        The URL guests phone home to, given the address of the host as seen by the guest
+        """
+        return f"http://{host}:{self._runtime.config.default_phone_home_port}"
+
+    async def start(self):
+        if self._server is not None or self._runtime.config.default_phone_home_port <= 0:
+            return
+        try:
+            self._server = await asyncio.start_server(
+                self._handle,
+                host=self._runtime.config.default_phone_home_host,
+                port=self._runtime.config.default_phone_home_port,
+                limit=PHONE_HOME_REQUEST_LIMIT,
+            )
+        except OSError as e:
+            self._logger.warning(
+                "Instances cannot phone home on %s port %s: %s",
+                self._runtime.config.default_phone_home_host,
+                self._runtime.config.default_phone_home_port,
+                e,
+            )
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    def ready(self, instance: InstanceEntity) -> CheckIn | None:
+        """
+        The check-in of an instance since it was last started, None if it has not checked in
+        """
+        return self._check_ins.get(instance.uid)
+
+    async def wait_ready(self, instance: InstanceEntity, timeout: float) -> bool:
+        """
+        Wait for an instance to phone home
+        Args:
+            instance: The instance to wait for
+            timeout: Seconds to wait at most
+
+        Returns:
+            Whether the instance phoned home in time
+        """
+        if instance.uid in self._check_ins:
+            return True
+        try:
+            await asyncio.wait_for(self._waiters[instance.uid].wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return instance.uid in self._check_ins
+
+    async def _on_instance_state(self, uid: UniqueIdentifier, state: InstanceState):
+        # A guest that is restarted or stopped has to boot again before it is ready
+        if state in (InstanceState.STARTING, InstanceState.STOPPED):
+            self._check_ins.pop(uid, None)
+
+    async def check_in(self, identifier: str) -> InstanceEntity | None:
+        """
+        Record that a guest finished booting
+        Args:
+            identifier: The MAC address of the guest or the uid of its instance
+
+        Returns:
+            The instance that checked in, None if no instance matches the identifier
+        """
+        repository = self._runtime.instance_repository
+        try:
+            try:
+                instance = await repository.get_by_uid(UniqueIdentifier(identifier))
+            except ValueError:
+                instance = await repository.get_by_mac(identifier)
+        except EntityNotFoundException:
+            instance = None
+        if instance is None:
+            self._logger.warning("Unknown instance %s phoned home", identifier)
+            return None
+        now = datetime.datetime.now()
+        process = self._runtime.supervisor_service.get(instance)
+        boot_seconds = (now - process.started).total_seconds() if process is not None else None
+        self._check_ins[instance.uid] = CheckIn(ready=now, boot_seconds=boot_seconds)
+        waiter = self._waiters.pop(instance.uid, None)
+        if waiter is not None:
+            waiter.set()
+        self._logger.info("Instance %s is ready after %ss", instance.name, boot_seconds)
+        await self._runtime.event_service.on_instance_ready(instance.uid, boot_seconds)
+        return instance
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Answer a check-in, which is a plain HTTP request for the phone home URL followed by
+        the identifier of the guest. The request body is ignored.
+        """
+        try:
+            async with asyncio.timeout(PHONE_HOME_REQUEST_TIMEOUT):
+                request = await reader.readuntil(b"\r\n\r\n")
+            method, target, *_ = request.decode("latin-1").split("\r\n", 1)[0].split(" ")
+            if method not in ("GET", "POST", "PUT"):
+                status = "405 Method Not Allowed"
+            elif await self.check_in(target.strip("/").split("?", 1)[0]) is None:
+                status = "404 Not Found"
+            else:
+                status = "204 No Content"
+            writer.write(f"HTTP/1.1 {status}\r\nConnection: close\r\n\r\n".encode("latin-1"))
+            await writer.drain()
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ValueError,
+            OSError,
+        ) as e:
+            self._logger.debug("Ignoring a malformed check-in: %s", e)
+        finally:
+            writer.close()
@@ -0,0 +1,96 @@
+import asyncio
+import typing
+
+import httpx
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service
+from kaso_mashin.common.config import PredefinedImageSchema
+from kaso_mashin.common.entities import ImageEntity, TaskEntity
+from kaso_mashin.common.entities.tasks import TaskRelation
+
+
+class PrefetchService(Service):
+    """
+    Keeps predefined images marked for prefetching downloaded and refreshed in the background.
+    Prefetching works through one image at a time at low priority, so it yields to interactive
+    downloads.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._task: asyncio.Task | None = None
+        self._logger.info("Started prefetch service")
+
+    @property
+    def predefined_images(self) -> typing.List[PredefinedImageSchema]:
+        return [
+            PredefinedImageSchema.model_validate(image)
+            for image in self._runtime.config.predefined_images
+        ]
+
+    async def start(self):
+        if self._task is not None:
+            return
+        if not any(image.prefetch for image in self.predefined_images):
+            self._logger.debug("No predefined images are marked for prefetching")
+            return
+        self._task = asyncio.create_task(self._run(), name="prefetch")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await self.prefetch()
+            await asyncio.sleep(self._runtime.config.prefetch_interval)
+
+    async def prefetch(self):
+        """
+        Download each predefined image marked for prefetching that is not yet present and
+        conditionally refresh those that are
+        """
+        for predefined in filter(lambda image: image.prefetch, self.predefined_images):
+            path = ImageEntity.path_for(self._runtime.config.images_path, predefined.name)
+            try:
+                image = await self._runtime.image_repository.get_by_url(predefined.url)
+                if image is None:
+                    task = await TaskEntity.create(
+                        name=f"Prefetch image {predefined.name} from URL {predefined.url}",
+                        relation=TaskRelation.IMAGES,
+                        msg="Prefetching image",
+                    )
+                    await ImageEntity.create(
+                        task=task,
+                        user=self._runtime.owning_user,
+                        name=predefined.name,
+                        url=predefined.url,
+                        path=path,
+                        rate_limit=self._runtime.config.prefetch_rate_limit,
+                        low_priority=True,
+                    )
+                    self._logger.info("Prefetched image %s", predefined.name)
+                else:
+                    task = await TaskEntity.create(
+                        name=f"Refresh image {image.name} from URL {image.url}",
+                        relation=TaskRelation.IMAGES,
+                        msg="Refreshing image",
+                    )
+                    if await image.refresh(
+                        task=task,
+                        user=self._runtime.owning_user,
+                        path=path,
+                        rate_limit=self._runtime.config.prefetch_rate_limit,
+                        low_priority=True,
+                    ):
+                        self._logger.info("Refreshed image %s", image.name)
+            except (KasoMashinException, OSError, httpx.HTTPError) as e:
+                # A failure must not end prefetching, the image is tried again next interval
+                self._logger.warning("Failed to prefetch image %s: %s", predefined.name, e)
@@ -0,0 +1,199 @@
+import asyncio
+import contextlib
+import dataclasses
+import pathlib
+import re
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import Service, EntitySchema
+
+
+class ProcessException(KasoMashinException):
+    """
+    Exception for external commands that could not be run or did not succeed
+    """
+
+    pass
+
+
+@dataclasses.dataclass
+class ProcessResult:
+    """
+    Outcome of an external command
+    """
+
+    args: typing.List[str]
+    returncode: int
+    stdout: str = dataclasses.field(default="")
+    stderr: str = dataclasses.field(default="")
+    duration: float = dataclasses.field(default=0.0)
+
+
+class ProcessMetricsSchema(EntitySchema):
+    """
+    Schema for the timing metrics of an external command
+    """
+
+    command: str = pydantic.Field(description="The name of the command", examples=["qemu-img"])
+    count: int = pydantic.Field(description="Number of times the command was run", default=0)
+    failures: int = pydantic.Field(description="Number of runs that failed or timed out", default=0)
+    total_duration: float = pydantic.Field(
+        description="Seconds spent running the command in total", default=0.0
+    )
+    max_duration: float = pydantic.Field(
+        description="Seconds taken by the slowest run of the command", default=0.0
+    )
+
+
+class ProcessService(Service):
+    """
+    Runs external commands asynchronously, so the event loop keeps serving while they execute.
+    Short-lived commands are capped in concurrency, bounded by a timeout and have their output
+    captured for error messages. Long-running processes such as instances are spawned instead.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._semaphore = asyncio.Semaphore(runtime.config.process_concurrency)
+        self._metrics: typing.Dict[str, ProcessMetricsSchema] = {}
+        self._logger.info("Started process service")
+
+    @property
+    def metrics(self) -> typing.List[ProcessMetricsSchema]:
+        return list(self._metrics.values())
+
+    def _record(self, command: str, duration: float, failed: bool):
+        metrics = self._metrics.setdefault(command, ProcessMetricsSchema(command=command))
+        metrics.count += 1
+        metrics.failures += 1 if failed else 0
+        metrics.total_duration += duration
+        metrics.max_duration = max(metrics.max_duration, duration)
+
+    async def run(
+        self,
+        args: typing.Sequence[str | pathlib.Path],
+        timeout: float | None = None,
+        check: bool = True,
+        stdin: bytes | None = None,
+        on_output: typing.Callable[[str], typing.Awaitable[None]] | None = None,
+    ) -> ProcessResult:
+        """
+        Run an external command to completion. Cancelling the caller kills the command.
+        Args:
+            args: The command and its arguments
+            timeout: Seconds after which the command is killed, defaults to the configured timeout.
+                0 waits for the command indefinitely
+            check: Whether a non-zero exit code raises a ProcessException
+            stdin: Optional input for the command
+            on_output: Optional coroutine called with each line the command prints while it runs,
+                e.g. to follow progress
+
+        Returns:
+            The result of the command
+        """
+        argv = [str(arg) for arg in args]
+        command = pathlib.Path(argv[0]).name
+        timeout = self._runtime.config.process_timeout if timeout is None else timeout
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdin=(
+                        asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL
+                    ),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                self._record(command, time.monotonic() - started, failed=True)
+                raise ProcessException(status=500, msg=f"Failed to run {command}: {e}") from e
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    self._communicate(proc, stdin, on_output), timeout=timeout or None
+                )
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                # The process may have exited on its own since the timeout
+                with contextlib.suppress(ProcessLookupError):
+                    proc.kill()
+                await proc.wait()
+                self._record(command, time.monotonic() - started, failed=True)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise ProcessException(
+                    status=500, msg=f"{command} timed out after {timeout} seconds"
+                ) from e
+        result = ProcessResult(
+            args=argv,
+            # The process has exited, so this returns its exit code right away
+            returncode=await proc.wait(),
+            stdout=stdout.decode("utf-8", errors="replace"),
+            stderr=stderr.decode("utf-8", errors="replace"),
+            duration=time.monotonic() - started,
+        )
+        self._record(command, result.duration, failed=result.returncode != 0)
+        self._logger.debug(
+            "%s exited with %s after %.3fs", command, result.returncode, result.duration
+        )
+        if check and result.returncode != 0:
+            raise ProcessException(
+                status=500,
+                msg=f"{command} failed with exit code {result.returncode}: "
+                f"{result.stderr.strip() or result.stdout.strip()}",
+            )
+        return result
+
+    @staticmethod
+    async def _communicate(
+        proc: asyncio.subprocess.Process,
+        stdin: bytes | None,
+        on_output: typing.Callable[[str], typing.Awaitable[None]] | None,
+    ) -> typing.Tuple[bytes, bytes]:
+        if on_output is None:
+            return await proc.communicate(stdin)
+
+        async def read(stream: asyncio.StreamReader) -> bytes:
+            captured, pending = bytearray(), b""
+            while chunk := await stream.read(4096):
+                captured += chunk
+                *lines, pending = re.split(rb"[\r\n]", pending + chunk)
+                for line in filter(bytes.strip, lines):
+                    await on_output(line.decode("utf-8", errors="replace").strip())
+            if pending.strip():
+                await on_output(pending.decode("utf-8", errors="replace").strip())
+            return bytes(captured)
+
+        # The pipes exist since the process was created with them
+        assert proc.stdout is not None and proc.stderr is not None
+        if stdin is not None:
+            assert proc.stdin is not None
+            proc.stdin.write(stdin)
+            await proc.stdin.drain()
+            proc.stdin.close()
+        stdout, stderr, _ = await asyncio.gather(read(proc.stdout), read(proc.stderr), proc.wait())
+        return stdout, stderr
+
+    async def spawn(self, args: typing.Sequence[str | pathlib.Path]) -> asyncio.subprocess.Process:
+        """
+        Start a long-running process without waiting for it to complete. Spawned processes do
+        not count against the concurrency cap and their output is not captured.
+        Args:
+            args: The command and its arguments
+
+        Returns:
+            The running process
+        """
+        args = [str(arg) for arg in args]
+        command = pathlib.Path(args[0]).name
+        try:
+            proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL)
+        except OSError as e:
+            self._record(command, 0.0, failed=True)
+            raise ProcessException(status=500, msg=f"Failed to start {command}: {e}") from e
+        self._record(command, 0.0, failed=False)
+        self._logger.info("Started %s with pid %s", command, proc.pid)
+        return proc
@@ -1,18 +1,368 @@
-import subprocess
+import asyncio
+import collections
+import contextlib
+import fcntl
+import pathlib
+import typing
+
+import qemu.qmp
 
 from kaso_mashin import KasoMashinException
-from kaso_mashin.common import Service
+from kaso_mashin.common import Service, UniqueIdentifier
 from kaso_mashin.common.base_types import BinaryScale
-from kaso_mashin.common.entities import InstanceEntity, NetworkKind, BootstrapKind
+from kaso_mashin.common.entities import (
+    InstanceEntity,
+    InstanceState,
+    NetworkKind,
+    BootstrapKind,
+)
+
+# Name of the QMP socket below the instance path
+QMP_SOCKET = "qmp.sock"
+
+# Name of the socket below the instance path the serial console of the guest is attached to
+SERIAL_SOCKET = "serial.sock"
+
+# Name of the file below the instance path QEMU writes its pid to
+QEMU_PIDFILE = "qemu.pid"
+
+# Seconds to wait for QEMU to accept a QMP connection
+QMP_CONNECT_TIMEOUT = 5
+
+# Instance state after each QMP event
+QMP_EVENT_STATES = {
+    "SHUTDOWN": InstanceState.STOPPED,
+    "STOP": InstanceState.PAUSED,
+    "RESUME": InstanceState.STARTED,
+}
+
+
+class QMPException(KasoMashinException):
+    """
+    Exception for instances that cannot be controlled via QMP
+    """
+
+    pass
 
 
 class QEMUService(Service):
+    """
+    Starts instances and controls them via QMP. One connection per running instance is kept
+    open, which makes commands fast and lets QEMU report state changes as events rather than
+    having them polled.
+    """
 
     def __init__(self, runtime: "Runtime"):
         super().__init__(runtime)
+        self._clients: typing.Dict[UniqueIdentifier, qemu.qmp.QMPClient] = {}
+        self._watchers: typing.Dict[UniqueIdentifier, asyncio.Task] = {}
+        self._states: typing.Dict[UniqueIdentifier, InstanceState] = {}
+        self._locks: typing.Dict[UniqueIdentifier, asyncio.Lock] = collections.defaultdict(
+            asyncio.Lock
+        )
         self._logger.info("Started QEMU service")
 
-    def start_instance(self, instance: InstanceEntity) -> subprocess.Popen:
+    @staticmethod
+    def qmp_path(instance: InstanceEntity) -> pathlib.Path:
+        return instance.path / QMP_SOCKET
+
+    @staticmethod
+    def serial_path(instance: InstanceEntity) -> pathlib.Path:
+        return instance.path / SERIAL_SOCKET
+
+    @staticmethod
+    def pid_path(instance: InstanceEntity) -> pathlib.Path:
+        return instance.path / QEMU_PIDFILE
+
+    @staticmethod
+    def running_pid(instance: InstanceEntity) -> int | None:
+        """
+        The pid of the QEMU process of an instance, if it is running. QEMU holds a lock on its
+        pidfile for as long as it runs, so a pidfile left behind by a crashed process or a
+        reused pid is not mistaken for a running instance.
+        """
+        try:
+            with open(QEMUService.pid_path(instance), "r+") as f:
+                try:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return int(f.read().strip())
+                fcntl.lockf(f, fcntl.LOCK_UN)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    async def reattach(self) -> int:
+        """
+        Watch over the instances that are still running since before the server started
+
+        Returns:
+            The number of instances reattached to
+        """
+        try:
+            instances = await self._runtime.instance_repository.list()
+        except KasoMashinException as e:
+            self._logger.warning("Failed to list instances to reattach to: %s", e.msg)
+            return 0
+        reattached = 0
+        for instance in instances:
+            reattached += 1 if await self.reattach_instance(instance) else 0
+        self._logger.info("Reattached to %s running instances", reattached)
+        return reattached
+
+    async def reattach_instance(self, instance: InstanceEntity) -> bool:
+        """
+        Adopt the QEMU process of an instance if it is running and reconnect to its QMP socket.
+        Pidfiles and sockets left behind by an instance that no longer runs are removed.
+        Args:
+            instance: The instance to reattach to
+
+        Returns:
+            Whether the instance is running
+        """
+        supervisor = self._runtime.supervisor_service
+        if supervisor.supervises(instance):
+            return supervisor.state(instance) != InstanceState.STOPPED
+        pid = self.running_pid(instance)
+        if pid is None:
+            for stale in (
+                self.pid_path(instance),
+                self.qmp_path(instance),
+                self.serial_path(instance),
+            ):
+                stale.unlink(missing_ok=True)
+            # The instance stopped while nobody was watching
+            if instance.state != InstanceState.STOPPED:
+                await self._runtime.event_service.on_instance_state(
+                    instance.uid, InstanceState.STOPPED
+                )
+            return False
+        # The running QEMU process keeps the display it was started with
+        if instance.vnc_display is not None:
+            self._runtime.display_service.claim(instance, instance.vnc_display)
+        try:
+            args = self.instance_args(instance)
+        except KasoMashinException as e:
+            self._logger.warning("Not reattaching to instance %s: %s", instance.name, e.msg)
+            self._runtime.display_service.release(instance.uid)
+            return False
+        self._runtime.resource_service.reserve(instance)
+        await supervisor.adopt(instance, pid, args)
+        try:
+            await self.connect(instance)
+        except QMPException as e:
+            self._logger.warning(
+                "Instance %s cannot be controlled via QMP: %s", instance.name, e.msg
+            )
+        return True
+
+    def state(self, instance: InstanceEntity) -> InstanceState | None:
+        """
+        The state of an instance as last reported via QMP, or of its process while there is no
+        QMP connection. None if neither is known.
+        """
+        client = self._clients.get(instance.uid)
+        if client is not None and client.runstate == qemu.qmp.Runstate.RUNNING:
+            return self._states.get(instance.uid)
+        return self._runtime.supervisor_service.state(instance)
+
+    async def connect(self, instance: InstanceEntity) -> qemu.qmp.QMPClient:
+        """
+        The QMP connection of a running instance, which is established if there is none yet.
+        A freshly started instance is given until the connect timeout to create its socket.
+        Args:
+            instance: The instance to connect to
+
+        Returns:
+            The connected client
+
+        Raises:
+            QMPException if the instance does not accept QMP connections
+        """
+        async with self._locks[instance.uid]:
+            client = self._clients.get(instance.uid)
+            if client is not None and client.runstate == qemu.qmp.Runstate.RUNNING:
+                return client
+            await self._disconnect(instance.uid)
+            client = qemu.qmp.QMPClient(instance.name)
+            try:
+                async with asyncio.timeout(QMP_CONNECT_TIMEOUT):
+                    while not self.qmp_path(instance).exists():
+                        await asyncio.sleep(0.1)
+                    await client.connect(str(self.qmp_path(instance)))
+                status = await client.execute("query-status")
+            except (qemu.qmp.QMPError, OSError, asyncio.TimeoutError) as e:
+                await client.disconnect()
+                raise QMPException(
+                    status=500, msg=f"Failed to connect to QMP of instance {instance.name}: {e}"
+                ) from e
+            self._clients[instance.uid] = client
+            running = isinstance(status, dict) and status.get("running", False)
+            await self._set_state(
+                instance.uid, InstanceState.STARTED if running else InstanceState.PAUSED
+            )
+            self._watchers[instance.uid] = asyncio.create_task(
+                self._watch(instance.uid, client), name=f"qmp {instance.name}"
+            )
+            return client
+
+    async def _set_state(self, uid: UniqueIdentifier, state: InstanceState):
+        if self._states.get(uid) == state:
+            return
+        self._states[uid] = state
+        await self._runtime.event_service.on_instance_state(uid, state)
+
+    async def _watch(self, uid: UniqueIdentifier, client: qemu.qmp.QMPClient):
+        with client.listener(tuple(QMP_EVENT_STATES)) as listener:
+            async for event in listener:
+                await self._set_state(uid, QMP_EVENT_STATES[str(event["event"])])
+                self._logger.info("Instance %s is %s", client.name, self._states[uid])
+
+    async def _disconnect(self, uid: UniqueIdentifier):
+        watcher = self._watchers.pop(uid, None)
+        if watcher is not None:
+            watcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await watcher
+        client = self._clients.pop(uid, None)
+        self._states.pop(uid, None)
+        if client is not None:
+            with contextlib.suppress(qemu.qmp.QMPError, OSError, EOFError):
+                await client.disconnect()
+
+    async def disconnect(self, instance: InstanceEntity):
+        """
+        Close the QMP connection of an instance, if there is one
+        """
+        async with self._locks[instance.uid]:
+            await self._disconnect(instance.uid)
+
+    async def stop(self):
+        for uid in list(self._clients):
+            async with self._locks[uid]:
+                await self._disconnect(uid)
+
+    @contextlib.asynccontextmanager
+    async def qmp_session(
+        self, instance: InstanceEntity
+    ) -> typing.AsyncIterator[qemu.qmp.QMPClient]:
+        """
+        Use the QMP connection of a running instance. A connection that fails is closed, so the
+        next session establishes a new one.
+        Args:
+            instance: The instance to connect to
+
+        Raises:
+            QMPException if the instance does not accept QMP connections or a command fails
+        """
+        client = await self.connect(instance)
+        try:
+            yield client
+        except (qemu.qmp.QMPError, OSError, asyncio.TimeoutError) as e:
+            await self.disconnect(instance)
+            raise QMPException(
+                status=500, msg=f"QMP session with instance {instance.name} failed: {e}"
+            ) from e
+
+    async def execute(
+        self,
+        instance: InstanceEntity,
+        command: str,
+        arguments: typing.Dict[str, typing.Any] | None = None,
+    ) -> typing.Any:
+        """
+        Execute a QMP command on a running instance
+        Args:
+            instance: The instance to execute the command on
+            command: The QMP command
+            arguments: Optional arguments of the command
+
+        Returns:
+            The return value of the command
+        """
+        async with self.qmp_session(instance) as qmp:
+            return await qmp.execute(command, arguments)
+
+    async def status(self, instance: InstanceEntity) -> InstanceState:
+        """
+        Query the current state of a running instance
+        """
+        status = await self.execute(instance, "query-status")
+        await self._set_state(
+            instance.uid, InstanceState.STARTED if status["running"] else InstanceState.PAUSED
+        )
+        return self._states[instance.uid]
+
+    async def powerdown(self, instance: InstanceEntity):
+        """
+        Ask the guest to shut down, like pressing the power button
+        """
+        await self.execute(instance, "system_powerdown")
+        await self._set_state(instance.uid, InstanceState.STOPPING)
+
+    async def pause(self, instance: InstanceEntity):
+        await self.execute(instance, "stop")
+        await self._set_state(instance.uid, InstanceState.PAUSED)
+
+    async def resume(self, instance: InstanceEntity):
+        await self.execute(instance, "cont")
+        await self._set_state(instance.uid, InstanceState.STARTED)
+
+    async def start_instance(self, instance: InstanceEntity):
+        """
+        Start the QEMU process of an instance under supervision once the host has the vCPUs and
+        RAM for it, unless it is running already
+        """
+        if await self.reattach_instance(instance):
+            self._logger.info("Instance %s is running already", instance.name)
+            return
+        try:
+            args = self.instance_args(instance)
+            await self._runtime.resource_service.admit(instance)
+            await self._runtime.supervisor_service.supervise(instance, args)
+        except KasoMashinException:
+            await self._runtime.resource_service.release(instance.uid)
+            self._runtime.display_service.release(instance.uid)
+            raise
+
+    async def stop_instance(self, instance: InstanceEntity) -> InstanceState:
+        """
+        Power the guest down and wait for its QEMU process to exit, terminating it if the guest
+        does not power off within the shutdown timeout
+        Args:
+            instance: The instance to stop
+
+        Returns:
+            The state of the instance, which is stopping if the instance was not started by
+            this server and could only be asked to power down
+        """
+
+        async def shutdown() -> bool:
+            try:
+                await self.powerdown(instance)
+                return True
+            except QMPException as e:
+                self._logger.warning("Instance %s cannot be powered down: %s", instance.name, e.msg)
+                return False
+
+        if await self._runtime.supervisor_service.halt(
+            instance, timeout=self._runtime.config.instance_shutdown_timeout, shutdown=shutdown
+        ):
+            await self.disconnect(instance)
+            return InstanceState.STOPPED
+        # Without a connection or a QEMU process holding its pidfile there is nothing to power
+        # down, and waiting for a QMP socket that is never created would only delay the caller
+        if instance.uid not in self._clients and self.running_pid(instance) is None:
+            return InstanceState.STOPPED
+        # The SHUTDOWN event reports when an instance not started by this server has stopped
+        return InstanceState.STOPPING if await shutdown() else InstanceState.STOPPED
+
+    def instance_args(self, instance: InstanceEntity) -> typing.List[str]:
+        """
+        The command line of the QEMU process of an instance. The instance is allocated a VNC
+        display unless it has one already.
+        """
+        display = self._runtime.display_service.allocate(instance)
         args = [
             str(self._runtime.config.qemu_aarch64_path),
             "-name",
@@ -48,7 +398,13 @@ class QEMUService(Service):
             "-drive",
             f"if=virtio,file={instance.os_disk.path},format=qcow2,index=0,media=disk",
             "-vnc",
-            "localhost:0,power-control=on",
+            f"localhost:{display},power-control=on",
+            "-serial",
+            f"unix:{self.serial_path(instance)},server=on,wait=off",
+            "-qmp",
+            f"unix:{self.qmp_path(instance)},server=on,wait=off",
+            "-pidfile",
+            str(self.pid_path(instance)),
         ]
         if instance.bootstrap.kind == BootstrapKind.IGNITION:
             args.extend(
@@ -69,4 +425,4 @@ class QEMUService(Service):
         # args.extend(["-device", "VGA", "-display", "cocoa", "-vnc", "to=0,power-control=on"])
         # args.extend(["-display", "vnc=:0", "-vnc", "to=0,power-control=on"])
 
-        return subprocess.Popen(args)
+        return args
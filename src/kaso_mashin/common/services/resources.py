@@ -0,0 +1,179 @@
+import asyncio
+import os
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common.base_types import (
+    Service,
+    EntitySchema,
+    UniqueIdentifier,
+    BinaryScale,
+)
+from kaso_mashin.common.entities import InstanceEntity, InstanceState
+
+
+class ResourceException(KasoMashinException):
+    """
+    Exception for vCPUs or RAM that are not available to run an instance
+    """
+
+    pass
+
+
+class ResourcesGetSchema(EntitySchema):
+    """
+    Schema for the vCPUs and RAM of the host and their reservation by running instances
+    """
+
+    vcpu_total: int = pydantic.Field(description="Number of CPUs of the host", examples=[10])
+    vcpu_reserved: int = pydantic.Field(description="Number of vCPUs of running instances")
+    vcpu_overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the host CPUs that instances may reserve, 0 for no limit",
+        examples=[4.0],
+    )
+    vcpu_available: int | None = pydantic.Field(
+        description="Number of vCPUs that can still be reserved, none if there is no limit",
+        default=None,
+    )
+    ram_total: int = pydantic.Field(description="Bytes of RAM of the host")
+    ram_reserved: int = pydantic.Field(description="Bytes of RAM of running instances")
+    ram_overcommit_ratio: float = pydantic.Field(
+        description="Multiple of the host RAM that instances may reserve, 0 for no limit",
+        examples=[1.0],
+    )
+    ram_available: int | None = pydantic.Field(
+        description="Bytes of RAM that can still be reserved, none if there is no limit",
+        default=None,
+    )
+    instances: int = pydantic.Field(description="Number of instances holding a reservation")
+    waiting: int = pydantic.Field(description="Number of instance starts queued for resources")
+
+
+class ResourceService(Service):
+    """
+    Keeps a ledger of the vCPUs and RAM reserved by running instances and admits an instance to
+    start only while the reservations stay within the configured overcommit ratios of the host.
+    Starting instances beyond the RAM of the host makes it swap, which slows every instance on it
+    down far more than not starting the instance at all. Starts that do not fit are rejected or,
+    if configured, queued until an instance stops.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._condition = asyncio.Condition()
+        self._reservations: typing.Dict[UniqueIdentifier, typing.Tuple[int, int]] = {}
+        self._waiting = 0
+        self._vcpu_total = os.cpu_count() or 0
+        try:
+            self._ram_total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            self._ram_total = 0
+        runtime.event_service.on_instance_state += self._on_instance_state
+        self._logger.info("Started resource service")
+
+    @staticmethod
+    def demand(instance: InstanceEntity) -> typing.Tuple[int, int]:
+        """
+        The number of vCPUs and bytes of RAM an instance reserves while it runs
+        """
+        return instance.vcpu, instance.ram.at_scale(BinaryScale.b).value
+
+    def usage(self) -> ResourcesGetSchema:
+        """
+        Account for the vCPUs and RAM of the host
+        """
+        config = self._runtime.config
+        vcpu_reserved = sum(vcpu for vcpu, _ in self._reservations.values())
+        ram_reserved = sum(ram for _, ram in self._reservations.values())
+        vcpu_limit = int(config.vcpu_overcommit_ratio * self._vcpu_total)
+        ram_limit = int(config.ram_overcommit_ratio * self._ram_total)
+        return ResourcesGetSchema(
+            vcpu_total=self._vcpu_total,
+            vcpu_reserved=vcpu_reserved,
+            vcpu_overcommit_ratio=config.vcpu_overcommit_ratio,
+            vcpu_available=max(vcpu_limit - vcpu_reserved, 0) if vcpu_limit > 0 else None,
+            ram_total=self._ram_total,
+            ram_reserved=ram_reserved,
+            ram_overcommit_ratio=config.ram_overcommit_ratio,
+            ram_available=max(ram_limit - ram_reserved, 0) if ram_limit > 0 else None,
+            instances=len(self._reservations),
+            waiting=self._waiting,
+        )
+
+    @staticmethod
+    def refusal(usage: ResourcesGetSchema, vcpu: int, ram: int) -> str | None:
+        """
+        Decide whether an instance may start
+        Args:
+            usage: The current resource accounting
+            vcpu: The number of vCPUs of the instance
+            ram: The bytes of RAM of the instance
+
+        Returns:
+            The reason why the instance cannot start, None if it can
+        """
+        if usage.vcpu_available is not None and vcpu > usage.vcpu_available:
+            return (
+                f"Starting {vcpu} vCPUs exceeds the overcommit ratio of "
+                f"{usage.vcpu_overcommit_ratio}, only {usage.vcpu_available} vCPUs are available"
+            )
+        if usage.ram_available is not None and ram > usage.ram_available:
+            return (
+                f"Starting {ram} bytes of RAM exceeds the overcommit ratio of "
+                f"{usage.ram_overcommit_ratio}, only {usage.ram_available} bytes are available"
+            )
+        return None
+
+    def reserve(self, instance: InstanceEntity):
+        """
+        Reserve the resources of an instance that runs already, without admitting it
+        """
+        self._reservations[instance.uid] = self.demand(instance)
+
+    async def admit(self, instance: InstanceEntity):
+        """
+        Reserve the resources of an instance that is about to start. Waits for other instances to
+        stop for up to the configured admission timeout before giving up. An instance that holds
+        a reservation already is admitted right away.
+        Args:
+            instance: The instance to start
+
+        Raises:
+            ResourceException if the instance does not fit on the host
+        """
+        if instance.uid in self._reservations:
+            return
+        vcpu, ram = self.demand(instance)
+        deadline = time.monotonic() + self._runtime.config.instance_admission_timeout
+        async with self._condition:
+            while (refusal := self.refusal(self.usage(), vcpu, ram)) is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ResourceException(
+                        status=503, msg=f"Instance {instance.name} cannot start: {refusal}"
+                    )
+                self._logger.info("Waiting for resources to start %s: %s", instance.name, refusal)
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiting -= 1
+            self._reservations[instance.uid] = (vcpu, ram)
+
+    async def release(self, uid: UniqueIdentifier):
+        """
+        Release the resources of an instance and wake up the starts waiting for them
+        """
+        async with self._condition:
+            if self._reservations.pop(uid, None) is not None:
+                self._condition.notify_all()
+
+    async def _on_instance_state(self, uid: UniqueIdentifier, state: InstanceState):
+        # A process the supervisor restarts after its guest shut down still needs its resources
+        if state == InstanceState.STOPPED and not self._runtime.supervisor_service.active(uid):
+            await self.release(uid)
@@ -0,0 +1,393 @@
+import asyncio
+import collections
+import datetime
+import enum
+import os
+import pathlib
+import re
+import signal
+import time
+import typing
+
+import pydantic
+
+from kaso_mashin.common.base_types import Service, EntitySchema, UniqueIdentifier
+from kaso_mashin.common.entities import InstanceEntity, InstanceState
+from kaso_mashin.common.services.process import ProcessException
+
+# Seconds a terminated process is given to exit before it is killed
+TERMINATE_TIMEOUT = 10
+
+# Seconds between checks whether an adopted process is still running
+ADOPTED_POLL_INTERVAL = 1
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Whether a process with the provided pid exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RestartPolicy(enum.StrEnum):
+    NEVER = "never"
+    ON_FAILURE = "on-failure"
+    ALWAYS = "always"
+
+
+class SupervisedProcessSchema(EntitySchema):
+    """
+    Schema for the process of an instance
+    """
+
+    uid: UniqueIdentifier = pydantic.Field(
+        description="The unique identifier of the instance",
+        examples=["b430727e-2491-4184-bb4f-c7d6d213e093"],
+    )
+    pid: int | None = pydantic.Field(
+        description="The process id, none while the process is not running", examples=[4711]
+    )
+    state: InstanceState = pydantic.Field(
+        description="The state of the process", examples=[InstanceState.STARTED]
+    )
+    policy: RestartPolicy = pydantic.Field(
+        description="When the process is restarted after it exits",
+        examples=[RestartPolicy.ON_FAILURE],
+    )
+    restarts: int = pydantic.Field(description="Number of times the process was restarted")
+    returncode: int | None = pydantic.Field(
+        description="Exit code of the most recent exit, none if the process never exited"
+    )
+    started: datetime.datetime = pydantic.Field(description="When the process last started")
+    stdout: typing.List[str] = pydantic.Field(
+        description="The most recent lines the process printed", default_factory=list
+    )
+    stderr: typing.List[str] = pydantic.Field(
+        description="The most recent lines the process printed as errors", default_factory=list
+    )
+
+
+class Supervised:
+    """
+    A supervised process and what is known about it
+    """
+
+    def __init__(
+        self,
+        instance: InstanceEntity,
+        args: typing.List[str],
+        policy: RestartPolicy,
+        lines: int,
+    ):
+        self.uid = instance.uid
+        self.name = instance.name
+        self.args = args
+        self.policy = policy
+        self.process: asyncio.subprocess.Process | None = None
+        self.pid: int | None = None
+        self.state = InstanceState.STARTING
+        self.started = time.monotonic()
+        self.started_at = datetime.datetime.now()
+        self.restarts = 0
+        self.failures = 0
+        self.returncode: int | None = None
+        self.stopping = asyncio.Event()
+        self.watcher: asyncio.Task | None = None
+        self.stdout: typing.Deque[str] = collections.deque(maxlen=lines)
+        self.stderr: typing.Deque[str] = collections.deque(maxlen=lines)
+
+
+class SupervisorService(Service):
+    """
+    Owns the processes of running instances. Each process is watched by a task on the event
+    loop, so any number of instances is supervised without a thread per process. When a process
+    exits unexpectedly, the restart policy decides whether it is restarted, with an exponential
+    backoff between consecutive failures. The most recent output of each process is kept in
+    bounded ring buffers.
+    """
+
+    def __init__(self, runtime: "Runtime"):
+        super().__init__(runtime)
+        self._supervised: typing.Dict[UniqueIdentifier, Supervised] = {}
+        self._logger.info("Started supervisor service")
+
+    def supervises(self, instance: InstanceEntity) -> bool:
+        return instance.uid in self._supervised
+
+    def state(self, instance: InstanceEntity) -> InstanceState | None:
+        """
+        The state of the process of an instance, None if it is not supervised
+        """
+        supervised = self._supervised.get(instance.uid)
+        return supervised.state if supervised is not None else None
+
+    def active(self, uid: UniqueIdentifier) -> bool:
+        """
+        Whether the process of an instance given its uid is supervised and has not stopped for
+        good. A guest that shuts down is reported stopped via QMP while its process may still be
+        restarted by the restart policy.
+        """
+        supervised = self._supervised.get(uid)
+        return supervised is not None and supervised.state != InstanceState.STOPPED
+
+    def pid(self, uid: UniqueIdentifier) -> int | None:
+        """
+        The pid of the running process of an instance given its uid, None if it is not running
+        """
+        supervised = self._supervised.get(uid)
+        if supervised is None or not self._running(supervised):
+            return None
+        return supervised.pid
+
+    def get(self, instance: InstanceEntity) -> SupervisedProcessSchema | None:
+        supervised = self._supervised.get(instance.uid)
+        if supervised is None:
+            return None
+        return SupervisedProcessSchema(
+            uid=supervised.uid,
+            pid=supervised.pid if self._running(supervised) else None,
+            state=supervised.state,
+            policy=supervised.policy,
+            restarts=supervised.restarts,
+            returncode=supervised.returncode,
+            started=supervised.started_at,
+            stdout=list(supervised.stdout),
+            stderr=list(supervised.stderr),
+        )
+
+    async def _set_state(self, supervised: Supervised, state: InstanceState):
+        supervised.state = state
+        self._logger.info("Instance %s is %s", supervised.name, state)
+        await self._runtime.event_service.on_instance_state(supervised.uid, state)
+
+    async def _spawn(self, supervised: Supervised):
+        command = pathlib.Path(supervised.args[0]).name
+        try:
+            supervised.process = await asyncio.create_subprocess_exec(
+                *supervised.args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                # Instances keep running when the server is interrupted or restarted
+                start_new_session=True,
+            )
+        except OSError as e:
+            raise ProcessException(status=500, msg=f"Failed to start {command}: {e}") from e
+        supervised.pid = supervised.process.pid
+        supervised.started = time.monotonic()
+        supervised.started_at = datetime.datetime.now()
+        self._logger.info("Started %s with pid %s", command, supervised.process.pid)
+
+    async def supervise(
+        self,
+        instance: InstanceEntity,
+        args: typing.Sequence[str | pathlib.Path],
+        policy: RestartPolicy | None = None,
+    ) -> Supervised:
+        """
+        Start the process of an instance and watch over it
+        Args:
+            instance: The instance the process belongs to
+            args: The command and its arguments
+            policy: When to restart the process, defaults to the configured policy
+
+        Returns:
+            The supervised process
+
+        Raises:
+            ProcessException if the process cannot be started or the instance is supervised already
+        """
+        existing = self._supervised.get(instance.uid)
+        if existing is not None and existing.state != InstanceState.STOPPED:
+            raise ProcessException(status=400, msg=f"Instance {instance.name} is running already")
+        supervised = Supervised(
+            instance,
+            [str(arg) for arg in args],
+            RestartPolicy(policy or self._runtime.config.instance_restart_policy),
+            self._runtime.config.instance_output_lines,
+        )
+        await self._spawn(supervised)
+        self._supervised[instance.uid] = supervised
+        await self._set_state(supervised, InstanceState.STARTED)
+        supervised.watcher = asyncio.create_task(
+            self._watch(supervised), name=f"supervise {instance.name}"
+        )
+        return supervised
+
+    async def adopt(
+        self,
+        instance: InstanceEntity,
+        pid: int,
+        args: typing.Sequence[str | pathlib.Path],
+        policy: RestartPolicy | None = None,
+    ) -> Supervised:
+        """
+        Watch over the process of an instance that was started before the server was, e.g. by a
+        previous run of it. The output of adopted processes is not captured and since their exit
+        code is unknown, they are only restarted if the policy is to always restart.
+        Args:
+            instance: The instance the process belongs to
+            pid: The process id of the running process
+            args: The command and its arguments to restart the process with
+            policy: When to restart the process, defaults to the configured policy
+
+        Returns:
+            The supervised process
+        """
+        supervised = Supervised(
+            instance,
+            [str(arg) for arg in args],
+            RestartPolicy(policy or self._runtime.config.instance_restart_policy),
+            self._runtime.config.instance_output_lines,
+        )
+        supervised.pid = pid
+        self._supervised[instance.uid] = supervised
+        self._logger.info("Adopted instance %s with pid %s", instance.name, pid)
+        await self._set_state(supervised, InstanceState.STARTED)
+        supervised.watcher = asyncio.create_task(
+            self._watch(supervised), name=f"supervise {instance.name}"
+        )
+        return supervised
+
+    @staticmethod
+    def _running(supervised: Supervised) -> bool:
+        if supervised.process is not None:
+            return supervised.process.returncode is None
+        return supervised.pid is not None and pid_alive(supervised.pid)
+
+    @staticmethod
+    async def _wait(supervised: Supervised) -> int | None:
+        """
+        Wait for the process to exit
+
+        Returns:
+            The exit code, None for adopted processes whose exit code is unknown
+        """
+        if supervised.process is not None:
+            return await supervised.process.wait()
+        while supervised.pid is not None and pid_alive(supervised.pid):
+            await asyncio.sleep(ADOPTED_POLL_INTERVAL)
+        return None
+
+    @staticmethod
+    def _signal(supervised: Supervised, signum: int):
+        if supervised.pid is None:
+            return
+        try:
+            os.kill(supervised.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    async def _drain(stream: asyncio.StreamReader | None, ring: typing.Deque[str]):
+        if stream is None:
+            return
+        pending = b""
+        while chunk := await stream.read(4096):
+            *lines, pending = re.split(rb"\r?\n", pending + chunk)
+            ring.extend(line.decode("utf-8", errors="replace") for line in lines)
+        if pending:
+            ring.append(pending.decode("utf-8", errors="replace"))
+
+    def _restart(self, supervised: Supervised) -> bool:
+        if supervised.stopping.is_set() or supervised.policy == RestartPolicy.NEVER:
+            return False
+        if supervised.policy == RestartPolicy.ON_FAILURE and supervised.returncode in (0, None):
+            return False
+        limit = self._runtime.config.instance_restart_limit
+        return limit <= 0 or supervised.failures < limit
+
+    async def _watch(self, supervised: Supervised):
+        config = self._runtime.config
+        while True:
+            process = supervised.process
+            if process is not None:
+                await asyncio.gather(
+                    self._drain(process.stdout, supervised.stdout),
+                    self._drain(process.stderr, supervised.stderr),
+                )
+            supervised.returncode = await self._wait(supervised)
+            self._logger.info("Instance %s exited with %s", supervised.name, supervised.returncode)
+            # A process that ran for longer than the longest backoff is considered healthy again
+            if time.monotonic() - supervised.started > config.instance_restart_backoff_max:
+                supervised.failures = 0
+            if not self._restart(supervised):
+                await self._set_state(supervised, InstanceState.STOPPED)
+                return
+            supervised.failures += 1
+            delay = min(
+                config.instance_restart_backoff * 2 ** (supervised.failures - 1),
+                config.instance_restart_backoff_max,
+            )
+            await self._set_state(supervised, InstanceState.STARTING)
+            try:
+                await asyncio.wait_for(supervised.stopping.wait(), timeout=delay)
+                await self._set_state(supervised, InstanceState.STOPPED)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._spawn(supervised)
+            except ProcessException as e:
+                self._logger.warning("Failed to restart instance %s: %s", supervised.name, e.msg)
+                await self._set_state(supervised, InstanceState.STOPPED)
+                return
+            supervised.restarts += 1
+            await self._set_state(supervised, InstanceState.STARTED)
+
+    async def stop(self):
+        """
+        Stop watching over all processes, which keep running
+        """
+        for supervised in self._supervised.values():
+            if supervised.watcher is not None and not supervised.watcher.done():
+                supervised.watcher.cancel()
+                try:
+                    await supervised.watcher
+                except asyncio.CancelledError:
+                    pass
+
+    async def halt(
+        self,
+        instance: InstanceEntity,
+        timeout: float = 0,
+        shutdown: typing.Callable[[], typing.Awaitable[bool]] | None = None,
+    ) -> bool:
+        """
+        Stop the process of an instance without restarting it
+        Args:
+            instance: The instance to stop
+            timeout: Seconds to wait for the process to exit before it is terminated
+            shutdown: Optional coroutine asking the process to exit gracefully, which returns
+                whether the process could be asked
+
+        Returns:
+            Whether the instance was supervised
+        """
+        supervised = self._supervised.get(instance.uid)
+        if supervised is None:
+            return False
+        supervised.stopping.set()
+        if self._running(supervised):
+            if supervised.state != InstanceState.STOPPING:
+                await self._set_state(supervised, InstanceState.STOPPING)
+            if shutdown is not None and not await shutdown():
+                timeout = 0
+            try:
+                await asyncio.wait_for(self._wait(supervised), timeout=timeout)
+            except asyncio.TimeoutError:
+                self._logger.warning("Terminating instance %s", supervised.name)
+                self._signal(supervised, signal.SIGTERM)
+                try:
+                    await asyncio.wait_for(self._wait(supervised), timeout=TERMINATE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self._signal(supervised, signal.SIGKILL)
+        if supervised.watcher is not None:
+            await supervised.watcher
+        return True
@@ -7,3 +7,5 @@ from .image_api import ImageAPI
 from .instance_api import InstanceAPI
 from .disk_api import DiskAPI
 from .bootstrap_api import BootstrapAPI
+from .capacity_api import CapacityAPI
+from .gc_api import GCAPI
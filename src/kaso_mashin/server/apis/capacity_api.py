@@ -0,0 +1,47 @@
+import fastapi
+
+from kaso_mashin.server.runtime import Runtime
+from kaso_mashin.common.services import CapacityGetSchema, ResourcesGetSchema
+
+
+class CapacityAPI:
+    """
+    The Capacity API
+    """
+
+    def __init__(self, runtime: Runtime):
+        super().__init__()
+        self._runtime = runtime
+        self._router = fastapi.APIRouter(tags=["capacity"])
+        self._router.add_api_route(
+            "/",
+            self.get_capacity,
+            methods=["GET"],
+            summary="Get Disk Capacity",
+            description="Get the provisioned, allocated and free disk space behind the instances "
+            "path",
+            response_description="Disk space accounting",
+            status_code=200,
+            response_model=CapacityGetSchema,
+        )
+        self._router.add_api_route(
+            "/resources",
+            self.get_resources,
+            methods=["GET"],
+            summary="Get Host Resources",
+            description="Get the vCPUs and RAM of the host and how much of them running "
+            "instances reserve",
+            response_description="vCPU and RAM accounting",
+            status_code=200,
+            response_model=ResourcesGetSchema,
+        )
+
+    @property
+    def router(self) -> fastapi.APIRouter:
+        return self._router
+
+    async def get_capacity(self):
+        return await self._runtime.capacity_service.usage()
+
+    async def get_resources(self):
+        return self._runtime.resource_service.usage()
@@ -1,7 +1,14 @@
+import typing
+
 import fastapi
 
 from kaso_mashin.server.runtime import Runtime
 from kaso_mashin.common.config import ConfigSchema
+from kaso_mashin.common.services import (
+    BandwidthGetSchema,
+    BandwidthModifySchema,
+    ProcessMetricsSchema,
+)
 
 
 class ConfigAPI:
@@ -23,6 +30,36 @@ class ConfigAPI:
             status_code=200,
             response_model=ConfigSchema,
         )
+        self._router.add_api_route(
+            "/bandwidth",
+            self.get_bandwidth,
+            methods=["GET"],
+            summary="Get Bandwidth Limits",
+            description="Get the bandwidth limits for downloads",
+            response_description="Bandwidth limits",
+            status_code=200,
+            response_model=BandwidthGetSchema,
+        )
+        self._router.add_api_route(
+            "/bandwidth",
+            self.modify_bandwidth,
+            methods=["PUT"],
+            summary="Modify Bandwidth Limits",
+            description="Modify the bandwidth limits for downloads, including those in progress",
+            response_description="The updated bandwidth limits",
+            status_code=200,
+            response_model=BandwidthGetSchema,
+        )
+        self._router.add_api_route(
+            "/processes",
+            self.get_process_metrics,
+            methods=["GET"],
+            summary="Get External Command Metrics",
+            description="Get timing metrics for the external commands run so far",
+            response_description="Metrics per command",
+            status_code=200,
+            response_model=typing.List[ProcessMetricsSchema],
+        )
 
     @property
     def router(self) -> fastapi.APIRouter:
@@ -30,3 +67,15 @@ class ConfigAPI:
 
     async def get_config(self):
         return ConfigSchema.model_validate(self._runtime.config)
+
+    async def get_bandwidth(self):
+        return BandwidthGetSchema.model_validate(self._runtime.bandwidth_service)
+
+    async def modify_bandwidth(self, schema: BandwidthModifySchema):
+        self._runtime.bandwidth_service.configure(
+            rate_limit=schema.rate_limit, rate_limit_per_transfer=schema.rate_limit_per_transfer
+        )
+        return BandwidthGetSchema.model_validate(self._runtime.bandwidth_service)
+
+    async def get_process_metrics(self):
+        return self._runtime.process_service.metrics
@@ -5,6 +5,8 @@ import pathlib
 import fastapi
 
 from kaso_mashin.common import AsyncRepository
+from kaso_mashin.common.entities.tasks import TaskRelation
+from kaso_mashin.common.services import DiskStatsSchema
 from kaso_mashin.server.apis import BaseAPI
 from kaso_mashin.server.runtime import Runtime
 from kaso_mashin.common.entities import (
@@ -12,9 +14,24 @@ from kaso_mashin.common.entities import (
     DiskListSchema,
     DiskGetSchema,
     DiskCreateSchema,
+    DiskBatchCreateSchema,
     DiskModifySchema,
+    DiskSnapshotSchema,
+    DiskCloneSchema,
+    DiskRebaseSchema,
+    TaskEntity,
+    TaskGetSchema,
 )
 
+DiskUID = Annotated[
+    UUID,
+    fastapi.Path(
+        title="Entity UUID",
+        description="The UUID of the disk",
+        examples=["4198471B-8C84-4636-87CD-9DF4E24CF43F"],
+    ),
+]
+
 
 class DiskAPI(
     BaseAPI[
@@ -37,6 +54,67 @@ class DiskAPI(
             create_schema_type=DiskCreateSchema,
             modify_schema_type=DiskModifySchema,
         )
+        self._router.add_api_route(
+            path="/batch",
+            endpoint=self.create_batch,
+            methods=["POST"],
+            summary="Create many Disk entities",
+            description="Create many disks at once in the background, all or none of them",
+            response_description="A task tracking the creation of all disks",
+            status_code=201,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/{uid}/snapshot",
+            endpoint=self.snapshot,
+            methods=["POST"],
+            summary="Snapshot a Disk entity",
+            description="Freeze the current state of a disk as an external or internal snapshot",
+            response_description="A task tracking the snapshot",
+            status_code=201,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/{uid}/clone",
+            endpoint=self.clone,
+            methods=["POST"],
+            summary="Clone a Disk entity",
+            description="Create a thin overlay disk on top of a disk, typically a snapshot",
+            response_description="A task tracking the clone",
+            status_code=201,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/{uid}/flatten",
+            endpoint=self.flatten,
+            methods=["POST"],
+            summary="Flatten a Disk entity",
+            description="Copy the data of the backing chain into a disk in the background",
+            response_description="A task tracking the flatten",
+            status_code=200,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/{uid}/rebase",
+            endpoint=self.rebase,
+            methods=["POST"],
+            summary="Rebase a Disk entity",
+            description="Layer a disk on top of another disk in the background",
+            response_description="A task tracking the rebase",
+            status_code=200,
+            response_model=TaskGetSchema,
+        )
+
+        self._router.add_api_route(
+            path="/{uid}/stats",
+            endpoint=self.stats,
+            methods=["GET"],
+            summary="Get Disk statistics",
+            description="Get the recent read, write and allocation activity of a disk",
+            response_description="Disk activity per interval",
+            status_code=200,
+            response_model=DiskStatsSchema,
+        )
 
     @property
     def repository(self) -> AsyncRepository:
@@ -57,6 +135,17 @@ class DiskAPI(
         )
         return DiskGetSchema.model_validate(entity)
 
+    async def create_batch(
+        self, schema: DiskBatchCreateSchema, background_tasks: fastapi.BackgroundTasks
+    ) -> TaskGetSchema:
+        task = await TaskEntity.create(
+            name=f"Create {len(schema.entries)} disks",
+            relation=TaskRelation.DISKS,
+            msg="Creating disks",
+        )
+        background_tasks.add_task(DiskEntity.create_many, task=task, disks=schema.entries)
+        return TaskGetSchema.model_validate(task)
+
     async def modify(
         self,
         uid: Annotated[
@@ -74,3 +163,74 @@ class DiskAPI(
         if entity.size != schema.size:
             entity = await entity.resize(schema.size)
         return DiskGetSchema.model_validate(entity)
+
+    async def snapshot(
+        self,
+        uid: DiskUID,
+        schema: DiskSnapshotSchema,
+        background_tasks: fastapi.BackgroundTasks,
+    ) -> TaskGetSchema:
+        entity: DiskEntity = await self.repository.get_by_uid(uid)
+        await entity.check_unused()
+        task = await TaskEntity.create(
+            name=f"Snapshot disk {entity.name} as {schema.name}",
+            relation=TaskRelation.DISKS,
+            msg="Creating snapshot",
+        )
+        background_tasks.add_task(
+            entity.snapshot, task=task, name=schema.name, path=schema.path, kind=schema.kind
+        )
+        return TaskGetSchema.model_validate(task)
+
+    async def clone(
+        self,
+        uid: DiskUID,
+        schema: DiskCloneSchema,
+        background_tasks: fastapi.BackgroundTasks,
+    ) -> TaskGetSchema:
+        entity: DiskEntity = await self.repository.get_by_uid(uid)
+        task = await TaskEntity.create(
+            name=f"Clone disk {entity.name} as {schema.name}",
+            relation=TaskRelation.DISKS,
+            msg="Creating clone",
+        )
+        background_tasks.add_task(entity.clone, task=task, name=schema.name, path=schema.path)
+        return TaskGetSchema.model_validate(task)
+
+    async def flatten(
+        self, uid: DiskUID, background_tasks: fastapi.BackgroundTasks
+    ) -> TaskGetSchema:
+        entity: DiskEntity = await self.repository.get_by_uid(uid)
+        task = await TaskEntity.create(
+            name=f"Flatten disk {entity.name}", relation=TaskRelation.DISKS, msg="Flattening"
+        )
+        background_tasks.add_task(entity.flatten, task=task)
+        return TaskGetSchema.model_validate(task)
+
+    async def rebase(
+        self,
+        uid: DiskUID,
+        schema: DiskRebaseSchema,
+        background_tasks: fastapi.BackgroundTasks,
+    ) -> TaskGetSchema:
+        entity: DiskEntity = await self.repository.get_by_uid(uid)
+        backing: DiskEntity | None = None
+        if schema.backing_uid is not None:
+            backing = await self.repository.get_by_uid(schema.backing_uid)
+            await entity.check_backing(backing)
+        task = await TaskEntity.create(
+            name=f"Rebase disk {entity.name}", relation=TaskRelation.DISKS, msg="Rebasing"
+        )
+        background_tasks.add_task(entity.rebase, task=task, backing=backing)
+        return TaskGetSchema.model_validate(task)
+
+    async def stats(
+        self,
+        uid: DiskUID,
+        points: Annotated[
+            int, fastapi.Query(description="Number of intervals", ge=1, le=1000)
+        ] = 60,
+        window: Annotated[int, fastapi.Query(description="Seconds of history", ge=1)] = 3600,
+    ) -> DiskStatsSchema:
+        entity: DiskEntity = await self.repository.get_by_uid(uid)
+        return self._runtime.disk_stats_service.stats(entity.uid, points=points, window=window)
@@ -0,0 +1,45 @@
+import fastapi
+
+from kaso_mashin.server.runtime import Runtime
+from kaso_mashin.common.services import GCMode, GCReportSchema
+
+
+class GCAPI:
+    """
+    The Garbage Collection API
+    """
+
+    def __init__(self, runtime: Runtime):
+        super().__init__()
+        self._runtime = runtime
+        self._router = fastapi.APIRouter(tags=["gc"])
+        self._router.add_api_route(
+            "/",
+            self.get_report,
+            methods=["GET"],
+            summary="Get Garbage Collection Report",
+            description="Get the report of the last garbage collection, if any",
+            response_description="The last garbage collection report",
+            status_code=200,
+            response_model=GCReportSchema | None,
+        )
+        self._router.add_api_route(
+            "/",
+            self.collect,
+            methods=["POST"],
+            summary="Collect Garbage",
+            description="Scan the images and instances paths for orphaned files and handle them",
+            response_description="The garbage collection report",
+            status_code=200,
+            response_model=GCReportSchema,
+        )
+
+    @property
+    def router(self) -> fastapi.APIRouter:
+        return self._router
+
+    async def get_report(self):
+        return self._runtime.gc_service.report
+
+    async def collect(self, mode: GCMode | None = None):
+        return await self._runtime.gc_service.collect(mode)
@@ -1,7 +1,9 @@
-import datetime
-from typing import Annotated
+import email.utils
+import pathlib
+from typing import Annotated, Tuple
 from uuid import UUID
 
+import aiofiles
 import fastapi
 
 from kaso_mashin.common import AsyncRepository
@@ -10,6 +12,7 @@ from kaso_mashin.server.apis import BaseAPI
 from kaso_mashin.server.runtime import Runtime
 from kaso_mashin.common.entities import (
     ImageEntity,
+    ImageException,
     ImageListSchema,
     ImageGetSchema,
     ImageCreateSchema,
@@ -41,6 +44,20 @@ class ImageAPI(
             modify_schema_type=ImageModifySchema,
             async_create=True,
         )
+        self._router.add_api_route(
+            path="/{uid}/content",
+            endpoint=self.content,
+            methods=["GET"],
+            summary="Get the content of an Image entity",
+            description="Stream the stored image file, optionally limited to a single byte range",
+            response_description="The image content",
+            status_code=200,
+            response_class=fastapi.responses.StreamingResponse,
+            responses={
+                206: {"description": "The requested range of the image content"},
+                416: {"description": "The requested range is not satisfiable"},
+            },
+        )
 
     @property
     def repository(self) -> AsyncRepository:
@@ -54,8 +71,7 @@ class ImageAPI(
             relation=TaskRelation.IMAGES,
             msg="Downloading image",
         )
-        now = datetime.datetime.now().strftime("%Y-%m-%d-%H%M")
-        imagepath = self._runtime.config.images_path / f"{schema.name}-{now}.qcow2"
+        imagepath = ImageEntity.path_for(self._runtime.config.images_path, schema.name)
         background_tasks.add_task(
             ImageEntity.create,
             task=task,
@@ -85,3 +101,83 @@ class ImageAPI(
         entity: ImageEntity = await self._runtime.image_repository.get_by_uid(uid)
         await entity.modify(schema)
         return ImageGetSchema.model_validate(entity)
+
+    async def content(
+        self,
+        uid: Annotated[
+            UUID,
+            fastapi.Path(
+                title="Entity UUID",
+                description="The UUID of the image to get the content of",
+                examples=["4198471B-8C84-4636-87CD-9DF4E24CF43F"],
+            ),
+        ],
+        range: Annotated[str | None, fastapi.Header()] = None,
+    ) -> fastapi.Response:
+        entity: ImageEntity = await self._runtime.image_repository.get_by_uid(uid)
+        if not entity.path.exists():
+            raise ImageException(status=404, msg=f"The image file at {entity.path} is missing")
+        stat = entity.path.stat()
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+        }
+        status_code = 200
+        first, last = 0, stat.st_size - 1
+        requested = self.parse_range(range, stat.st_size)
+        if requested is not None:
+            first, last = requested
+            if first > last:
+                headers["Content-Range"] = f"bytes */{stat.st_size}"
+                return fastapi.Response(status_code=416, headers=headers)
+            headers["Content-Range"] = f"bytes {first}-{last}/{stat.st_size}"
+            status_code = 206
+        headers["Content-Length"] = str(last - first + 1)
+        return fastapi.responses.StreamingResponse(
+            self._stream(entity.path, first, last - first + 1),
+            status_code=status_code,
+            headers=headers,
+            media_type="application/octet-stream",
+        )
+
+    @staticmethod
+    def parse_range(header: str | None, size: int) -> Tuple[int, int] | None:
+        """
+        Parse a single byte range from a Range header. Multiple ranges and other units are
+        not supported and yield the full content, as permitted by RFC 9110.
+        Args:
+            header: The value of the Range header
+            size: The size of the content
+
+        Returns:
+            The first and last byte position of the range, which are reversed if the range is
+            not satisfiable, or None to serve the full content
+        """
+        if header is None:
+            return None
+        unit, _, spec = header.partition("=")
+        if unit.strip().lower() != "bytes" or "," in spec:
+            return None
+        start, _, end = spec.strip().partition("-")
+        try:
+            if start == "":
+                suffix = int(end)
+                return max(size - suffix, 0) if suffix > 0 else size, size - 1
+            first = int(start)
+            if end and int(end) < first:
+                # An invalid range is ignored rather than unsatisfiable
+                return None
+            return first, min(int(end), size - 1) if end else size - 1
+        except ValueError:
+            return None
+
+    @staticmethod
+    async def _stream(path: pathlib.Path, offset: int, length: int, chunk_size: int = 1048576):
+        async with aiofiles.open(path, mode="rb") as f:
+            await f.seek(offset)
+            while length > 0:
+                chunk = await f.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
@@ -1,4 +1,4 @@
-from typing import Annotated
+from typing import Annotated, Dict, List
 from uuid import UUID
 
 import fastapi
@@ -11,11 +11,18 @@ from kaso_mashin.common import (
 from kaso_mashin.server.apis import BaseAPI
 from kaso_mashin.server.runtime import Runtime
 from kaso_mashin.common.base_types import ExceptionSchema
+from kaso_mashin.common.entities.tasks import TaskRelation
+from kaso_mashin.common.services import ProcessException, SupervisedProcessSchema
 from kaso_mashin.common.entities import (
     InstanceEntity,
+    InstanceException,
+    InstanceAction,
+    InstanceActionSchema,
+    InstanceState,
     InstanceListSchema,
     InstanceGetSchema,
     InstanceCreateSchema,
+    InstanceFleetCreateSchema,
     InstanceModifySchema,
     TaskEntity,
     TaskGetSchema,
@@ -48,11 +55,61 @@ class InstanceAPI(
             async_create=True,
             async_modify=True,
         )
+        self._router.add_api_route(
+            path="/fleet",
+            endpoint=self.create_fleet,
+            methods=["POST"],
+            summary="Create a fleet of Instance entities",
+            description="Create many instances from the same template in the background, "
+            "all or none of them",
+            response_description="A task tracking the creation of all instances",
+            status_code=201,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/actions/{action}",
+            endpoint=self.act,
+            methods=["POST"],
+            summary="Start or stop many Instance entities",
+            description="Start or stop the provided instances and those in the provided states "
+            "in the background, a few at a time and staggered",
+            response_description="A task tracking the action on all instances",
+            status_code=200,
+            response_model=TaskGetSchema,
+        )
+        self._router.add_api_route(
+            path="/{uid}/process",
+            endpoint=self.process,
+            methods=["GET"],
+            summary="Get the process of an Instance entity",
+            description="Get the state, restarts and most recent output of the process of an "
+            "instance",
+            response_description="The process of the instance",
+            status_code=200,
+            response_model=SupervisedProcessSchema,
+        )
 
     @property
     def repository(self) -> AsyncRepository:
         return self._runtime.instance_repository
 
+    async def list(
+        self,
+        state: Annotated[
+            List[InstanceState] | None,
+            fastapi.Query(
+                title="Instance states",
+                description="Only list instances in any of these states",
+                examples=[[InstanceState.STARTED]],
+            ),
+        ] = None,
+    ) -> InstanceListSchema:
+        if state is None:
+            entities = await self.repository.list()
+        else:
+            entities = await self._runtime.instance_repository.list_by_state(state)
+        return InstanceListSchema(entries=[InstanceGetSchema.model_validate(e) for e in entities])
+
     async def create(
         self, schema: InstanceCreateSchema, background_tasks: fastapi.BackgroundTasks
     ) -> TaskGetSchema | ExceptionSchema:
@@ -89,6 +146,62 @@ class InstanceAPI(
         except Exception as e:
             return ExceptionSchema.model_validate(e)
 
+    async def create_fleet(
+        self, schema: InstanceFleetCreateSchema, background_tasks: fastapi.BackgroundTasks
+    ) -> TaskGetSchema:
+        task = await TaskEntity.create(
+            name=f"Create a fleet of {schema.count} instances",
+            relation=TaskRelation.INSTANCES,
+            msg="Creating instances",
+        )
+        background_tasks.add_task(
+            InstanceEntity.create_many,
+            task=task,
+            user=self._runtime.owning_user,
+            instances_path=self._runtime.config.instances_path,
+            uefi_code=self._runtime.uefi_code_path,
+            uefi_vars=self._runtime.uefi_vars_path,
+            schema=schema,
+        )
+        return TaskGetSchema.model_validate(task)
+
+    async def act(
+        self,
+        action: Annotated[
+            InstanceAction,
+            fastapi.Path(
+                title="Action",
+                description="The action to take on the instances",
+                examples=[InstanceAction.START],
+            ),
+        ],
+        schema: InstanceActionSchema,
+        background_tasks: fastapi.BackgroundTasks,
+    ) -> TaskGetSchema:
+        if not schema.uids and not schema.state:
+            raise InstanceException(
+                status=400, msg=f"Provide the uids or states of the instances to {action.value}"
+            )
+        instances: Dict[UniqueIdentifier, InstanceEntity] = {
+            uid: await self.repository.get_by_uid(uid) for uid in schema.uids
+        }
+        if schema.state:
+            for entity in await self._runtime.instance_repository.list_by_state(schema.state):
+                instances.setdefault(entity.uid, entity)
+        task = await TaskEntity.create(
+            name=f"{action.value.capitalize()} {len(instances)} instances",
+            relation=TaskRelation.INSTANCES,
+            msg=f"Waiting to {action.value} instances",
+        )
+        background_tasks.add_task(
+            InstanceEntity.act_many,
+            task=task,
+            action=action,
+            instances=list(instances.values()),
+            schema=schema,
+        )
+        return TaskGetSchema.model_validate(task)
+
     async def modify(
         self,
         uid: Annotated[
@@ -106,3 +219,20 @@ class InstanceAPI(
         task = await TaskEntity.create(f"Modifying instance {entity.name}")
         background_tasks.add_task(entity.modify, schema=schema, task=task)
         return TaskGetSchema.model_validate(task)
+
+    async def process(
+        self,
+        uid: Annotated[
+            UUID,
+            fastapi.Path(
+                title="Entity UUID",
+                description="The UUID of the instance",
+                examples=["4198471B-8C84-4636-87CD-9DF4E24CF43F"],
+            ),
+        ],
+    ) -> SupervisedProcessSchema:
+        entity: InstanceEntity = await self.repository.get_by_uid(uid)
+        process = self._runtime.supervisor_service.get(entity)
+        if process is None:
+            raise ProcessException(status=404, msg=f"Instance {entity.name} was never started")
+        return process
@@ -30,6 +30,8 @@ from kaso_mashin.server.apis import (
     InstanceAPI,
     BootstrapAPI,
     IdentityAPI,
+    CapacityAPI,
+    GCAPI,
 )
 
 logger = logging.getLogger("kaso_mashin.server")
@@ -52,6 +54,8 @@ def create_server(runtime: Runtime) -> fastapi.applications.FastAPI:
     app.include_router(DiskAPI(runtime).router, prefix="/api/disks")
     app.include_router(InstanceAPI(runtime).router, prefix="/api/instances")
     app.include_router(BootstrapAPI(runtime).router, prefix="/api/bootstraps")
+    app.include_router(CapacityAPI(runtime).router, prefix="/api/capacity")
+    app.include_router(GCAPI(runtime).router, prefix="/api/gc")
 
     app.mount(
         path="/",
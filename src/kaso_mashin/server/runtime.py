@@ -8,8 +8,6 @@ from ipaddress import IPv4Network
 
 import fastapi
 import getpass
-import httpx
-import aiofiles
 
 from kaso_mashin.common.config import Config
 from kaso_mashin.server.db import DB
@@ -44,7 +42,22 @@ from kaso_mashin.common.entities import (
     IdentityModel,
     IdentityEntity,
 )
-from kaso_mashin.common.services import QEMUService, EventService
+from kaso_mashin.common.services import (
+    QEMUService,
+    PhoneHomeService,
+    EventService,
+    ProcessService,
+    SupervisorService,
+    DownloadService,
+    PrefetchService,
+    BandwidthService,
+    DiskPoolService,
+    CapacityService,
+    ResourceService,
+    DisplayService,
+    GCService,
+    DiskStatsService,
+)
 
 
 class Runtime:
@@ -69,27 +82,32 @@ class Runtime:
         self._uefi_code_path = config.bootstrap_path / "uefi-code.fd"
         self._uefi_vars_path = config.bootstrap_path / "uefi-vars.fd"
         self._event_service = EventService(self)
+        self._process_service = ProcessService(self)
+        self._supervisor_service = SupervisorService(self)
         self._qemu_service = QEMUService(self)
+        self._phone_home_service = PhoneHomeService(self)
+        self._bandwidth_service = BandwidthService(self)
+        self._download_service = DownloadService(self)
+        self._prefetch_service = PrefetchService(self)
+        self._disk_pool_service = DiskPoolService(self)
+        self._capacity_service = CapacityService(self)
+        self._resource_service = ResourceService(self)
+        self._display_service = DisplayService(self)
+        self._gc_service = GCService(self)
+        self._disk_stats_service = DiskStatsService(self)
 
     async def lifespan_uefi(self):
         self._logger.info(f"Lifespan UEFI started")
-        client = httpx.AsyncClient(follow_redirects=True, timeout=60)
         if not self.uefi_code_path.exists():
-            async with (
-                client.stream("GET", url=self._config.uefi_code_url) as resp,
-                aiofiles.open(self.uefi_code_path, "wb") as file,
-            ):
-                async for chunk in resp.aiter_bytes(chunk_size=8196):
-                    await file.write(chunk)
+            await self.download_service.download(
+                url=self._config.uefi_code_url, path=self.uefi_code_path
+            )
             shutil.chown(path=self.uefi_code_path, user=self._owning_user)
         if not self.uefi_vars_path.exists():
-            async with (
-                client.stream("GET", url=self._config.uefi_vars_url) as resp,
-                aiofiles.open(self.uefi_vars_path, "wb") as file,
-            ):
-                async for chunk in resp.aiter_bytes(chunk_size=8196):
-                    await file.write(chunk)
-                shutil.chown(path=self.uefi_vars_path, user=self._owning_user)
+            await self.download_service.download(
+                url=self._config.uefi_vars_url, path=self.uefi_vars_path
+            )
+            shutil.chown(path=self.uefi_vars_path, user=self._owning_user)
 
     async def lifespan_bootstrap(self):
         self._logger.info(f"Lifespan Bootstrap started")
@@ -202,7 +220,20 @@ class Runtime:
         await self.lifespan_networks()
         await self.lifespan_uefi()
         await self.lifespan_bootstrap()
+        await self.prefetch_service.start()
+        await self.disk_pool_service.start()
+        await self.gc_service.start()
+        await self.disk_stats_service.start()
+        await self.phone_home_service.start()
+        await self.qemu_service.reattach()
         yield
+        await self.phone_home_service.stop()
+        await self.disk_stats_service.stop()
+        await self.gc_service.stop()
+        await self.disk_pool_service.stop()
+        await self.prefetch_service.stop()
+        await self.supervisor_service.stop()
+        await self.qemu_service.stop()
 
     @property
     def task_repository(self) -> TaskRepository:
@@ -236,10 +267,58 @@ class Runtime:
     def event_service(self) -> EventService:
         return self._event_service
 
+    @property
+    def process_service(self) -> ProcessService:
+        return self._process_service
+
+    @property
+    def supervisor_service(self) -> SupervisorService:
+        return self._supervisor_service
+
     @property
     def qemu_service(self) -> QEMUService:
         return self._qemu_service
 
+    @property
+    def phone_home_service(self) -> PhoneHomeService:
+        return self._phone_home_service
+
+    @property
+    def bandwidth_service(self) -> BandwidthService:
+        return self._bandwidth_service
+
+    @property
+    def download_service(self) -> DownloadService:
+        return self._download_service
+
+    @property
+    def prefetch_service(self) -> PrefetchService:
+        return self._prefetch_service
+
+    @property
+    def disk_pool_service(self) -> DiskPoolService:
+        return self._disk_pool_service
+
+    @property
+    def capacity_service(self) -> CapacityService:
+        return self._capacity_service
+
+    @property
+    def resource_service(self) -> ResourceService:
+        return self._resource_service
+
+    @property
+    def display_service(self) -> DisplayService:
+        return self._display_service
+
+    @property
+    def gc_service(self) -> GCService:
+        return self._gc_service
+
+    @property
+    def disk_stats_service(self) -> DiskStatsService:
+        return self._disk_stats_service
+
     @property
     def config(self) -> Config:
         return self._config
@@ -0,0 +1,76 @@
+"""
+Benchmark the download sinks
+
+Compares the CPU time, wall time and disk usage of writing a mostly empty raw image through
+the sinks of the download service with different buffer sizes. Run it directly, it is not
+collected as a test:
+
+    python tests/bench_download.py [--size MiB] [--chunk-size bytes]
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+import resource
+import tempfile
+import time
+
+from kaso_mashin.common.services.download import FileSink, QCoW2Sink
+
+
+def payload_chunks(size: int, chunk_size: int):
+    """
+    Produce a payload resembling a cloud image, with data at the start and mostly zeros after it
+    """
+    data = os.urandom(chunk_size)
+    zero = bytes(chunk_size)
+    for offset in range(0, size, chunk_size):
+        yield data if offset < size // 8 or offset % (64 * chunk_size) == 0 else zero
+
+
+async def bench(sink, size: int, chunk_size: int) -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    await sink.open()
+    for chunk in payload_chunks(size, chunk_size):
+        await sink.write(chunk)
+    await sink.close()
+    elapsed = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    stat = sink._path.stat()
+    return {
+        "wall": elapsed,
+        "cpu": after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime,
+        "apparent": stat.st_size,
+        "allocated": stat.st_blocks * 512,
+    }
+
+
+async def main(size: int, chunk_size: int):
+    with tempfile.TemporaryDirectory(prefix="kaso-bench") as temp:
+        temp_dir = pathlib.Path(temp)
+        candidates = {
+            "dense, 64 KiB buffer": FileSink(temp_dir / "dense.img", buffer_size=65536),
+            "sparse, 64 KiB buffer": FileSink(
+                temp_dir / "sparse-small.img", sparse=True, buffer_size=65536
+            ),
+            "sparse, 8 MiB buffer": FileSink(temp_dir / "sparse.img", sparse=True),
+            "qcow2, 64 KiB buffer": QCoW2Sink(temp_dir / "small.qcow2", buffer_size=65536),
+            "qcow2, 8 MiB buffer": QCoW2Sink(temp_dir / "large.qcow2"),
+        }
+        print(f"{'Sink':<24}{'Wall [s]':>10}{'CPU [s]':>10}{'Size [MiB]':>12}{'Disk [MiB]':>12}")
+        for name, sink in candidates.items():
+            result = await bench(sink, size, chunk_size)
+            print(
+                f"{name:<24}{result['wall']:>10.2f}{result['cpu']:>10.2f}"
+                f"{result['apparent'] / 1048576:>12.1f}{result['allocated'] / 1048576:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the download sinks")
+    parser.add_argument("--size", type=int, default=1024, help="Payload size in MiB")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Bytes per write")
+    args = parser.parse_args()
+    asyncio.run(main(args.size * 1048576, args.chunk_size))
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import pytest
+
+from kaso_mashin.common.services import BandwidthGetSchema, BandwidthModifySchema
+from kaso_mashin.common.services.bandwidth import TokenBucket
+
+
+@pytest.mark.asyncio(scope="session")
+class TestBandwidth:
+    """
+    Test behaviour of the bandwidth governor
+    """
+
+    async def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000000)
+        started = time.monotonic()
+        for _ in range(6):
+            await bucket.consume(250000)
+        # One second of burst is available immediately, the remainder takes half a second
+        assert 0.4 < time.monotonic() - started < 1.0
+
+    async def test_unlimited(self):
+        bucket = TokenBucket(rate=0)
+        started = time.monotonic()
+        await bucket.consume(1 << 40)
+        assert time.monotonic() - started < 0.1
+
+    async def test_fair_share(self, test_context_empty):
+        service = test_context_empty.runtime.bandwidth_service
+        service.configure(rate_limit=2000000)
+        try:
+
+            async def run(name: str) -> int:
+                async with service.transfer(name=name) as transfer:
+                    deadline = time.monotonic() + 0.5
+                    while time.monotonic() < deadline:
+                        await transfer.throttle(65536)
+                        # Stands in for the network read between chunks
+                        await asyncio.sleep(0)
+                    return transfer.transferred
+
+            first, second = await asyncio.gather(run("first"), run("second"))
+            assert abs(first - second) <= 2 * 65536
+        finally:
+            service.configure(rate_limit=0)
+
+    async def test_low_priority(self, test_context_empty):
+        service = test_context_empty.runtime.bandwidth_service
+        async with service.transfer(name="interactive"):
+            async with service.transfer(name="prefetch", low_priority=True) as prefetch:
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(prefetch.throttle(1), timeout=0.1)
+        async with service.transfer(name="prefetch", low_priority=True) as prefetch:
+            await asyncio.wait_for(prefetch.throttle(1), timeout=0.1)
+
+    async def test_bandwidth_api(self, test_context_empty):
+        resp = test_context_empty.client.put(
+            "/api/config/bandwidth",
+            content=BandwidthModifySchema(rate_limit_per_transfer=1048576).model_dump_json(),
+        )
+        assert 200 == resp.status_code
+        schema = BandwidthGetSchema.model_validate_json(resp.content)
+        assert 1048576 == schema.rate_limit_per_transfer
+        assert 0 == schema.rate_limit
+        resp = test_context_empty.client.get("/api/config/bandwidth")
+        assert (
+            1048576 == BandwidthGetSchema.model_validate_json(resp.content).rate_limit_per_transfer
+        )
+        assert 1048576 == test_context_empty.runtime.config.download_rate_limit_per_transfer
+        test_context_empty.runtime.bandwidth_service.configure(rate_limit_per_transfer=0)
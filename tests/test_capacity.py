@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import DiskEntity, DiskFormat
+from kaso_mashin.common.services import CapacityException, CapacityGetSchema
+
+
+@pytest.mark.asyncio(scope="session")
+class TestCapacityService:
+    """
+    Test disk space accounting and admission of disk creations
+    """
+
+    async def test_get_api(self, test_context_empty):
+        resp = test_context_empty.client.get("/api/capacity/")
+        assert 200 == resp.status_code
+        capacity = CapacityGetSchema.model_validate_json(resp.content)
+        assert capacity.total > 0
+        assert 0 == capacity.provisioned
+        assert 0 == capacity.reserved
+        assert capacity.available == int(capacity.overcommit_ratio * capacity.total)
+
+    async def test_reject(self, test_context_empty, tmp_path):
+        with pytest.raises(CapacityException) as ce:
+            await DiskEntity.create(
+                name="Too Large",
+                path=tmp_path / "large.qcow2",
+                size=BinarySizedValue(1, BinaryScale.E),
+                disk_format=DiskFormat.QCoW2,
+            )
+        assert 507 == ce.value.status
+        assert "overcommit ratio" in ce.value.msg
+        assert not (tmp_path / "large.qcow2").exists()
+
+    async def test_min_free(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        runtime.config.disk_min_free_ratio = 1.0
+        try:
+            with pytest.raises(CapacityException) as ce:
+                async with runtime.capacity_service.reserve(1):
+                    pass
+            assert "below the minimum" in ce.value.msg
+        finally:
+            runtime.config.disk_min_free_ratio = 0.05
+
+    async def test_queue(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.capacity_service
+        usage = await service.usage()
+        runtime.config.capacity_queue_timeout = 5
+        try:
+            admitted = asyncio.Event()
+
+            async def second():
+                async with service.reserve(usage.available):
+                    admitted.set()
+
+            async with service.reserve(usage.available):
+                waiter = asyncio.create_task(second())
+                await asyncio.sleep(0.2)
+                assert not admitted.is_set()
+                assert 1 == (await service.usage()).waiting
+            await asyncio.wait_for(waiter, timeout=5)
+            assert admitted.is_set()
+            assert 0 == (await service.usage()).reserved
+        finally:
+            runtime.config.capacity_queue_timeout = 0
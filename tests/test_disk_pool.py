@@ -0,0 +1,65 @@
+import pytest
+from test_qcow2 import write_overlay
+
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import DiskEntity, DiskFormat, ImageEntity
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDiskPool:
+    """
+    Test claiming overlay disks from the warm pool
+    """
+
+    async def test_claim(self, test_context_empty, tmp_path):
+        runtime = test_context_empty.runtime
+        service = runtime.disk_pool_service
+        image_path = tmp_path / "image.qcow2"
+        image_path.write_bytes(bytes(65536))
+        image = await runtime.image_repository.create(
+            ImageEntity(
+                name="Pooled Image", url="https://example.com/pooled.qcow2", path=image_path
+            )
+        )
+        size = BinarySizedValue(2, BinaryScale.G)
+        target = tmp_path / "os.qcow2"
+        disk = None
+        try:
+            # The pool is disabled by default
+            assert not await service.claim(image, size, DiskFormat.QCoW2, target)
+
+            runtime.config.disk_pool_size = 2
+            service.path.mkdir(parents=True, exist_ok=True)
+            stale = service.path / f"{image.uid}_{size}_stale.qcow2"
+            write_overlay(stale, backing_file=str(tmp_path / "old.qcow2"), virtual_size=2 << 30)
+            (service.path / "garbage").write_bytes(b"")
+            await service.start()
+            assert not (service.path / "garbage").exists()
+            assert not await service.claim(image, size, DiskFormat.QCoW2, target)
+            assert not stale.exists()
+            assert not target.exists()
+            await service.stop()
+
+            runtime.config.disk_pool_size = 1
+            current = service.path / f"{image.uid}_{size}_current.qcow2"
+            write_overlay(current, backing_file=str(image_path), virtual_size=2 << 30)
+            await service.start()
+            assert [current] == service.entries[service.key(image, size, DiskFormat.QCoW2)]
+            disk = await DiskEntity.create(
+                name="Pooled Disk",
+                path=target,
+                size=size,
+                disk_format=DiskFormat.QCoW2,
+                image=image,
+            )
+            assert target.exists()
+            assert not current.exists()
+            assert 1 == disk.chain_depth
+        finally:
+            if disk is not None:
+                await disk.remove()
+            runtime.config.disk_pool_size = 0
+            await service.stop()
+            for candidate in service.path.iterdir():
+                candidate.unlink()
+            await runtime.image_repository.remove(image.uid)
@@ -0,0 +1,100 @@
+import asyncio
+import tempfile
+
+import pytest
+from test_qemu import FakeQMP, qmp_instance
+
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import DiskEntity, DiskFormat
+from kaso_mashin.common.services import (
+    DiskStatsRing,
+    DiskStatsSchema,
+    DiskStatsSource,
+    QMPException,
+)
+
+
+class TestDiskStatsRing:
+    """
+    Test the ring buffer of disk counters
+    """
+
+    def test_wraps(self):
+        ring = DiskStatsRing(3)
+        for timestamp in range(5):
+            ring.append(timestamp, 0, timestamp * 10, 0, 0, 0, 0)
+        assert 3 == len(ring)
+        assert [2.0, 3.0, 4.0] == [sample[0] for sample in ring.samples()]
+        assert [3.0, 4.0] == [sample[0] for sample in ring.samples(since=3)]
+        assert 40.0 == ring.samples()[-1][2]
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDiskStatsService:
+    """
+    Test sampling and downsampling disk activity
+    """
+
+    async def test_allocation(self, test_context_empty, tmp_path):
+        runtime = test_context_empty.runtime
+        service = runtime.disk_stats_service
+        disk = await runtime.disk_repository.create(
+            DiskEntity(
+                name="Sampled Disk",
+                path=tmp_path / "sampled.raw",
+                size=BinarySizedValue(1, BinaryScale.M),
+                disk_format=DiskFormat.Raw,
+            )
+        )
+        try:
+            (tmp_path / "sampled.raw").write_bytes(bytes(4096))
+            await service.sample()
+            await asyncio.sleep(0.05)
+            with open(tmp_path / "sampled.raw", "ab") as f:
+                f.write(b"\x01" * 65536)
+            await service.sample()
+            stats = service.stats(disk.uid, points=10, window=60)
+            assert DiskStatsSource.ALLOCATION == stats.source
+            assert 1 == len(stats.entries)
+            assert stats.entries[0].allocation_growth_per_second > 0
+            assert 0 == stats.entries[0].write_bytes_per_second
+
+            resp = test_context_empty.client.get(
+                f"/api/disks/{disk.uid}/stats", params={"points": 10, "window": 60}
+            )
+            assert 200 == resp.status_code
+            assert stats == DiskStatsSchema.model_validate_json(resp.content)
+        finally:
+            await runtime.disk_repository.remove(disk.uid)
+            await service.sample()
+        assert [] == service.stats(disk.uid).entries
+
+    async def test_qmp(self, test_context_empty, tmp_path):
+        service = test_context_empty.runtime.disk_stats_service
+        disk_path = tmp_path / "os.qcow2"
+        counters = {"rd_bytes": 0, "wr_bytes": 0, "rd_operations": 0, "wr_operations": 0}
+
+        def blockstats(_):
+            counters["rd_bytes"] += 8192
+            counters["rd_operations"] += 2
+            return [{"device": "hd0", "stats": dict(counters)}, {"device": "cd0", "stats": {}}]
+
+        replies = {
+            "query-block": [
+                {"device": "hd0", "inserted": {"file": str(disk_path)}},
+                {"device": "cd0"},
+            ],
+            "query-blockstats": blockstats,
+        }
+        with tempfile.TemporaryDirectory(dir="/tmp") as socket_dir:
+            instance = qmp_instance("stats", socket_dir)
+            qmp_path = test_context_empty.runtime.qemu_service.qmp_path(instance)
+            async with FakeQMP(qmp_path, replies) as qmp:
+                first = await service._instance_counters(instance)
+                second = await service._instance_counters(instance)
+            assert {str(disk_path): (8192, 0, 2, 0)} == first
+            assert {str(disk_path): (16384, 0, 4, 0)} == second
+            assert 1 == qmp.connections
+            assert "query-blockstats" in qmp.commands
+        with pytest.raises(QMPException):
+            await service._instance_counters(instance)
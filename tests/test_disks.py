@@ -3,6 +3,7 @@ import uuid
 
 import pytest
 from conftest import seed, BaseTest, qemu_img_available
+from test_qemu import instance_entity
 
 from kaso_mashin.common import (
     UniqueIdentifier,
@@ -10,14 +11,24 @@ from kaso_mashin.common import (
     BinarySizedValue,
     BinaryScale,
 )
+from kaso_mashin.common import qcow2
 from kaso_mashin.common.entities import (
+    ImageEntity,
     DiskModel,
     DiskEntity,
     DiskListSchema,
     DiskGetSchema,
     DiskModifySchema,
+    DiskCreateSchema,
+    DiskBatchCreateSchema,
     DiskFormat,
+    DiskException,
+    InstanceState,
+    SnapshotKind,
+    TaskEntity,
+    TaskState,
 )
+from kaso_mashin.common.entities.tasks import TaskRelation
 
 
 @pytest.mark.asyncio(scope="session")
@@ -116,3 +127,248 @@ class TestSeededDisks(BaseTest[DiskModel, DiskEntity, DiskGetSchema]):
         finally:
             if entity is not None:
                 await entity.remove()
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDiskOperations:
+    """
+    Test snapshot, clone and rebase of Disk entities
+    """
+
+    async def test_invalid_operations(self, test_context_seeded, tmp_path):
+        disk = await test_context_seeded.runtime.disk_repository.get_by_uid(
+            seed["disks"][0].uid
+        )
+        task = await TaskEntity.create(name="Snapshot", relation=TaskRelation.DISKS)
+        with pytest.raises(DiskException) as de:
+            await disk.snapshot(task=task, name="internal", kind=SnapshotKind.INTERNAL)
+        assert 400 == de.value.status
+        assert TaskState.FAILED == task.state
+
+        existing = tmp_path / "existing.qcow2"
+        existing.write_bytes(b"precious")
+        task = await TaskEntity.create(name="Clone", relation=TaskRelation.DISKS)
+        with pytest.raises(DiskException):
+            await disk.clone(task=task, name="clone", path=existing)
+        assert TaskState.FAILED == task.state
+        assert b"precious" == existing.read_bytes()
+
+        task = await TaskEntity.create(name="Flatten", relation=TaskRelation.DISKS)
+        with pytest.raises(DiskException):
+            await disk.flatten(task=task)
+        assert TaskState.FAILED == task.state
+
+    async def test_snapshot_in_use(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        instance = instance_entity(tmp_path)
+        disk = instance.os_disk
+        qcow2.create(disk.path, 1 << 20)
+        entities = [instance.image, instance.network, instance.bootstrap, disk]
+        for entity in entities:
+            await entity.repository.create(entity)
+        await runtime.instance_repository.create(instance)
+        try:
+            await runtime.instance_repository.record_state(instance.uid, InstanceState.PAUSED)
+            task = await TaskEntity.create(name="Snapshot", relation=TaskRelation.DISKS)
+            with pytest.raises(DiskException) as de:
+                await disk.snapshot(task=task, name="Frozen", path=tmp_path / "frozen.qcow2")
+            assert 409 == de.value.status
+            assert instance.name in de.value.msg
+            assert TaskState.FAILED == task.state
+            assert not (tmp_path / "frozen.qcow2").exists()
+
+            await runtime.instance_repository.record_state(instance.uid, InstanceState.STOPPED)
+            task = await TaskEntity.create(name="Snapshot", relation=TaskRelation.DISKS)
+            snapshot = await disk.snapshot(task=task, name="Frozen", path=tmp_path / "frozen.qcow2")
+            assert TaskState.DONE == task.state
+            entities.append(snapshot)
+        finally:
+            await runtime.instance_repository.remove(instance.uid)
+            for entity in reversed(entities):
+                await entity.repository.remove(entity.uid)
+
+    async def test_backing_disks(self, test_context_empty, tmp_path):
+        disk = await DiskEntity.create(
+            name="Golden",
+            path=tmp_path / "golden.qcow2",
+            size=BinarySizedValue(1, BinaryScale.M),
+            disk_format=DiskFormat.QCoW2,
+        )
+        task = await TaskEntity.create(name="Snapshot", relation=TaskRelation.DISKS)
+        snapshot = await disk.snapshot(task=task, name="Frozen", path=tmp_path / "frozen.qcow2")
+        task = await TaskEntity.create(name="Clone", relation=TaskRelation.DISKS)
+        clone = await snapshot.clone(task=task, name="Clone", path=tmp_path / "clone.qcow2")
+
+        # Disks layered on the snapshot would be left without their backing file
+        with pytest.raises(DiskException) as de:
+            await snapshot.remove()
+        assert 409 == de.value.status
+        assert "Golden" in de.value.msg and "Clone" in de.value.msg
+        assert snapshot.path.exists()
+
+        for backing in (snapshot, clone):
+            task = await TaskEntity.create(name="Rebase", relation=TaskRelation.DISKS)
+            with pytest.raises(DiskException) as de:
+                await snapshot.rebase(task=task, backing=backing)
+            assert 400 == de.value.status
+            assert TaskState.FAILED == task.state
+        assert snapshot.parent_uid is None
+
+        for entity in (clone, disk, snapshot):
+            await entity.remove()
+        assert not snapshot.path.exists()
+
+    @pytest.mark.skipif(not qemu_img_available(), reason="qemu-img is unavailable")
+    async def test_snapshot_clone_flatten(self, test_context_empty, tmp_path):
+        disk = await DiskEntity.create(
+            name="Golden",
+            path=tmp_path / "golden.qcow2",
+            size=BinarySizedValue(1, BinaryScale.M),
+            disk_format=DiskFormat.QCoW2,
+        )
+        task = await TaskEntity.create(name="Snapshot", relation=TaskRelation.DISKS)
+        snapshot = await disk.snapshot(task=task, name="Frozen", path=tmp_path / "frozen.qcow2")
+        assert disk.parent_uid == snapshot.uid
+        assert 1 == disk.chain_depth
+        task = await TaskEntity.create(name="Clone", relation=TaskRelation.DISKS)
+        clone = await snapshot.clone(task=task, name="Clone", path=tmp_path / "clone.qcow2")
+        assert clone.parent_uid == snapshot.uid
+        task = await TaskEntity.create(name="Flatten", relation=TaskRelation.DISKS)
+        await clone.flatten(task=task)
+        assert TaskState.DONE == task.state
+        assert clone.parent_uid is None
+        assert 0 == clone.chain_depth
+        for entity in (clone, disk, snapshot):
+            await entity.remove()
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDiskCreation:
+    """
+    Test creating disk files without qemu-img
+    """
+
+    async def test_create_native(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        qemu_img_path = runtime.config.qemu_img_path
+        runtime.config.qemu_img_path = pathlib.Path("/no/where/qemu-img")
+        image_path = tmp_path / "image.qcow2"
+        qcow2.create(image_path, 1 << 30)
+        image = await runtime.image_repository.create(
+            ImageEntity(
+                name="Native Image", url="https://example.com/native.qcow2", path=image_path
+            )
+        )
+        disks = []
+        try:
+            for name, disk_format, disk_image in (
+                ("raw", DiskFormat.Raw, None),
+                ("empty", DiskFormat.QCoW2, None),
+                ("overlay", DiskFormat.QCoW2, image),
+            ):
+                disks.append(
+                    await DiskEntity.create(
+                        name=name,
+                        path=tmp_path / f"{name}.{disk_format}",
+                        size=BinarySizedValue(2, BinaryScale.G),
+                        disk_format=disk_format,
+                        image=disk_image,
+                    )
+                )
+            raw, empty, overlay = disks
+            assert 2 << 30 == raw.path.stat().st_size
+            assert 2 << 30 == raw.virtual_size
+            assert 2 << 30 == empty.virtual_size
+            assert 0 == empty.chain_depth
+            assert 1 == overlay.chain_depth
+            assert image_path == overlay.chain[1].path
+            assert "qcow2" == overlay.chain[0].backing_format
+            assert all(disk.allocated_size < 1 << 20 for disk in disks)
+
+            with pytest.raises(DiskException):
+                await DiskEntity.create(
+                    name="vdi", path=tmp_path / "disk.vdi", disk_format=DiskFormat.VDI
+                )
+            assert not (tmp_path / "disk.vdi").exists()
+        finally:
+            runtime.config.qemu_img_path = qemu_img_path
+            for disk in disks:
+                await disk.remove()
+            await runtime.image_repository.remove(image.uid)
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDiskBatch:
+    """
+    Test creating many Disk entities at once
+    """
+
+    async def test_repository_create_many(self, test_context_empty, tmp_path):
+        repository = test_context_empty.runtime.disk_repository
+        disks = [
+            DiskEntity(name=f"Batch {i}", path=tmp_path / f"batch-{i}.qcow2") for i in range(10)
+        ]
+        assert disks == await repository.create_many(disks)
+        try:
+            assert {disk.uid for disk in disks} == {disk.uid for disk in await repository.list()}
+        finally:
+            for disk in disks:
+                await repository.remove(disk.uid)
+
+    async def test_create_many_invalid(self, test_context_empty, tmp_path):
+        size = BinarySizedValue(1, BinaryScale.M)
+        existing = tmp_path / "existing.qcow2"
+        existing.write_bytes(b"precious")
+        for disks in (
+            [
+                DiskCreateSchema(name="a", path=tmp_path / "a.raw", size=size, disk_format="raw"),
+                DiskCreateSchema(name="b", path=tmp_path / "a.raw", size=size, disk_format="raw"),
+            ],
+            [
+                DiskCreateSchema(name="a", path=tmp_path / "a.raw", size=size, disk_format="raw"),
+                DiskCreateSchema(name="b", path=existing, size=size, disk_format="raw"),
+            ],
+            [
+                DiskCreateSchema(
+                    name="a",
+                    path=tmp_path / "a.raw",
+                    size=size,
+                    disk_format="raw",
+                    image_uid=uuid.uuid4(),
+                ),
+            ],
+        ):
+            task = await TaskEntity.create(name="Batch", relation=TaskRelation.DISKS)
+            with pytest.raises(DiskException) as de:
+                await DiskEntity.create_many(task=task, disks=disks)
+            assert 400 == de.value.status
+            assert TaskState.FAILED == task.state
+        assert b"precious" == existing.read_bytes()
+        assert not (tmp_path / "a.raw").exists()
+        assert [] == await test_context_empty.runtime.disk_repository.list()
+
+        resp = test_context_empty.client.post("/api/disks/batch", json={"entries": []})
+        assert 422 == resp.status_code
+
+    async def test_create_batch_api(self, test_context_empty, tmp_path):
+        schema = DiskBatchCreateSchema(
+            entries=[
+                DiskCreateSchema(
+                    name=f"Data {i}",
+                    path=tmp_path / f"data-{i}.qcow2",
+                    size=BinarySizedValue(1, BinaryScale.M),
+                    disk_format=DiskFormat.QCoW2,
+                )
+                for i in range(20)
+            ]
+        )
+        resp = test_context_empty.client.post("/api/disks/batch", content=schema.model_dump_json())
+        assert 201 == resp.status_code
+        # Entities record themselves in the runtime of the context that was set up last
+        task = await TaskEntity.repository.get_by_uid(UniqueIdentifier(resp.json()["uid"]))
+        assert TaskState.DONE == task.state, task.msg
+        disks = [d for d in await DiskEntity.repository.list() if d.path.parent == tmp_path]
+        assert 20 == len(disks)
+        for disk in disks:
+            assert disk.path.exists()
+            await disk.remove()
@@ -0,0 +1,88 @@
+import pathlib
+import tempfile
+
+import pytest
+from test_qemu import fake_qemu, instance_entity
+
+from kaso_mashin.common.entities import DiskEntity, InstanceState
+from kaso_mashin.common.services import DisplayException
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDisplayService:
+    """
+    Test allocating distinct VNC displays to running instances
+    """
+
+    async def test_allocate(self, test_context_empty, tmp_path):
+        runtime = test_context_empty.runtime
+        service = runtime.display_service
+        vnc_displays = runtime.config.vnc_displays
+        runtime.config.vnc_displays = 3
+        instances = [instance_entity(tmp_path) for _ in range(4)]
+        try:
+            assert [0, 1, 2] == [service.allocate(instance) for instance in instances[:3]]
+            assert 1 == service.allocate(instances[1])
+            with pytest.raises(DisplayException):
+                service.allocate(instances[3])
+
+            # The lowest display released is allocated next
+            await runtime.event_service.on_instance_state(instances[1].uid, InstanceState.STOPPED)
+            assert service.display(instances[1].uid) is None
+            assert 1 == service.allocate(instances[3])
+
+            assert not service.claim(instances[1], 2)
+            service.release(instances[2].uid)
+            assert service.claim(instances[1], 2)
+            assert service.claim(instances[1], 2)
+            assert 2 == service.display(instances[1].uid)
+            assert 5902 == service.port(2)
+        finally:
+            runtime.config.vnc_displays = vnc_displays
+            for instance in instances:
+                service.release(instance.uid)
+
+    async def test_start(self, test_context_empty):
+        runtime = DiskEntity.runtime
+        service = runtime.display_service
+        qemu_path = runtime.config.qemu_aarch64_path
+        with tempfile.TemporaryDirectory(dir="/tmp") as instance_dir:
+            runtime.config.qemu_aarch64_path = fake_qemu(pathlib.Path(instance_dir))
+            instance = instance_entity(pathlib.Path(instance_dir))
+            entities = [instance.image, instance.network, instance.bootstrap, instance.os_disk]
+            for entity in entities:
+                await entity.repository.create(entity)
+            await runtime.instance_repository.create(instance)
+            other = instance_entity(pathlib.Path(instance_dir))
+            try:
+                taken = service.allocate(other)
+                await runtime.qemu_service.start_instance(instance)
+                display = service.display(instance.uid)
+                assert display is not None and display != taken
+                args = runtime.qemu_service.instance_args(instance)
+                assert f"localhost:{display},power-control=on" in args
+                assert (
+                    f"unix:{runtime.qemu_service.serial_path(instance)},server=on,wait=off" in args
+                )
+                recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+                assert display == recorded.vnc_display
+                assert service.port(display) == recorded.vnc_port
+
+                # The guest shutting down does not release the display of a process that may
+                # be restarted with it
+                await runtime.event_service.on_instance_state(instance.uid, InstanceState.STOPPED)
+                assert display == service.display(instance.uid)
+                recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+                assert display == recorded.vnc_display
+
+                assert InstanceState.STOPPED == await runtime.qemu_service.stop_instance(instance)
+                assert service.display(instance.uid) is None
+                recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+                assert recorded.vnc_display is None
+            finally:
+                runtime.config.qemu_aarch64_path = qemu_path
+                service.release(other.uid)
+                await runtime.qemu_service.stop_instance(instance)
+                await runtime.instance_repository.remove(instance.uid)
+                for entity in entities:
+                    await entity.repository.remove(entity.uid)
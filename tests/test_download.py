@@ -0,0 +1,199 @@
+import bz2
+import functools
+import gzip
+import http.server
+import json
+import lzma
+import os
+import pathlib
+import struct
+import threading
+import uuid
+
+import pytest
+
+from kaso_mashin.common import qcow2
+from kaso_mashin.common.services.download import DECOMPRESS_PIECE_SIZE, FileSink, QCoW2Sink
+
+
+def read_qcow2(path: pathlib.Path) -> bytes:
+    """
+    Read back the guest view of a QCoW2 image without a backing file
+    """
+    data = path.read_bytes()
+    header = qcow2.QCOW2_HEADER.unpack_from(data)
+    cluster_size = 1 << header[4]
+    virtual_size, l1_size, l1_offset = header[5], header[7], header[8]
+    l2_size = cluster_size // 8
+    guest = bytearray(virtual_size)
+    for l1_index in range(l1_size):
+        (l1_entry,) = struct.unpack_from(">Q", data, l1_offset + l1_index * 8)
+        l2_offset = l1_entry & qcow2.QCOW2_OFFSET_MASK
+        if l2_offset == 0:
+            continue
+        for l2_index in range(l2_size):
+            (l2_entry,) = struct.unpack_from(">Q", data, l2_offset + l2_index * 8)
+            host = l2_entry & qcow2.QCOW2_OFFSET_MASK
+            if host == 0:
+                continue
+            start = (l1_index * l2_size + l2_index) * cluster_size
+            length = min(cluster_size, virtual_size - start)
+            guest[start : start + length] = data[host : host + length]
+    return bytes(guest)
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """
+    Serve a temporary directory over HTTP
+    """
+    served = tmp_path / "served"
+    served.mkdir()
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield served, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.mark.asyncio(scope="session")
+class TestDownloadPipeline:
+    """
+    Test the streaming stages and sinks of the download service
+    """
+
+    @pytest.mark.parametrize(
+        "suffix,compress",
+        [(".xz", lzma.compress), (".gz", gzip.compress), (".bz2", bz2.compress)],
+    )
+    async def test_decompress(self, test_context_empty, suffix, compress):
+        payload = os.urandom(200000)
+        compressed = compress(payload[:100000]) + compress(payload[100000:])
+        stage = test_context_empty.runtime.download_service.stage_for(
+            f"https://example.com/image.qcow2{suffix}"
+        )
+        out = b"".join(
+            piece
+            for offset in range(0, len(compressed), 4096)
+            for piece in stage.feed(compressed[offset : offset + 4096])
+        )
+        assert payload == out + stage.flush()
+
+    @pytest.mark.parametrize(
+        "suffix,compress",
+        [(".xz", lzma.compress), (".gz", gzip.compress), (".bz2", bz2.compress)],
+    )
+    async def test_decompress_bounded(self, test_context_empty, suffix, compress):
+        payload = bytes(8000000) + os.urandom(1000)
+        stage = test_context_empty.runtime.download_service.stage_for(
+            f"https://example.com/image.img{suffix}"
+        )
+        pieces = list(stage.feed(compress(payload)))
+        assert max(len(piece) for piece in pieces) <= DECOMPRESS_PIECE_SIZE
+        assert payload == b"".join(pieces) + stage.flush()
+
+    async def test_uncompressed(self, test_context_empty):
+        assert (
+            test_context_empty.runtime.download_service.stage_for("https://example.com/image.img")
+            is None
+        )
+
+    async def test_sink_for(self, test_context_empty, tmp_path):
+        service = test_context_empty.runtime.download_service
+        assert isinstance(service.sink_for(tmp_path / "a", qcow2.QCOW2_MAGIC, True), FileSink)
+        assert isinstance(service.sink_for(tmp_path / "b", b"\x00\x00\x00\x00", True), QCoW2Sink)
+        assert isinstance(service.sink_for(tmp_path / "c", b"\x00\x00\x00\x00", False), FileSink)
+
+    async def test_file_sink_sparse(self, tmp_path):
+        payload = os.urandom(70000) + bytes(4000000) + os.urandom(1000) + bytes(100000)
+        path = tmp_path / "sparse.img"
+        sink = FileSink(path, sparse=True, buffer_size=1048576)
+        await sink.open()
+        for offset in range(0, len(payload), 100000):
+            await sink.write(payload[offset : offset + 100000])
+        assert len(payload) == await sink.close()
+        assert payload == path.read_bytes()
+        # The zero blocks were skipped rather than written
+        assert path.stat().st_blocks * 512 < len(payload) // 2
+
+    async def test_file_sink_preallocated(self, tmp_path):
+        payload = qcow2.QCOW2_MAGIC + os.urandom(300000)
+        path = tmp_path / "preallocated.qcow2"
+        sink = FileSink(path, size=len(payload) + 4096, buffer_size=65536)
+        await sink.open()
+        await sink.write(payload)
+        assert len(payload) == await sink.close()
+        assert payload == path.read_bytes()
+
+    async def test_qcow2_sink(self, tmp_path):
+        payload = os.urandom(70000) + bytes(4000000) + os.urandom(1000)
+        path = tmp_path / "converted.qcow2"
+        sink = QCoW2Sink(path)
+        await sink.open()
+        for offset in range(0, len(payload), 100000):
+            await sink.write(payload[offset : offset + 100000])
+        assert len(payload) == await sink.close()
+        assert qcow2.is_qcow2(path.read_bytes())
+        assert read_qcow2(path)[: len(payload)] == payload
+        # The zero clusters in between the random data are not allocated
+        assert path.stat().st_size < len(payload)
+
+    async def test_download(self, test_context_empty, http_server, tmp_path):
+        served, url = http_server
+        payload = qcow2.QCOW2_MAGIC + os.urandom(100000)
+        (served / "image.qcow2.xz").write_bytes(lzma.compress(payload))
+        path = tmp_path / "image.qcow2"
+        service = test_context_empty.runtime.download_service
+        result = await service.download(
+            url=f"{url}/image.qcow2.xz", path=path, convert_to_qcow2=True
+        )
+        assert len(payload) == result.size
+        assert payload == path.read_bytes()
+        assert result.last_modified is not None
+
+        path.unlink()
+        result = await service.download(
+            url=f"{url}/image.qcow2.xz", path=path, last_modified=result.last_modified
+        )
+        assert result.not_modified
+        assert not path.exists()
+
+    async def test_download_from_peers(self, test_context_empty, http_server, tmp_path):
+        served, url = http_server
+        payload = qcow2.QCOW2_MAGIC + os.urandom(100000)
+        uid = str(uuid.uuid4())
+        # The served directory mimics the image API of a peer server
+        (served / "api" / "images" / uid).mkdir(parents=True)
+        (served / "api" / "images" / uid / "content").write_bytes(payload)
+        (served / "api" / "images" / "index.html").write_text(
+            json.dumps(
+                {
+                    "entries": [
+                        {
+                            "uid": uid,
+                            "url": "https://example.com/image.qcow2.xz",
+                            "etag": '"origin"',
+                            "last_modified": None,
+                        }
+                    ]
+                }
+            )
+        )
+        service = test_context_empty.runtime.download_service
+        path = tmp_path / "image.qcow2"
+        assert (
+            await service.download_from_peers(
+                url="https://example.com/other.qcow2", peers=[url], path=path
+            )
+            is None
+        )
+        result = await service.download_from_peers(
+            url="https://example.com/image.qcow2.xz",
+            peers=["http://127.0.0.1:1", url],
+            path=path,
+            convert_to_qcow2=True,
+        )
+        assert result is not None
+        assert '"origin"' == result.etag
+        assert payload == path.read_bytes()
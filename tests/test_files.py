@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from kaso_mashin.common import files
+
+
+@pytest.mark.asyncio(scope="session")
+class TestCloneFile:
+    """
+    Test copying files as cheaply as the platform allows
+    """
+
+    async def test_clone(self, tmp_path):
+        payload = os.urandom(3 << 20)
+        source = tmp_path / "uefi_vars.fd"
+        source.write_bytes(payload)
+        destination = tmp_path / "instance_uefi_vars.fd"
+        method = files.clone_file(source, destination)
+        assert method in ("reflink", "clonefile", "copy_file_range", "sendfile", "copy")
+        assert payload == destination.read_bytes()
+
+        # The clone is independent of its source
+        with open(destination, "r+b") as f:
+            f.write(b"modified")
+        assert payload == source.read_bytes()
+
+    async def test_fallbacks(self, tmp_path, monkeypatch):
+        payload = os.urandom(1 << 20)
+        source = tmp_path / "source"
+        source.write_bytes(payload)
+        monkeypatch.setattr(files, "_reflink", lambda *_: False)
+        monkeypatch.setattr(files, "_clonefile", lambda *_: False)
+        if hasattr(os, "copy_file_range"):
+            assert "copy_file_range" == files.clone_file(source, tmp_path / "copy_file_range")
+            assert payload == (tmp_path / "copy_file_range").read_bytes()
+            monkeypatch.delattr(os, "copy_file_range")
+        if hasattr(os, "sendfile") and os.uname().sysname == "Linux":
+            assert "sendfile" == files.clone_file(source, tmp_path / "sendfile")
+            assert payload == (tmp_path / "sendfile").read_bytes()
+        monkeypatch.setattr(files, "_copy_in_kernel", lambda *_: None)
+        destination = tmp_path / "copy"
+        destination.write_bytes(os.urandom(2 << 20))
+        assert "copy" == files.clone_file(source, destination)
+        assert payload == destination.read_bytes()
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+
+import pytest
+from test_qcow2 import write_overlay
+
+from kaso_mashin import KasoMashinException
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import DiskEntity, DiskFormat, ImageEntity
+from kaso_mashin.common.services import GCMode, GCAction, GCReportSchema
+
+
+@pytest.mark.asyncio(scope="session")
+class TestGCService:
+    """
+    Test reconciling files with the entities referring to them
+    """
+
+    async def test_collect(self, test_context_empty, tmp_path):
+        runtime = test_context_empty.runtime
+        config = runtime.config
+        images_path, instances_path = config.images_path, config.instances_path
+        config.images_path, config.instances_path = tmp_path / "images", tmp_path / "instances"
+        config.images_path.mkdir()
+        config.instances_path.mkdir()
+        old = time.time() - 2 * config.gc_grace_period
+
+        image_path = config.images_path / "known.qcow2"
+        image_path.write_bytes(bytes(4096))
+        orphan_image = config.images_path / "orphan.img"
+        orphan_image.write_bytes(os.urandom(8192))
+        fresh_image = config.images_path / "fresh.img"
+        fresh_image.write_bytes(bytes(4096))
+        frozen = config.instances_path / "frozen.qcow2"
+        write_overlay(frozen, backing_file=str(image_path), virtual_size=1 << 30)
+        disk_path = config.instances_path / "disk.qcow2"
+        write_overlay(disk_path, backing_file="frozen.qcow2", virtual_size=1 << 30)
+        failed = config.instances_path / "failed-instance"
+        failed.mkdir()
+        (failed / "uefi_vars.fd").write_bytes(os.urandom(4096))
+        for path in (image_path, orphan_image, frozen, disk_path, failed / "uefi_vars.fd", failed):
+            os.utime(path, (old, old))
+
+        image = await runtime.image_repository.create(
+            ImageEntity(name="Known Image", url="https://example.com/known.qcow2", path=image_path)
+        )
+        size = BinarySizedValue(1, BinaryScale.G)
+        disk = await runtime.disk_repository.create(
+            DiskEntity(name="Known Disk", path=disk_path, size=size, disk_format=DiskFormat.QCoW2)
+        )
+        missing = await runtime.disk_repository.create(
+            DiskEntity(name="Missing Disk", path=config.instances_path / "missing.qcow2", size=size)
+        )
+        try:
+            resp = test_context_empty.client.post("/api/gc/", params={"mode": "report"})
+            assert 200 == resp.status_code
+            report = GCReportSchema.model_validate_json(resp.content)
+            assert GCMode.REPORT == report.mode
+            assert {orphan_image, failed} == {orphan.path for orphan in report.orphans}
+            assert all(GCAction.REPORTED == orphan.action for orphan in report.orphans)
+            assert [missing.uid] == [dangling.uid for dangling in report.dangling]
+            assert orphan_image.exists() and failed.exists()
+            resp = test_context_empty.client.get("/api/gc/")
+            assert report == GCReportSchema.model_validate_json(resp.content)
+
+            # Unchanged disk files are not read again
+            report = await runtime.gc_service.collect(GCMode.REPORT)
+            assert report.cache_hits >= 2
+
+            report = await runtime.gc_service.collect(GCMode.QUARANTINE)
+            assert all(GCAction.QUARANTINED == orphan.action for orphan in report.orphans)
+            assert report.quarantined >= 8192 + 4096
+            assert 0 == report.reclaimed
+            assert not orphan_image.exists() and not failed.exists()
+            assert 1 == len(list((config.images_path / ".quarantine").iterdir()))
+            assert 1 == len(list((config.instances_path / ".quarantine").iterdir()))
+            assert image_path.exists() and frozen.exists() and disk_path.exists()
+            assert fresh_image.exists()
+
+            config.gc_quarantine_retention = 0
+            report = await runtime.gc_service.collect(GCMode.DELETE)
+            assert [] == report.orphans
+            assert report.reclaimed >= 8192 + 4096
+            assert [] == list((config.images_path / ".quarantine").iterdir())
+            assert [] == list((config.instances_path / ".quarantine").iterdir())
+        finally:
+            config.gc_quarantine_retention = 604800
+            config.images_path, config.instances_path = images_path, instances_path
+            await runtime.disk_repository.remove(missing.uid)
+            await runtime.disk_repository.remove(disk.uid)
+            await runtime.image_repository.remove(image.uid)
+
+    async def test_run_survives_failures(self, test_context_empty, monkeypatch):
+        runtime = test_context_empty.runtime
+        service = runtime.gc_service
+        collected = asyncio.Event()
+        calls = []
+
+        async def collect():
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise KasoMashinException(status=500, msg="Failed to list disks")
+            collected.set()
+
+        monkeypatch.setattr(service, "collect", collect)
+        await service.stop()
+        runtime.config.gc_interval = 0.01
+        try:
+            await service.start()
+            await asyncio.wait_for(collected.wait(), timeout=5)
+            assert len(calls) >= 2
+        finally:
+            await service.stop()
+            runtime.config.gc_interval = 3600
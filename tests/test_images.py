@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from kaso_mashin.common.entities import ImageEntity, ImageListSchema
+
+
+@pytest.mark.asyncio(scope="session")
+class TestImageContent:
+    """
+    Test serving the content of Image entities to peers
+    """
+
+    async def test_list_api(self, test_context_empty):
+        resp = test_context_empty.client.get("/api/images/")
+        assert 200 == resp.status_code
+        assert [] == ImageListSchema.model_validate_json(resp.content).entries
+
+    async def test_content(self, test_context_empty, tmp_path):
+        payload = os.urandom(100000)
+        path = tmp_path / "image.qcow2"
+        path.write_bytes(payload)
+        image = await test_context_empty.runtime.image_repository.create(
+            ImageEntity(name="Test Image", url="https://example.com/image.qcow2", path=path)
+        )
+        try:
+            client = test_context_empty.client
+            resp = client.get(f"/api/images/{image.uid}/content")
+            assert 200 == resp.status_code
+            assert "bytes" == resp.headers["accept-ranges"]
+            assert payload == resp.content
+
+            resp = client.get(f"/api/images/{image.uid}/content", headers={"Range": "bytes=10-19"})
+            assert 206 == resp.status_code
+            assert f"bytes 10-19/{len(payload)}" == resp.headers["content-range"]
+            assert payload[10:20] == resp.content
+
+            resp = client.get(f"/api/images/{image.uid}/content", headers={"Range": "bytes=99990-"})
+            assert 206 == resp.status_code
+            assert payload[99990:] == resp.content
+
+            resp = client.get(f"/api/images/{image.uid}/content", headers={"Range": "bytes=-5"})
+            assert 206 == resp.status_code
+            assert payload[-5:] == resp.content
+
+            resp = client.get(
+                f"/api/images/{image.uid}/content", headers={"Range": "bytes=200000-"}
+            )
+            assert 416 == resp.status_code
+            assert f"bytes */{len(payload)}" == resp.headers["content-range"]
+
+            resp = client.get(
+                f"/api/images/{image.uid}/content", headers={"Range": "bytes=0-1,5-6"}
+            )
+            assert 200 == resp.status_code
+            assert payload == resp.content
+
+            resp = client.get(f"/api/images/{image.uid}/content", headers={"Range": "bytes=5-2"})
+            assert 200 == resp.status_code
+            assert payload == resp.content
+        finally:
+            await test_context_empty.runtime.image_repository.remove(image.uid)
@@ -1,17 +1,43 @@
 import uuid
+import getpass
+import ipaddress
 import pathlib
+import tempfile
 
+import fastapi.testclient
 import pytest
 from conftest import seed, BaseTest
+from test_qemu import fake_qemu, instance_entity
 
 
-from kaso_mashin.common import UniqueIdentifier, EntityNotFoundException
+from kaso_mashin.common import (
+    UniqueIdentifier,
+    EntityNotFoundException,
+    BinarySizedValue,
+    BinaryScale,
+)
+from kaso_mashin.server.run import create_server
+from kaso_mashin.common import qcow2
 from kaso_mashin.common.entities import (
     InstanceModel,
     InstanceEntity,
+    InstanceException,
+    InstanceFleetCreateSchema,
     InstanceListSchema,
     InstanceGetSchema,
     InstanceModifySchema,
+    InstanceAction,
+    InstanceActionSchema,
+    InstanceState,
+    BootstrapEntity,
+    BootstrapKind,
+    DiskEntity,
+    ImageEntity,
+    NetworkEntity,
+    NetworkKind,
+    TaskEntity,
+    TaskGetSchema,
+    TaskState,
 )
 
 
@@ -60,3 +86,359 @@ class TestSeededInstances(BaseTest[InstanceModel, InstanceEntity, InstanceGetSch
         assert obj.mac == model.mac
         # TODO: os_disk and network
         assert obj.bootstrap_file == pathlib.Path(model.bootstrap_file)
+
+
+@pytest.mark.asyncio(scope="session")
+class TestInstanceCreation:
+    """
+    Test the instance creation pipeline
+    """
+
+    @staticmethod
+    def dependencies(tmp_path: pathlib.Path, bootstrap_kind: BootstrapKind):
+        image_path = tmp_path / "image.qcow2"
+        if not image_path.exists():
+            qcow2.create(image_path, 1 << 30)
+            (tmp_path / "uefi_code.fd").write_bytes(bytes(4096))
+            (tmp_path / "uefi_vars.fd").write_bytes(b"\x01" * 4096)
+        return dict(
+            user=getpass.getuser(),
+            uefi_code=tmp_path / "uefi_code.fd",
+            uefi_vars=tmp_path / "uefi_vars.fd",
+            vcpu=2,
+            ram=BinarySizedValue(2, BinaryScale.G),
+            image=ImageEntity(
+                name="Pipeline Image", url="https://example.com/image.qcow2", path=image_path
+            ),
+            os_disk_size=BinarySizedValue(2, BinaryScale.G),
+            network=NetworkEntity(
+                name="Pipeline Network",
+                kind=NetworkKind.VMNET_SHARED,
+                cidr=ipaddress.IPv4Network("10.0.0.0/24"),
+                gateway=ipaddress.IPv4Address("10.0.0.1"),
+                dhcp_start=ipaddress.IPv4Address("10.0.0.2"),
+                dhcp_end=ipaddress.IPv4Address("10.0.0.254"),
+            ),
+            bootstrap=BootstrapEntity(
+                name="Pipeline Bootstrap", kind=bootstrap_kind, content="hostname: {{ name }}"
+            ),
+        )
+
+    async def test_create(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        task = await TaskEntity.create(name="Create pipeline instance")
+        instance = await InstanceEntity.create(
+            task=task,
+            name="pipeline",
+            path=tmp_path / "pipeline",
+            **self.dependencies(tmp_path, BootstrapKind.CLOUD_INIT),
+        )
+        try:
+            assert TaskState.DONE == task.state
+            assert instance.uid == task.outcome
+            assert {"path", "uefi", "os_disk", "bootstrap", "persist"} == set(task.timings)
+            assert b"\x01" * 4096 == instance.uefi_vars.read_bytes()
+            assert instance.uefi_code.is_symlink()
+            assert "hostname: pipeline" == instance.bootstrap_file.read_text()
+            assert 1 == instance.os_disk.chain_depth
+        finally:
+            await instance.os_disk.remove()
+            await runtime.instance_repository.remove(instance.uid)
+
+    async def test_create_failure(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        butane_path = runtime.config.butane_path
+        runtime.config.butane_path = tmp_path / "no-butane"
+        task = await TaskEntity.create(name="Create failing pipeline instance")
+        try:
+            with pytest.raises(InstanceException):
+                await InstanceEntity.create(
+                    task=task,
+                    name="failing",
+                    path=tmp_path / "failing",
+                    **self.dependencies(tmp_path, BootstrapKind.IGNITION),
+                )
+        finally:
+            runtime.config.butane_path = butane_path
+        assert TaskState.FAILED == task.state
+        assert {"os_disk", "bootstrap"} <= set(task.timings)
+        assert not (tmp_path / "failing").exists()
+        disks = await runtime.disk_repository.list()
+        assert tmp_path / "failing" / "os.qcow2" not in [disk.path for disk in disks]
+
+    async def test_requirements(self, test_context_empty, tmp_path):
+        dependencies = self.dependencies(tmp_path, BootstrapKind.CLOUD_INIT)
+        dependencies["image"] = ImageEntity(
+            name="Demanding Image",
+            url="https://example.com/image.qcow2",
+            path=dependencies["image"].path,
+            min_vcpu=4,
+            min_ram=BinarySizedValue(1, BinaryScale.G),
+        )
+        task = await TaskEntity.create(name="Create undersized instance")
+        with pytest.raises(InstanceException) as ie:
+            await InstanceEntity.create(
+                task=task, name="undersized", path=tmp_path / "undersized", **dependencies
+            )
+        assert "at least 4 vCPUs" in ie.value.msg
+        assert TaskState.FAILED == task.state
+        assert not (tmp_path / "undersized").exists()
+        with pytest.raises(InstanceException) as ie:
+            InstanceEntity.check_requirements(
+                dependencies["image"], 4, BinarySizedValue(512, BinaryScale.M)
+            )
+        assert "at least 1G of RAM" in ie.value.msg
+        InstanceEntity.check_requirements(
+            dependencies["image"], 4, BinarySizedValue(2048, BinaryScale.M)
+        )
+
+
+@pytest.mark.asyncio(scope="session")
+class TestInstanceFleet:
+    """
+    Test creating many instances from the same template
+    """
+
+    @staticmethod
+    async def template(runtime, tmp_path: pathlib.Path, bootstrap_kind: BootstrapKind):
+        dependencies = TestInstanceCreation.dependencies(tmp_path, bootstrap_kind)
+        image = await runtime.image_repository.create(dependencies["image"])
+        network = await runtime.network_repository.create(dependencies["network"])
+        bootstrap = await runtime.bootstrap_repository.create(
+            BootstrapEntity(
+                name="Fleet Bootstrap",
+                kind=bootstrap_kind,
+                content="hostname: {{ name }}\nrole: {{ role }}\nindex: {{ index }}",
+            )
+        )
+        schema = InstanceFleetCreateSchema(
+            count=3,
+            name_pattern="node-{index}",
+            vcpu=2,
+            ram=BinarySizedValue(2, BinaryScale.G),
+            os_disk_size=BinarySizedValue(2, BinaryScale.G),
+            image_uid=str(image.uid),
+            network_uid=str(network.uid),
+            bootstrap_uid=str(bootstrap.uid),
+            variables=[{"role": "master"}, {"role": "worker"}, {"role": "worker"}],
+        )
+        return schema, [image, network, bootstrap]
+
+    @staticmethod
+    async def remove(runtime, entities):
+        image, network, bootstrap = entities
+        await runtime.bootstrap_repository.remove(bootstrap.uid)
+        await runtime.network_repository.remove(network.uid)
+        await runtime.image_repository.remove(image.uid)
+
+    async def test_create_api(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        config = test_context_empty.runtime.config
+        instances_path = config.instances_path
+        config.instances_path = tmp_path / "instances"
+        test_context_empty.runtime.uefi_code_path.write_bytes(bytes(4096))
+        test_context_empty.runtime.uefi_vars_path.write_bytes(bytes(4096))
+        schema, entities = await self.template(runtime, tmp_path, BootstrapKind.CLOUD_INIT)
+        instances = []
+        try:
+            for name_pattern in ("node-{role}", "{0}", "{", "../node-{index}", "a/{index}"):
+                payload = schema.model_dump(mode="json") | {"name_pattern": name_pattern}
+                resp = test_context_empty.client.post("/api/instances/fleet", json=payload)
+                assert 422 == resp.status_code, name_pattern
+            resp = test_context_empty.client.post(
+                "/api/instances/fleet", content=schema.model_dump_json()
+            )
+            assert 201 == resp.status_code
+            task = await runtime.task_repository.get_by_uid(
+                TaskGetSchema.model_validate_json(resp.content).uid
+            )
+            assert TaskState.DONE == task.state, task.msg
+            assert {"provision", "persist"} == set(task.timings)
+            instances = [
+                instance
+                for instance in await runtime.instance_repository.list()
+                if instance.path.parent == config.instances_path
+            ]
+            assert ["node-0", "node-1", "node-2"] == sorted(i.name for i in instances)
+            assert (
+                "hostname: node-0\nrole: master\nindex: 0"
+                == (config.instances_path / "node-0" / "bootstrap.json").read_text()
+            )
+            assert (
+                "hostname: node-2\nrole: worker\nindex: 2"
+                == (config.instances_path / "node-2" / "bootstrap.json").read_text()
+            )
+        finally:
+            config.instances_path = instances_path
+            for instance in instances:
+                await instance.os_disk.remove()
+                await runtime.instance_repository.remove(instance.uid)
+            await self.remove(runtime, entities)
+
+    async def test_create_failure(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        butane_path = runtime.config.butane_path
+        runtime.config.butane_path = tmp_path / "no-butane"
+        schema, entities = await self.template(runtime, tmp_path, BootstrapKind.IGNITION)
+        instances = len(await runtime.instance_repository.list())
+        task = await TaskEntity.create(name="Create failing fleet")
+        try:
+            with pytest.raises(InstanceException):
+                await InstanceEntity.create_many(
+                    task=task,
+                    user=getpass.getuser(),
+                    instances_path=tmp_path / "instances",
+                    uefi_code=tmp_path / "uefi_code.fd",
+                    uefi_vars=tmp_path / "uefi_vars.fd",
+                    schema=schema,
+                )
+            assert TaskState.FAILED == task.state
+            assert instances == len(await runtime.instance_repository.list())
+            assert [] == list((tmp_path / "instances").iterdir())
+            disks = await runtime.disk_repository.list()
+            assert all(tmp_path / "instances" not in disk.path.parents for disk in disks)
+
+            task = await TaskEntity.create(name="Create fleet with duplicate names")
+            with pytest.raises(InstanceException) as ie:
+                await InstanceEntity.create_many(
+                    task=task,
+                    user=getpass.getuser(),
+                    instances_path=tmp_path / "instances",
+                    uefi_code=tmp_path / "uefi_code.fd",
+                    uefi_vars=tmp_path / "uefi_vars.fd",
+                    schema=schema.model_copy(update={"name_pattern": "node"}),
+                )
+            assert "unique names" in ie.value.msg
+            assert TaskState.FAILED == task.state
+        finally:
+            runtime.config.butane_path = butane_path
+            await self.remove(runtime, entities)
+
+
+@pytest.mark.asyncio(scope="session")
+class TestInstanceState:
+    """
+    Test recording the state of instances as it changes
+    """
+
+    async def test_record(self, test_context_empty, tmp_path):
+        runtime = DiskEntity.runtime
+        dependencies = TestInstanceCreation.dependencies(tmp_path, BootstrapKind.CLOUD_INIT)
+        image = await runtime.image_repository.create(dependencies["image"])
+        network = await runtime.network_repository.create(dependencies["network"])
+        bootstrap = await runtime.bootstrap_repository.create(dependencies["bootstrap"])
+        task = await TaskEntity.create(name="Create recorded instance")
+        instance = await InstanceEntity.create(
+            task=task, name="recorded", path=tmp_path / "recorded", **dependencies
+        )
+        try:
+            assert InstanceState.STOPPED == instance.state
+            await runtime.supervisor_service.supervise(instance, ["sleep", "30"])
+            recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+            assert InstanceState.STARTED == recorded.state
+            assert runtime.supervisor_service.pid(instance.uid) == recorded.pid
+            assert recorded.started is not None
+            assert recorded.started == recorded.state_changed
+            assert [instance.uid] == [
+                entity.uid
+                for entity in await runtime.instance_repository.list_by_state(
+                    [InstanceState.STARTED, InstanceState.PAUSED]
+                )
+            ]
+
+            # The entities are recorded by the runtime of whichever context was created last
+            client = fastapi.testclient.TestClient(create_server(runtime))
+            resp = client.get("/api/instances/", params={"state": "STARTED"})
+            assert 200 == resp.status_code
+            schema = InstanceListSchema.model_validate_json(resp.content)
+            assert [instance.uid] == [entry.uid for entry in schema.entries]
+            assert recorded.pid == schema.entries[0].pid
+            resp = client.get("/api/instances/", params={"state": "STOPPED"})
+            assert instance.uid not in [
+                entry.uid for entry in InstanceListSchema.model_validate_json(resp.content).entries
+            ]
+
+            await runtime.supervisor_service.halt(instance)
+            recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+            assert InstanceState.STOPPED == recorded._state
+            assert recorded.pid is None
+            assert recorded.state_changed > recorded.started
+            assert [] == await runtime.instance_repository.list_by_state([InstanceState.STARTED])
+        finally:
+            await instance.os_disk.remove()
+            await runtime.instance_repository.remove(instance.uid)
+            await runtime.bootstrap_repository.remove(bootstrap.uid)
+            await runtime.network_repository.remove(network.uid)
+            await runtime.image_repository.remove(image.uid)
+
+    async def test_modify_failure(self, test_context_empty, monkeypatch):
+        monkeypatch.setattr("kaso_mashin.common.services.qemu.QMP_CONNECT_TIMEOUT", 0.1)
+        with tempfile.TemporaryDirectory(dir="/tmp") as instance_dir:
+            instance = instance_entity(pathlib.Path(instance_dir))
+            task = await TaskEntity.create(name="Pause a stopped instance")
+            await instance.modify(InstanceModifySchema(state=InstanceState.PAUSED), task)
+            assert TaskState.FAILED == task.state
+            assert "reattached" in task.msg
+
+            # Starting an instance the host has no room for is refused rather than done
+            instance._vcpu = instance.runtime.resource_service.usage().vcpu_available + 1
+            task = await TaskEntity.create(name="Start an oversized instance")
+            await instance.modify(InstanceModifySchema(state=InstanceState.STARTED), task)
+            assert TaskState.FAILED == task.state
+            assert "overcommit ratio" in task.msg
+            assert InstanceState.STOPPED == instance.state
+
+
+@pytest.mark.asyncio(scope="session")
+class TestInstanceActions:
+    """
+    Test starting and stopping many instances at once
+    """
+
+    async def test_start_stop(self, test_context_empty):
+        runtime = DiskEntity.runtime
+        qemu_path = runtime.config.qemu_aarch64_path
+        with tempfile.TemporaryDirectory(dir="/tmp") as instances_dir:
+            instances_path = pathlib.Path(instances_dir)
+            runtime.config.qemu_aarch64_path = fake_qemu(instances_path)
+            instances = []
+            for index in range(3):
+                (instances_path / str(index)).mkdir()
+                instances.append(instance_entity(instances_path / str(index)))
+            schema = InstanceActionSchema(concurrency=2, stagger=0.2)
+            try:
+                task = await TaskEntity.create(name="Start instances")
+                assert [] == await InstanceEntity.act_many(
+                    task, InstanceAction.START, instances, schema
+                )
+                assert TaskState.DONE == task.state, task.msg
+                assert all(InstanceState.STARTED == instance.state for instance in instances)
+                started = sorted(
+                    runtime.supervisor_service.get(instance).started for instance in instances
+                )
+                assert all(
+                    (later - earlier).total_seconds() > 0.15
+                    for earlier, later in zip(started, started[1:])
+                )
+
+                task = await TaskEntity.create(name="Stop instances")
+                assert [] == await InstanceEntity.act_many(
+                    task, InstanceAction.STOP, instances, schema
+                )
+                assert TaskState.DONE == task.state, task.msg
+                assert all(InstanceState.STOPPED == instance.state for instance in instances)
+                assert all(
+                    0 == runtime.supervisor_service.get(instance).returncode
+                    for instance in instances
+                )
+
+                runtime.config.qemu_aarch64_path = instances_path / "no-qemu"
+                task = await TaskEntity.create(name="Fail to start instances")
+                assert instances[:1] == await InstanceEntity.act_many(
+                    task, InstanceAction.START, instances[:1], schema
+                )
+                assert TaskState.FAILED == task.state
+            finally:
+                runtime.config.qemu_aarch64_path = qemu_path
+                for instance in instances:
+                    await runtime.qemu_service.stop_instance(instance)
@@ -0,0 +1,91 @@
+import asyncio
+import pathlib
+import socket
+import tempfile
+
+import pytest
+from test_qemu import fake_qemu, instance_entity
+
+from kaso_mashin.common.entities import (
+    DiskEntity,
+    InstanceAction,
+    InstanceActionSchema,
+    InstanceEntity,
+    TaskEntity,
+    TaskState,
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def request(port: int, target: str, method: str = "POST") -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    status = await reader.readline()
+    writer.close()
+    return status
+
+
+@pytest.mark.asyncio(scope="session")
+class TestPhoneHomeService:
+    """
+    Test guests phoning home once they booted
+    """
+
+    async def test_ready(self, test_context_empty, monkeypatch):
+        runtime = DiskEntity.runtime
+        config = runtime.config
+        service = runtime.phone_home_service
+        phone_home_port, qemu_path = config.default_phone_home_port, config.qemu_aarch64_path
+        await service.stop()
+        config.default_phone_home_port = free_port()
+        await service.start()
+        assert config.default_phone_home_port == service.port
+        # Guests check in unauthenticated, so only the configured address listens
+        assert {config.default_phone_home_host} == {
+            sock.getsockname()[0] for sock in service._server.sockets
+        }
+        monkeypatch.setenv("FAKE_QEMU_PHONE_HOME", service.url("127.0.0.1"))
+        with tempfile.TemporaryDirectory(dir="/tmp") as instance_dir:
+            config.qemu_aarch64_path = fake_qemu(pathlib.Path(instance_dir))
+            instance = instance_entity(pathlib.Path(instance_dir))
+            entities = [instance.image, instance.network, instance.bootstrap, instance.os_disk]
+            for entity in entities:
+                await entity.repository.create(entity)
+            await runtime.instance_repository.create(instance)
+            try:
+                task = await TaskEntity.create(name="Start instances until they are ready")
+                assert [] == await InstanceEntity.act_many(
+                    task, InstanceAction.START, [instance], InstanceActionSchema(wait_ready=True)
+                )
+                assert TaskState.DONE == task.state, task.msg
+                recorded = await runtime.instance_repository.get_by_uid(instance.uid)
+                assert recorded.ready is not None
+                assert 0 < recorded.boot_seconds < 10
+                assert await recorded.wait_ready(timeout=0)
+
+                assert (await request(service.port, f"/{instance.uid}")).startswith(b"HTTP/1.1 204")
+                assert (await request(service.port, "/00:50:56:00:00:00")).startswith(
+                    b"HTTP/1.1 404"
+                )
+                assert (await request(service.port, "/", method="DELETE")).startswith(
+                    b"HTTP/1.1 405"
+                )
+
+                await instance.stop()
+                assert recorded.ready is None
+                assert not await recorded.wait_ready(timeout=0.1)
+            finally:
+                config.qemu_aarch64_path = qemu_path
+                await runtime.qemu_service.stop_instance(instance)
+                await runtime.instance_repository.remove(instance.uid)
+                for entity in entities:
+                    await entity.repository.remove(entity.uid)
+                await service.stop()
+                config.default_phone_home_port = phone_home_port
+                await service.start()
@@ -0,0 +1,103 @@
+import asyncio
+import pathlib
+import sys
+import time
+
+import pytest
+
+from kaso_mashin.common.services import ProcessException, ProcessMetricsSchema
+
+
+@pytest.mark.asyncio(scope="session")
+class TestProcessService:
+    """
+    Test running external commands through the process service
+    """
+
+    async def test_run(self, test_context_empty):
+        result = await test_context_empty.runtime.process_service.run(
+            [sys.executable, "-c", "import sys; print(sys.stdin.read().upper())"], stdin=b"kaso"
+        )
+        assert 0 == result.returncode
+        assert "KASO" == result.stdout.strip()
+
+    async def test_failure(self, test_context_empty):
+        service = test_context_empty.runtime.process_service
+        with pytest.raises(ProcessException) as pe:
+            await service.run([sys.executable, "-c", "import sys; sys.exit('broken disk')"])
+        assert "broken disk" in pe.value.msg
+        result = await service.run([sys.executable, "-c", "raise SystemExit(3)"], check=False)
+        assert 3 == result.returncode
+
+    async def test_missing_command(self, test_context_empty):
+        with pytest.raises(ProcessException):
+            await test_context_empty.runtime.process_service.run(["/no/where/qemu-img"])
+
+    async def test_timeout(self, test_context_empty):
+        started = time.monotonic()
+        with pytest.raises(ProcessException) as pe:
+            await test_context_empty.runtime.process_service.run(
+                [sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5
+            )
+        assert "timed out" in pe.value.msg
+        assert time.monotonic() - started < 5
+
+    async def test_timeout_after_exit(self, test_context_empty):
+        async def on_output(line: str):
+            # The process exits while its output is still being handled
+            await asyncio.sleep(1)
+
+        with pytest.raises(ProcessException) as pe:
+            await test_context_empty.runtime.process_service.run(
+                [sys.executable, "-c", "print('done')"], timeout=0.5, on_output=on_output
+            )
+        assert "timed out" in pe.value.msg
+
+    async def test_does_not_block(self, test_context_empty):
+        service = test_context_empty.runtime.process_service
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await service.run([sys.executable, "-c", "import time; time.sleep(0.5)"])
+        ticker.cancel()
+        assert ticks > 10
+
+    async def test_cancel(self, test_context_empty):
+        service = test_context_empty.runtime.process_service
+        run = asyncio.create_task(
+            service.run([sys.executable, "-c", "import time; time.sleep(10)"])
+        )
+        await asyncio.sleep(0.5)
+        started = time.monotonic()
+        run.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await run
+        assert time.monotonic() - started < 5
+
+    async def test_metrics_api(self, test_context_empty):
+        resp = test_context_empty.client.get("/api/config/processes")
+        assert 200 == resp.status_code
+        metrics = {m.command: m for m in map(ProcessMetricsSchema.model_validate, resp.json())}
+        assert metrics[pathlib.Path(sys.executable).name].count >= 6
+        assert metrics[pathlib.Path(sys.executable).name].failures >= 2
+
+    async def test_on_output(self, test_context_empty):
+        lines = []
+
+        async def on_output(line: str):
+            lines.append(line)
+
+        script = (
+            "import sys\nfor p in (0, 50, 100):\n    print(f'({p}.00/100%)', end='\\r', flush=True)"
+        )
+        result = await test_context_empty.runtime.process_service.run(
+            [sys.executable, "-c", script], on_output=on_output
+        )
+        assert ["(0.00/100%)", "(50.00/100%)", "(100.00/100%)"] == lines
+        assert "(50.00/100%)" in result.stdout
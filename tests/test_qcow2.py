@@ -0,0 +1,140 @@
+import os
+import pathlib
+import struct
+
+import pytest
+
+from kaso_mashin.common import qcow2
+from kaso_mashin.common.entities import DiskEntity, DiskGetSchema, DiskFormat
+from kaso_mashin.common.services.download import QCoW2Sink
+
+
+def write_overlay(path: pathlib.Path, backing_file: str, virtual_size: int):
+    """
+    Write an empty QCoW2 overlay on top of a backing file
+    """
+    cluster_size = 1 << qcow2.QCOW2_DEFAULT_CLUSTER_BITS
+    l1_size = qcow2.l1_entries(virtual_size)
+    blocks, table_clusters = qcow2.refcount_layout(2)
+    table, refcounts = qcow2.pack_refcounts(
+        refcount_block_offset=(2 + table_clusters) * cluster_size,
+        blocks=blocks,
+        table_clusters=table_clusters,
+        clusters=2 + blocks + table_clusters,
+    )
+    header = qcow2.pack_header(
+        virtual_size=virtual_size,
+        l1_size=l1_size,
+        l1_table_offset=cluster_size,
+        refcount_table_offset=2 * cluster_size,
+        refcount_table_clusters=table_clusters,
+        backing_file=backing_file,
+        backing_format="qcow2",
+    )
+    path.write_bytes(header.ljust(cluster_size, b"\x00") + bytes(cluster_size) + table + refcounts)
+
+
+@pytest.mark.asyncio(scope="session")
+class TestQCoW2Inspector:
+    """
+    Test reading image metadata without qemu-img
+    """
+
+    async def test_raw(self, tmp_path):
+        path = tmp_path / "disk.raw"
+        with open(path, "wb") as f:
+            f.truncate(1 << 30)
+        info = qcow2.inspect(path)
+        assert "raw" == info.format
+        assert 1 << 30 == info.virtual_size
+        assert info.allocated_size < 1 << 20
+        assert info.backing_file is None
+
+    async def test_qcow2(self, tmp_path):
+        payload = os.urandom(200000) + bytes(1 << 20)
+        base = tmp_path / "base.qcow2"
+        sink = QCoW2Sink(base)
+        await sink.open()
+        await sink.write(payload)
+        await sink.close()
+        info = qcow2.inspect(base)
+        assert "qcow2" == info.format
+        assert len(payload) == info.virtual_size - (-len(payload) % 512)
+        assert 1 == info.l2_tables
+        assert info.backing_file is None
+
+    async def test_backing_chain(self, tmp_path):
+        base = tmp_path / "base.img"
+        base.write_bytes(bytes(65536))
+        middle = tmp_path / "middle.qcow2"
+        write_overlay(middle, backing_file="base.img", virtual_size=65536)
+        top = tmp_path / "top.qcow2"
+        write_overlay(top, backing_file=str(middle), virtual_size=1 << 30)
+        chain = qcow2.backing_chain(top)
+        assert [top, middle, base] == [info.path for info in chain]
+        assert 1 << 30 == chain[0].virtual_size
+        assert "qcow2" == chain[0].backing_format
+        assert 0 == chain[0].l2_tables
+        assert "raw" == chain[2].format
+
+    async def test_backing_chain_cycle(self, tmp_path):
+        first, second = tmp_path / "first.qcow2", tmp_path / "second.qcow2"
+        write_overlay(first, backing_file="second.qcow2", virtual_size=65536)
+        write_overlay(second, backing_file="first.qcow2", virtual_size=65536)
+        assert 2 == len(qcow2.backing_chain(first))
+
+    async def test_disk_schema(self, tmp_path):
+        base = tmp_path / "base.img"
+        base.write_bytes(bytes(65536))
+        path = tmp_path / "disk.qcow2"
+        write_overlay(path, backing_file="base.img", virtual_size=1 << 30)
+        schema = DiskGetSchema.model_validate(
+            DiskEntity(name="Test Disk", path=path, disk_format=DiskFormat.QCoW2)
+        )
+        assert 1 << 30 == schema.virtual_size
+        assert 1 == schema.chain_depth
+        assert schema.allocated_size == path.stat().st_blocks * 512
+        missing = DiskGetSchema.model_validate(DiskEntity(name="Missing", path=tmp_path / "none"))
+        assert missing.virtual_size is None
+        assert missing.chain_depth is None
+
+
+@pytest.mark.asyncio(scope="session")
+class TestQCoW2Creator:
+    """
+    Test creating empty QCoW2 images without qemu-img
+    """
+
+    async def test_create(self, tmp_path):
+        path = tmp_path / "empty.qcow2"
+        qcow2.create(path, 2 << 30)
+        info = qcow2.inspect(path)
+        assert "qcow2" == info.format
+        assert 2 << 30 == info.virtual_size
+        assert 0 == info.l2_tables
+        assert info.backing_file is None
+        assert info.allocated_size < 1 << 20
+
+        # Every cluster of the file is referenced exactly once
+        data = path.read_bytes()
+        cluster_size = 1 << qcow2.QCOW2_DEFAULT_CLUSTER_BITS
+        header = qcow2.QCOW2_HEADER.unpack_from(data)
+        refcount_table_offset = header[9]
+        (refcount_block_offset,) = struct.unpack_from(">Q", data, refcount_table_offset)
+        clusters = len(data) // cluster_size
+        refcounts = struct.unpack_from(f">{clusters + 1}H", data, refcount_block_offset)
+        assert (1,) * clusters + (0,) == refcounts
+        l1_table_offset, l1_size = header[8], header[7]
+        assert bytes(l1_size * 8) == data[l1_table_offset : l1_table_offset + l1_size * 8]
+
+        with pytest.raises(FileExistsError):
+            qcow2.create(path, 1 << 30)
+
+    async def test_create_backing(self, tmp_path):
+        base = tmp_path / "base.img"
+        base.write_bytes(bytes(65536))
+        path = tmp_path / "overlay.qcow2"
+        qcow2.create(path, 1 << 30, backing_file="base.img", backing_format="raw")
+        chain = qcow2.backing_chain(path)
+        assert [path, base] == [info.path for info in chain]
+        assert "raw" == chain[0].backing_format
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import ipaddress
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import (
+    InstanceEntity,
+    InstanceState,
+    BootstrapEntity,
+    BootstrapKind,
+    DiskEntity,
+    ImageEntity,
+    NetworkEntity,
+    NetworkKind,
+)
+from kaso_mashin.common.services import QMPException
+
+QMPInstance = collections.namedtuple("QMPInstance", "uid name path")
+
+
+class FakeQMP:
+    """
+    Serve a minimal QMP protocol on a unix socket, answering commands from a dict of replies.
+    Like QEMU, the server parses a stream of JSON objects which are not terminated by newlines.
+    """
+
+    def __init__(self, path: pathlib.Path, replies: dict):
+        self.path = path
+        self.replies = {"qmp_capabilities": {}, "query-status": {"running": True}, **replies}
+        self.received = []
+        self.connections = 0
+        self._writers = []
+        self._server = None
+
+    @property
+    def commands(self):
+        return [message["execute"] for message in self.received]
+
+    async def __aenter__(self) -> "FakeQMP":
+        self._server = await asyncio.start_unix_server(self._handle, path=str(self.path))
+        return self
+
+    async def __aexit__(self, *exc):
+        for writer in self._writers:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def emit(self, event: str):
+        message = {
+            "event": event,
+            "data": {},
+            "timestamp": {"seconds": int(time.time()), "microseconds": 0},
+        }
+        for writer in self._writers:
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.append(writer)
+        greeting = {
+            "QMP": {
+                "version": {"qemu": {"micro": 0, "minor": 0, "major": 8}, "package": ""},
+                "capabilities": [],
+            }
+        }
+        writer.write(json.dumps(greeting).encode() + b"\n")
+        await writer.drain()
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while chunk := await reader.read(4096):
+            buffer += chunk.decode()
+            while buffer.strip():
+                try:
+                    message, end = decoder.raw_decode(buffer.lstrip())
+                except json.JSONDecodeError:
+                    break
+                buffer = buffer.lstrip()[end:]
+                self.received.append(message)
+                reply = self.replies.get(message["execute"], {})
+                response = {"return": reply(message) if callable(reply) else reply}
+                if "id" in message:
+                    response["id"] = message["id"]
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        self._writers.remove(writer)
+        writer.close()
+
+
+# Stands in for QEMU: holds its pidfile, serves QMP and exits when the guest is powered down.
+# The guest phones home to the URL in FAKE_QEMU_PHONE_HOME, if it is set.
+FAKE_QEMU = """
+import asyncio, fcntl, json, os, sys, urllib.request
+
+args = sys.argv[1:]
+qmp_path = args[args.index("-qmp") + 1].split(",")[0].removeprefix("unix:")
+pidfile = open(args[args.index("-pidfile") + 1], "w")
+fcntl.lockf(pidfile, fcntl.LOCK_EX)
+pidfile.write(str(os.getpid()))
+pidfile.flush()
+
+
+async def handle(reader, writer):
+    greeting = {"QMP": {"version": {"qemu": {"micro": 0, "minor": 0, "major": 8}, "package": ""},
+                        "capabilities": []}}
+    writer.write(json.dumps(greeting).encode() + b"\\n")
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while chunk := await reader.read(4096):
+        buffer += chunk.decode()
+        while buffer.strip():
+            try:
+                message, end = decoder.raw_decode(buffer.lstrip())
+            except json.JSONDecodeError:
+                break
+            buffer = buffer.lstrip()[end:]
+            response = {"return": {"running": True} if message["execute"] == "query-status" else {}}
+            if "id" in message:
+                response["id"] = message["id"]
+            writer.write(json.dumps(response).encode() + b"\\n")
+            await writer.drain()
+            if message["execute"] == "system_powerdown":
+                os.unlink(qmp_path)
+                os._exit(0)
+
+
+def phone_home():
+    mac = [arg for arg in args if arg.startswith("virtio-net-device")][0].split("mac=")[1]
+    url = f"{os.environ['FAKE_QEMU_PHONE_HOME']}/{mac}"
+    urllib.request.urlopen(urllib.request.Request(url, method="POST"), timeout=5)
+
+
+async def main():
+    await asyncio.start_unix_server(handle, path=qmp_path)
+    if "FAKE_QEMU_PHONE_HOME" in os.environ:
+        await asyncio.to_thread(phone_home)
+    await asyncio.sleep(60)
+
+
+asyncio.run(main())
+"""
+
+
+def fake_qemu(directory: pathlib.Path) -> pathlib.Path:
+    path = directory / "qemu-system-aarch64"
+    path.write_text(f"#!{sys.executable}\n{FAKE_QEMU}")
+    path.chmod(0o755)
+    return path
+
+
+def qmp_instance(name: str, socket_dir: str) -> QMPInstance:
+    # Unix socket paths are limited in length, so sockets do not live below tmp_path
+    return QMPInstance(uid=uuid.uuid4(), name=name, path=pathlib.Path(socket_dir))
+
+
+@pytest.mark.asyncio(scope="session")
+class TestQEMUService:
+    """
+    Test controlling instances via their QMP connection
+    """
+
+    async def test_pooled(self, test_context_empty):
+        service = test_context_empty.runtime.qemu_service
+        with tempfile.TemporaryDirectory(dir="/tmp") as socket_dir:
+            instance = qmp_instance("pooled", socket_dir)
+            async with FakeQMP(service.qmp_path(instance), {}) as qmp:
+                assert InstanceState.STARTED == await service.status(instance)
+                await service.pause(instance)
+                await service.resume(instance)
+                await service.powerdown(instance)
+                assert InstanceState.STOPPING == service.state(instance)
+                assert 1 == qmp.connections
+                assert ["stop", "cont", "system_powerdown"] == qmp.commands[-3:]
+                await service.disconnect(instance)
+                assert service.state(instance) is None
+            with pytest.raises(QMPException):
+                await service.status(instance)
+
+    async def test_events(self, test_context_empty):
+        service = test_context_empty.runtime.qemu_service
+        with tempfile.TemporaryDirectory(dir="/tmp") as socket_dir:
+            instance = qmp_instance("events", socket_dir)
+            async with FakeQMP(service.qmp_path(instance), {}) as qmp:
+                await service.connect(instance)
+                assert InstanceState.STARTED == service.state(instance)
+                for event, state in (
+                    ("STOP", InstanceState.PAUSED),
+                    ("RESUME", InstanceState.STARTED),
+                    ("SHUTDOWN", InstanceState.STOPPED),
+                ):
+                    await qmp.emit(event)
+                    for _ in range(50):
+                        if service.state(instance) == state:
+                            break
+                        await asyncio.sleep(0.01)
+                    assert state == service.state(instance)
+                await service.disconnect(instance)
+
+
+def instance_entity(path: pathlib.Path) -> InstanceEntity:
+    return InstanceEntity(
+        name="reattached",
+        path=path,
+        uefi_code=path / "uefi_code.fd",
+        uefi_vars=path / "uefi_vars.fd",
+        vcpu=1,
+        ram=BinarySizedValue(1, BinaryScale.G),
+        image=ImageEntity(name="Image", url="https://example.com/image.qcow2", path=path),
+        os_disk=DiskEntity(name="OS Disk 0", path=path / "os.qcow2"),
+        network=NetworkEntity(
+            name="Network",
+            kind=NetworkKind.VMNET_SHARED,
+            cidr=ipaddress.IPv4Network("10.0.0.0/24"),
+            gateway=ipaddress.IPv4Address("10.0.0.1"),
+            dhcp_start=ipaddress.IPv4Address("10.0.0.2"),
+            dhcp_end=ipaddress.IPv4Address("10.0.0.254"),
+        ),
+        bootstrap=BootstrapEntity(name="Bootstrap", kind=BootstrapKind.IGNITION, content=""),
+        bootstrap_file=path / "bootstrap.json",
+    )
+
+
+@pytest.mark.asyncio(scope="session")
+class TestReattach:
+    """
+    Test reattaching to instances that run since before the server started
+    """
+
+    async def test_stale(self, test_context_empty):
+        service = test_context_empty.runtime.qemu_service
+        with tempfile.TemporaryDirectory(dir="/tmp") as instance_dir:
+            instance = instance_entity(pathlib.Path(instance_dir))
+            service.pid_path(instance).write_text("4194304")
+            service.qmp_path(instance).touch()
+            assert service.running_pid(instance) is None
+            assert not await service.reattach_instance(instance)
+            assert not service.pid_path(instance).exists()
+            assert not service.qmp_path(instance).exists()
+            # Nothing runs, so there is no QMP socket to wait for
+            started = time.monotonic()
+            assert InstanceState.STOPPED == await service.stop_instance(instance)
+            assert time.monotonic() - started < 1
+
+    async def test_running(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.qemu_service
+        with tempfile.TemporaryDirectory(dir="/tmp") as instance_dir:
+            instance = instance_entity(pathlib.Path(instance_dir))
+            # Holds a lock on its pidfile like QEMU does
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-c",
+                "import fcntl, os, sys, time\n"
+                "f = open(sys.argv[1], 'w')\n"
+                "fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                "f.write(str(os.getpid()))\n"
+                "f.flush()\n"
+                "time.sleep(30)\n",
+                str(service.pid_path(instance)),
+            )
+            async with asyncio.timeout(5):
+                while service.running_pid(instance) is None:
+                    await asyncio.sleep(0.01)
+            assert process.pid == service.running_pid(instance)
+            async with FakeQMP(service.qmp_path(instance), {}) as qmp:
+                assert await service.reattach_instance(instance)
+                assert InstanceState.STARTED == service.state(instance)
+                assert process.pid == runtime.supervisor_service.get(instance).pid
+                assert await service.reattach_instance(instance)
+
+                runtime.config.instance_shutdown_timeout = 0
+                try:
+                    assert InstanceState.STOPPED == await service.stop_instance(instance)
+                finally:
+                    runtime.config.instance_shutdown_timeout = 60
+                assert "system_powerdown" in qmp.commands
+            assert -15 == await process.wait()
+            assert InstanceState.STOPPED == runtime.supervisor_service.state(instance)
+            assert runtime.supervisor_service.get(instance).returncode is None
@@ -0,0 +1,85 @@
+import asyncio
+import collections
+import os
+import uuid
+
+import pytest
+
+from kaso_mashin.common import BinarySizedValue, BinaryScale
+from kaso_mashin.common.entities import InstanceState
+from kaso_mashin.common.services import ResourceException, ResourcesGetSchema
+
+ResourceInstance = collections.namedtuple("ResourceInstance", "uid name vcpu ram")
+
+
+def resource_instance(name: str, vcpu: int, ram: int = 0) -> ResourceInstance:
+    return ResourceInstance(
+        uid=uuid.uuid4(), name=name, vcpu=vcpu, ram=BinarySizedValue(ram, BinaryScale.M)
+    )
+
+
+@pytest.mark.asyncio(scope="session")
+class TestResourceService:
+    """
+    Test accounting and admission of the vCPUs and RAM of instances
+    """
+
+    async def test_get_api(self, test_context_empty):
+        resp = test_context_empty.client.get("/api/capacity/resources")
+        assert 200 == resp.status_code
+        resources = ResourcesGetSchema.model_validate_json(resp.content)
+        assert os.cpu_count() == resources.vcpu_total
+        assert resources.ram_total > 0
+        assert (
+            resources.vcpu_available
+            == int(resources.vcpu_overcommit_ratio * resources.vcpu_total) - resources.vcpu_reserved
+        )
+
+    async def test_reject(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.resource_service
+        usage = service.usage()
+        instance = resource_instance("large", usage.vcpu_available + 1)
+        with pytest.raises(ResourceException) as rex:
+            await service.admit(instance)
+        assert 503 == rex.value.status
+        assert "overcommit ratio" in rex.value.msg
+        with pytest.raises(ResourceException):
+            await service.admit(resource_instance("hungry", 1, usage.ram_available + 1))
+        assert usage == service.usage()
+
+    async def test_queue(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.resource_service
+        first = resource_instance("first", service.usage().vcpu_available)
+        second = resource_instance("second", 1)
+        runtime.config.instance_admission_timeout = 5
+        try:
+            await service.admit(first)
+            assert 0 == service.usage().vcpu_available
+            waiter = asyncio.create_task(service.admit(second))
+            await asyncio.sleep(0.2)
+            assert not waiter.done()
+            assert 1 == service.usage().waiting
+            await runtime.event_service.on_instance_state(first.uid, InstanceState.STOPPED)
+            await asyncio.wait_for(waiter, timeout=5)
+            assert 1 == service.usage().vcpu_reserved
+        finally:
+            runtime.config.instance_admission_timeout = 0
+            await service.release(first.uid)
+            await service.release(second.uid)
+        assert 0 == service.usage().instances
+
+    async def test_restart(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.resource_service
+        instance = resource_instance("restarted", 1)
+        await service.admit(instance)
+        await runtime.supervisor_service.supervise(instance, ["sleep", "30"])
+        try:
+            # The guest shut down, but the supervisor may restart its process
+            await runtime.event_service.on_instance_state(instance.uid, InstanceState.STOPPED)
+            assert 1 == service.usage().vcpu_reserved
+        finally:
+            await runtime.supervisor_service.halt(instance)
+        assert 0 == service.usage().instances
@@ -0,0 +1,87 @@
+import asyncio
+import collections
+import uuid
+
+import pytest
+
+from kaso_mashin.common.entities import InstanceState
+from kaso_mashin.common.services import RestartPolicy
+
+SupervisedInstance = collections.namedtuple("SupervisedInstance", "uid name")
+
+
+async def wait_for_state(service, instance, state: InstanceState, timeout: float = 5):
+    async with asyncio.timeout(timeout):
+        while service.state(instance) != state:
+            await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio(scope="session")
+class TestSupervisorService:
+    """
+    Test supervising the processes of instances
+    """
+
+    async def test_output(self, test_context_empty):
+        runtime = test_context_empty.runtime
+        service = runtime.supervisor_service
+        instance = SupervisedInstance(uid=uuid.uuid4(), name="output")
+        states = []
+
+        async def on_instance_state(uid, state):
+            if uid == instance.uid:
+                states.append(state)
+
+        runtime.event_service.on_instance_state += on_instance_state
+        runtime.config.instance_output_lines = 3
+        try:
+            await service.supervise(
+                instance,
+                ["sh", "-c", "for i in 1 2 3 4 5; do echo line $i; done; echo failed >&2"],
+                policy=RestartPolicy.NEVER,
+            )
+            await wait_for_state(service, instance, InstanceState.STOPPED)
+        finally:
+            runtime.config.instance_output_lines = 200
+            runtime.event_service.on_instance_state -= on_instance_state
+        process = service.get(instance)
+        assert ["line 3", "line 4", "line 5"] == process.stdout
+        assert ["failed"] == process.stderr
+        assert 0 == process.returncode
+        assert process.pid is None
+        assert [InstanceState.STARTED, InstanceState.STOPPED] == states
+
+    async def test_restart(self, test_context_empty):
+        config = test_context_empty.runtime.config
+        service = test_context_empty.runtime.supervisor_service
+        instance = SupervisedInstance(uid=uuid.uuid4(), name="crashing")
+        config.instance_restart_backoff, config.instance_restart_limit = 0, 2
+        try:
+            await service.supervise(instance, ["sh", "-c", "echo crashed; exit 3"])
+            await wait_for_state(service, instance, InstanceState.STOPPED)
+        finally:
+            config.instance_restart_backoff, config.instance_restart_limit = 1, 5
+        process = service.get(instance)
+        assert RestartPolicy.ON_FAILURE == process.policy
+        assert 2 == process.restarts
+        assert 3 == process.returncode
+        assert ["crashed"] * 3 == process.stdout
+
+    async def test_halt(self, test_context_empty):
+        service = test_context_empty.runtime.supervisor_service
+        instance = SupervisedInstance(uid=uuid.uuid4(), name="halted")
+        await service.supervise(instance, ["sleep", "30"], policy=RestartPolicy.ALWAYS)
+        assert InstanceState.STARTED == service.state(instance)
+        assert service.get(instance).pid is not None
+        asked = []
+
+        async def shutdown() -> bool:
+            asked.append(True)
+            return False
+
+        assert await service.halt(instance, timeout=30, shutdown=shutdown)
+        assert [True] == asked
+        assert InstanceState.STOPPED == service.state(instance)
+        assert 0 == service.get(instance).restarts
+        assert -15 == service.get(instance).returncode
+        assert not await service.halt(SupervisedInstance(uid=uuid.uuid4(), name="unknown"))